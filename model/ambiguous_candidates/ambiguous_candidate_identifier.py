@@ -49,32 +49,71 @@ class AmbiguousCandidateIdentifier(nn.Module):
             self.visual_fc.cuda()
 
     def forward(self, batch):
+        """Returns the list of the logits of the candidates of each instance."""
+        logits, object_mask = self.forward_padded(batch)
+        num_candidates = object_mask.sum(-1).tolist()
+        return [ii[:num] for ii, num in zip(logits, num_candidates)]
+
+    def forward_padded(self, batch):
+        """
+        Returns the logits of the zero-padded candidates of the batch,
+        [batch_size, max_candidates], along with the mask of the candidates.
+
+        Uses the padded features of the Dataloader batches if present, else
+        pads batch["features"].
+        """
+        if batch.get("padded_features") is not None:
+            features = batch["padded_features"]
+            object_mask = batch["object_mask"]
+        else:
+            features, object_mask = pad_features(batch["features"])
+        text_embed = self.encode_text(batch["text_in"])
+        return self.score_candidates(text_embed, features), object_mask
+
+    def score_candidates(self, text_embed, features):
+        """
+        Dot product of the text embedding of each instance with the embedding
+        of its visual features, [batch_size, max_candidates, feature_size].
+        """
+        visual_embed = self.visual_fc(features)
+        return torch.einsum("bnh,bh->bn", visual_embed, text_embed)
+
+    def encode_text(self, text_in):
+        """Embeds the dialog context of each instance, [batch_size, hidden_size]."""
         if self._args["backbone"] == "gpt2":
-            model_output = self.text_encoder(
-                **batch["text_in"], output_hidden_states=True
-            )
+            model_output = self.text_encoder(**text_in, output_hidden_states=True)
             last_hidden_states = model_output[0]
             # Get the hidden state from the last token.
             # Code adopted from:
             # https://huggingface.co/transformers/v3.5.1/_modules/transformers/
             #           modeling_gpt2.html#GPT2ForSequenceClassification
-            input_ids = batch["text_in"]["input_ids"]
+            input_ids = text_in["input_ids"]
             batch_size, sequence_length = input_ids.shape
             sequence_lengths = (
                 torch.ne(input_ids, self.text_encoder.config.pad_token_id).sum(-1) - 1
             )
-            text_embed = last_hidden_states[range(batch_size), sequence_lengths]
+            # torch.arange (rather than range) keeps the batch size dynamic
+            # when the model is traced for export.
+            batch_range = torch.arange(batch_size, device=input_ids.device)
+            text_embed = last_hidden_states[batch_range, sequence_lengths]
 
         if self._args["backbone"] == "bert":
-            model_out = self.text_encoder(**batch["text_in"], output_hidden_states=True)
+            model_out = self.text_encoder(**text_in, output_hidden_states=True)
             last_hidden_states = model_out.hidden_states[-1]
             text_embed = last_hidden_states[:, 0, :]
 
-        text_embed = self.text_fc(text_embed)
-        # Compute cosine similarity.
-        batch_logits = []
-        for visual_feature, text_feature in zip(batch["features"], text_embed):
-            visual_embed = self.visual_fc(visual_feature)
-            logits = (visual_embed * text_feature).sum(axis=-1)
-            batch_logits.append(logits)
-        return batch_logits
+        return self.text_fc(text_embed)
+
+
+def pad_features(features):
+    """
+    Zero-pads the visual features of the candidates of each instance into
+    [batch_size, max_candidates, feature_size], along with the (boolean)
+    mask of the candidates, [batch_size, max_candidates].
+    """
+    padded_features = nn.utils.rnn.pad_sequence(features, batch_first=True)
+    num_candidates = torch.tensor(
+        [len(ii) for ii in features], device=padded_features.device
+    )
+    positions = torch.arange(padded_features.shape[1], device=padded_features.device)
+    return padded_features, positions[None, :] < num_candidates[:, None]
@@ -12,10 +12,18 @@ Author(s): Satwik Kottur
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import hashlib
+import itertools
 import json
+import os
+import sys
 
 import numpy as np
 import torch
+import torch.nn as nn
+
+sys.path.append("..")
+from utils.batching import BatchPrefetcher, gather_token_ids, split_epoch, to_gpu
 
 
 class Dataloader:
@@ -36,75 +44,208 @@ class Dataloader:
         self.num_instances = len(self._data)
         self.device = torch.cuda if args["use_gpu"] else torch
 
-    def get_random_batch(self, batch_size):
-        indices = np.random.randint(0, self.num_instances, batch_size)
-        return self.get_indexed_data(indices)
+        self._dialog_ids = [ii["dialog_id"] for ii in self._data]
+        self._turn_ids = [ii["turn_id"] for ii in self._data]
+        self._image_names = [ii["image_name"] for ii in self._data]
+        if self._features:
+            num_candidates = [
+                self._features[ii].shape[0] for ii in self._image_names
+            ]
+        else:
+            num_candidates = [len(ii["object_map"]) for ii in self._data]
+        self._load_instances(load_path, np.array(num_candidates, dtype=np.int64))
 
-    def get_entire_batch(self, batch_size):
-        all_indices = np.arange(self.num_instances)
-        for start in all_indices[::batch_size]:
-            batch_indices = all_indices[start : start + batch_size]
-            yield self.get_indexed_data(batch_indices)
+    def _load_instances(self, load_path, num_candidates):
+        """
+        Loads the packed token ids, labels and object maps of the instances,
+        which are cached next to load_path.
+        """
+        cache_key = self._cache_key(load_path, num_candidates)
+        cache_path = f"{os.path.splitext(load_path)[0]}_cached_{cache_key}.npz"
+        if not os.path.exists(cache_path):
+            print(f"Saving: {cache_path}")
+            arrays = self._encode_instances(num_candidates)
+            # The cache is only renamed into place once complete: a killed run
+            # leaves a stray .tmp file, not a cache that np.load fails on.
+            with open(cache_path + ".tmp", "wb") as file_id:
+                np.savez(file_id, **arrays)
+            os.replace(cache_path + ".tmp", cache_path)
+        with np.load(cache_path) as arrays:
+            self._token_ids = arrays["token_ids"]
+            self._token_offsets = arrays["token_offsets"]
+            self._labels = arrays["labels"]
+            self._object_maps = arrays["object_maps"]
+            self._candidate_offsets = arrays["candidate_offsets"]
 
-    def get_indexed_data(self, indices):
-        text_labels = []
+    def _cache_key(self, load_path, num_candidates):
+        stat = os.stat(load_path)
+        key = json.dumps(
+            [
+                type(self._tokenizer).__name__,
+                sorted(self._tokenizer.get_vocab().items()),
+                self._tokenizer.all_special_tokens,
+                self._tokenizer.truncation_side,
+                self.num_utterances,
+                self._args["max_length"],
+                stat.st_size,
+                stat.st_mtime_ns,
+            ]
+        )
+        # Labels and object maps depend on the number of candidates in the
+        # visual features of each instance.
+        digest = hashlib.sha1(key.encode("utf-8"))
+        digest.update(num_candidates.tobytes())
+        return digest.hexdigest()[:16]
+
+    def _encode_instances(self, num_candidates):
+        """
+        Tokenizes the dialog history and computes the local candidate labels
+        and object map of each instance, packed into flat arrays.
+        """
         text_inputs = []
-        dialog_ids = []
-        turn_ids = []
-        features = []
+        labels = []
         object_maps = []
-        for index in indices:
+        for dialog_datum, instance_candidates in zip(self._data, num_candidates):
             # Add <USER> and <SYS> tokens.
-            dialog_datum = self._data[index]
-            dialog = self._data[index]["input_text"]
-            for turn_id, turn in enumerate(dialog):
-                if turn_id % 2 == 0:
-                    dialog[turn_id] = "<USER> " + turn
-                else:
-                    dialog[turn_id] = "<SYS> " + turn
-            text = " ".join(dialog[-self.num_utterances :])
-            text_inputs.append(text)
-            dialog_ids.append(dialog_datum["dialog_id"])
-            turn_ids.append(dialog_datum["turn_id"])
-            object_map = dialog_datum["object_map"]
-            # Get image features.
-            if self._features:
-                features.append(self._features[dialog_datum["image_name"]])
-                num_candidates = features[-1].shape[0]
-            else:
-                num_candidates = len(object_map)
+            dialog = [
+                ("<USER> " if turn_id % 2 == 0 else "<SYS> ") + turn
+                for turn_id, turn in enumerate(dialog_datum["input_text"])
+            ]
+            text_inputs.append(" ".join(dialog[-self.num_utterances :]))
 
             # Get the ambiguous candidates and map it local ids.
+            object_map = dialog_datum["object_map"]
             global_ambiguous_candidates = dialog_datum["ambiguous_candidates"]
             local_ambiguous_candidates = [
                 object_map.index(ii) for ii in global_ambiguous_candidates
             ]
             # NOTE: Few scenes have misaligned image features (ignore them).
             # Default object map to linear local ids in such cases.
-            if len(object_map) != num_candidates:
+            if len(object_map) != instance_candidates:
                 local_ambiguous_candidates = global_ambiguous_candidates
-                object_map = list(range(num_candidates))
-            object_maps.append(object_map)
-            label = torch.tensor(
-                [
-                    1 if ii in local_ambiguous_candidates else 0
-                    for ii in range(num_candidates)
-                ],
-                dtype=torch.float32,
-            )
-            text_labels.append(label)
+                object_map = list(range(instance_candidates))
+            object_maps.extend(object_map)
+            label = np.zeros(instance_candidates, dtype=np.float32)
+            for ii in local_ambiguous_candidates:
+                if 0 <= ii < instance_candidates:
+                    label[ii] = 1
+            labels.append(label)
 
         encoded_inputs = self._tokenizer(
-            text_inputs,
-            padding=True,
-            max_length=self._args["max_length"],
-            return_tensors="pt",
-            truncation=True,
+            text_inputs, max_length=self._args["max_length"], truncation=True
+        )["input_ids"]
+        token_offsets = np.cumsum([0] + [len(ii) for ii in encoded_inputs])
+        return {
+            "token_ids": np.fromiter(
+                (token_id for ii in encoded_inputs for token_id in ii),
+                dtype=np.int32,
+                count=token_offsets[-1],
+            ),
+            "token_offsets": token_offsets,
+            "labels": np.concatenate(labels + [np.zeros(0, dtype=np.float32)]),
+            "object_maps": np.array(object_maps, dtype=np.int64),
+            "candidate_offsets": np.cumsum(np.concatenate([[0], num_candidates])),
+        }
+
+    def get_random_batch(self, batch_size):
+        indices = np.random.randint(0, self.num_instances, batch_size)
+        return self.get_indexed_data(indices)
+
+    def get_random_batches(
+        self,
+        batch_size,
+        sampling="epoch",
+        length_bucketing=False,
+        num_prefetch_batches=0,
+        num_workers=1,
+        pin_memory=False,
+    ):
+        """
+        Iterates over random batches, sampled either from a new permutation of
+        the instances every epoch ("epoch", see sample_epochs) or with
+        replacement as get_random_batch ("random"). With num_prefetch_batches
+        > 0, up to that many batches are built ahead of time by num_workers
+        background threads.
+        """
+        if sampling == "random" and length_bucketing:
+            raise ValueError("length_bucketing needs epoch sampling.")
+        if sampling == "epoch":
+            batch_indices = self.sample_epochs(batch_size, length_bucketing)
+        else:
+            batch_indices = (
+                np.random.randint(0, self.num_instances, batch_size)
+                for _ in itertools.count()
+            )
+        if num_prefetch_batches > 0:
+            return BatchPrefetcher(
+                self, batch_indices, num_prefetch_batches, num_workers, pin_memory
+            )
+        return (self.get_indexed_data(indices) for indices in batch_indices)
+
+    def sample_epochs(self, batch_size, length_bucketing=False):
+        """
+        Yields the indices of the batches of successive epochs, each of which
+        visits every instance once, in random order. With length_bucketing,
+        batches group instances of similar lengths (see split_epoch).
+        """
+        lengths = np.diff(self._token_offsets) if length_bucketing else None
+        while True:
+            indices = np.random.permutation(self.num_instances)
+            yield from split_epoch(indices, batch_size, lengths)
+
+    def get_entire_batch(self, batch_size):
+        all_indices = np.arange(self.num_instances)
+        for start in all_indices[::batch_size]:
+            batch_indices = all_indices[start : start + batch_size]
+            yield self.get_indexed_data(batch_indices)
+
+    def get_indexed_data(self, indices, pin_memory=False):
+        indices = np.asarray(indices)
+        input_ids, attention_mask = gather_token_ids(
+            self._token_ids,
+            self._token_offsets,
+            indices,
+            self._tokenizer.pad_token_id,
+            self._tokenizer.padding_side == "left",
         )
-        encoded_inputs = {key: val.detach() for key, val in encoded_inputs.items()}
+        encoded_inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self._tokenizer.model_input_names:
+            encoded_inputs["token_type_ids"] = torch.zeros_like(input_ids)
+
+        starts = self._candidate_offsets[indices]
+        ends = self._candidate_offsets[indices + 1]
+        text_labels = [
+            torch.from_numpy(self._labels[start:end]) for start, end in zip(starts, ends)
+        ]
+        object_maps = [
+            self._object_maps[start:end].tolist() for start, end in zip(starts, ends)
+        ]
+        # Candidates of all the instances, zero-padded to the largest number of
+        # candidates, for the batched forward and loss.
+        num_candidates = ends - starts
+        candidate_ids = np.arange(num_candidates.max(initial=0))
+        object_mask = candidate_ids[None, :] < num_candidates[:, None]
+        padded_labels = np.zeros(object_mask.shape, dtype=np.float32)
+        if not self._hidden_labels:
+            padded_labels[object_mask] = self._labels[
+                (starts[:, None] + candidate_ids)[object_mask]
+            ]
+        padded_labels = torch.from_numpy(padded_labels)
+        object_mask = torch.from_numpy(object_mask)
+        # Get image features.
+        features = []
+        padded_features = None
+        if self._features:
+            features = [self._features[self._image_names[ii]] for ii in indices]
+            padded_features = nn.utils.rnn.pad_sequence(features, batch_first=True)
+
         if self._args["use_gpu"]:
-            encoded_inputs = {key: val.cuda() for key, val in encoded_inputs.items()}
-            text_labels = [ii.cuda() for ii in text_labels]
+            encoded_inputs = {
+                key: to_gpu(val, pin_memory) for key, val in encoded_inputs.items()
+            }
+            text_labels = [to_gpu(ii, pin_memory) for ii in text_labels]
+            padded_labels = to_gpu(padded_labels, pin_memory)
+            object_mask = to_gpu(object_mask, pin_memory)
         if self._hidden_labels:
             # Reset all the text_labels to [0] (dummy labels).
             text_labels = [[0] for ii in text_labels]
@@ -113,14 +254,18 @@ class Dataloader:
         batch = {
             "text_in": encoded_inputs,
             "gt_label": text_labels,
-            "dialog_id": dialog_ids,
-            "turn_id": turn_ids,
+            "dialog_id": [self._dialog_ids[ii] for ii in indices],
+            "turn_id": [self._turn_ids[ii] for ii in indices],
             "features": features,
             "object_map": object_maps,
+            "padded_gt_label": padded_labels,
+            "padded_features": padded_features,
+            "object_mask": object_mask,
         }
         return batch
 
 
+
 class VisualFeatureLoader:
     """Loads visual features for SIMMC 2.1 ambiguous candidate identification."""
 
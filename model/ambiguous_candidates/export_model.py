@@ -0,0 +1,210 @@
+#! /usr/bin/env python
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+This source code is licensed under the license found in the LICENSE file in the
+root directory of this source tree.
+
+Exports a trained ambiguous candidate identifier (see --model_save_path of
+train_model.py) to a TorchScript or ONNX graph that exported_model.py runs
+without transformers, and checks its parity with the eager model.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import inspect
+import json
+import os
+
+import torch
+import torch.nn as nn
+
+from dataloader import Dataloader, VisualFeatureLoader
+from ambiguous_candidate_identifier import AmbiguousCandidateIdentifier
+from exported_model import (
+    EXPORT_CONFIG_NAME,
+    INPUT_NAMES,
+    OUTPUT_NAMES,
+    ExportedAmbiguousCandidateIdentifier,
+)
+from train_model import build_tokenizer
+
+
+GRAPH_FILES = {"torchscript": "model.pt", "onnx": "model.onnx"}
+# Dialogs for the parity check, if no --data_file is given.
+DEFAULT_DIALOGS = [
+    "<USER> Do you have any shirts with good reviews?",
+    "<USER> I need a new jacket. <SYS> How about the grey one on the left? "
+    "<USER> How much is it?",
+]
+
+
+class AmbiguousCandidateIdentifierExportWrapper(nn.Module):
+    """Scores zero-padded candidates, [batch_size, max_candidates, feature_size]."""
+
+    def __init__(self, model):
+        super(AmbiguousCandidateIdentifierExportWrapper, self).__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, features):
+        text_embed = self.model.encode_text(
+            {"input_ids": input_ids, "attention_mask": attention_mask}
+        )
+        return self.model.score_candidates(text_embed, features)
+
+
+def export_graph(wrapper, example_inputs, graph_path, export_format):
+    if export_format == "torchscript":
+        with torch.no_grad():
+            traced = torch.jit.trace(
+                wrapper, example_inputs, strict=False, check_trace=False
+            )
+        torch.jit.save(traced, graph_path)
+        return
+
+    dynamic_axes = {
+        "input_ids": {0: "batch_size", 1: "length"},
+        "attention_mask": {0: "batch_size", 1: "length"},
+        "features": {0: "batch_size", 1: "max_candidates"},
+        "logits": {0: "batch_size", 1: "max_candidates"},
+    }
+    kwargs = {}
+    # Newer versions of torch default to the dynamo based exporter.
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        kwargs["dynamo"] = False
+    torch.onnx.export(
+        wrapper,
+        example_inputs,
+        graph_path,
+        input_names=INPUT_NAMES,
+        output_names=OUTPUT_NAMES,
+        dynamic_axes=dynamic_axes,
+        opset_version=14,
+        **kwargs,
+    )
+
+
+def sample_batch(tokenizer, dialogs, feature_size):
+    """Returns a batch of dialogs with random features of 1, 2, ... candidates."""
+    text_in = tokenizer(dialogs, padding=True, return_tensors="pt")
+    return {
+        "text_in": {name: text_in[name] for name in INPUT_NAMES[:2]},
+        "features": [
+            torch.randn((index + 1, feature_size)) for index in range(len(dialogs))
+        ],
+    }
+
+
+def main(args):
+    checkpoint = torch.load(args["checkpoint_path"], map_location="cpu")
+    model_args = checkpoint["args"]
+    model_args["use_gpu"] = False
+    tokenizer = build_tokenizer(model_args["backbone"])
+    model = AmbiguousCandidateIdentifier(tokenizer, model_args)
+    model.load_state_dict(checkpoint["model_state_dict"])
+    model.eval()
+    wrapper = AmbiguousCandidateIdentifierExportWrapper(model).eval()
+
+    # Trace with padding, so that the attention mask is used.
+    example_batch = sample_batch(
+        tokenizer, DEFAULT_DIALOGS, model_args["visual_feature_size"]
+    )
+    example_inputs = (
+        example_batch["text_in"]["input_ids"],
+        example_batch["text_in"]["attention_mask"],
+        nn.utils.rnn.pad_sequence(example_batch["features"], batch_first=True),
+    )
+
+    os.makedirs(args["output_dir"], exist_ok=True)
+    graph_file = GRAPH_FILES[args["format"]]
+    print(f"""Exporting: {os.path.join(args["output_dir"], graph_file)}""")
+    export_graph(
+        wrapper,
+        example_inputs,
+        os.path.join(args["output_dir"], graph_file),
+        args["format"],
+    )
+    export_config = {
+        "format": args["format"],
+        "graph_file": graph_file,
+        # To format and tokenize the dialogs as the Dataloader.
+        "max_turns": model_args["max_turns"],
+        "max_length": model_args["max_length"],
+    }
+    with open(os.path.join(args["output_dir"], EXPORT_CONFIG_NAME), "w") as file_id:
+        json.dump(export_config, file_id)
+    # Tokenizer files, to encode the inputs of the exported model.
+    tokenizer.save_pretrained(args["output_dir"])
+
+    # Parity check against the eager model.
+    if args["data_file"]:
+        feature_loader = VisualFeatureLoader(
+            args["visual_feature_path"] or model_args["visual_feature_path"],
+            model_args["visual_feature_size"],
+        )
+        loader = Dataloader(tokenizer, feature_loader, args["data_file"], model_args)
+        batch = next(loader.get_entire_batch(args["num_parity_instances"]))
+    else:
+        batch = sample_batch(
+            tokenizer, DEFAULT_DIALOGS[::-1] * 2, model_args["visual_feature_size"]
+        )
+    exported = ExportedAmbiguousCandidateIdentifier(args["output_dir"])
+    with torch.no_grad():
+        logits = model(batch)
+    exported_logits = exported(batch)
+    max_diff = max(
+        (ii - jj).abs().max().item() for ii, jj in zip(logits, exported_logits)
+    )
+    num_matches = sum(
+        torch.equal(ii > 0, jj > 0) for ii, jj in zip(logits, exported_logits)
+    )
+    print(
+        f"Parity: max |logits diff| = {max_diff:.2e}, "
+        f"{num_matches} / {len(logits)} identical predictions"
+    )
+    if max_diff > args["parity_tolerance"]:
+        raise ValueError(
+            f"""Exported logits differ by more than {args["parity_tolerance"]}."""
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--checkpoint_path", required=True, help="Path to the trained model"
+    )
+    parser.add_argument(
+        "--output_dir", required=True, help="Path to save the exported model"
+    )
+    parser.add_argument(
+        "--format",
+        default="torchscript",
+        choices=list(GRAPH_FILES),
+        help="Format of the exported graph",
+    )
+    parser.add_argument(
+        "--data_file", default=None, help="Path to data (e.g. devtest) for parity"
+    )
+    parser.add_argument(
+        "--visual_feature_path",
+        default=None,
+        help="Path to visual features for --data_file (default: the training one)",
+    )
+    parser.add_argument(
+        "--num_parity_instances",
+        type=int,
+        default=32,
+        help="Number of instances for the parity check",
+    )
+    parser.add_argument(
+        "--parity_tolerance",
+        type=float,
+        default=1e-4,
+        help="Max absolute difference of the logits of the exported model",
+    )
+    try:
+        parsed_args = vars(parser.parse_args())
+    except (IOError) as msg:
+        parser.error(str(msg))
+    main(parsed_args)
@@ -0,0 +1,72 @@
+#! /usr/bin/env python
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+This source code is licensed under the license found in the LICENSE file in the
+root directory of this source tree.
+
+Runtime for Ambiguous Candidate Identifier Models exported by export_model.py.
+
+The exported graph (TorchScript or ONNX) maps (input_ids, attention_mask,
+features) to the logits of the candidates, where features holds the visual
+features of the candidates of each instance, zero-padded to
+[batch_size, max_candidates, visual_feature_size]. It only needs torch (and
+onnxruntime for ONNX graphs), not transformers.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import os
+
+import torch
+import torch.nn as nn
+
+
+EXPORT_CONFIG_NAME = "export_config.json"
+INPUT_NAMES = ["input_ids", "attention_mask", "features"]
+OUTPUT_NAMES = ["logits"]
+
+
+class ExportedAmbiguousCandidateIdentifier:
+    def __init__(self, export_dir, use_gpu=False):
+        with open(os.path.join(export_dir, EXPORT_CONFIG_NAME), "r") as file_id:
+            self.config = json.load(file_id)
+        graph_path = os.path.join(export_dir, self.config["graph_file"])
+        self._session = None
+        self._module = None
+        self._device = torch.device("cuda" if use_gpu else "cpu")
+        if self.config["format"] == "onnx":
+            # Only needed to run ONNX graphs.
+            import onnxruntime
+
+            self._session = onnxruntime.InferenceSession(
+                graph_path, providers=["CPUExecutionProvider"]
+            )
+        else:
+            self._module = torch.jit.load(graph_path, map_location=self._device)
+
+    def __call__(self, batch):
+        """
+        Returns the logits of the candidates of each instance for a batch of
+        the Dataloader, as AmbiguousCandidateIdentifier.
+        """
+        features = nn.utils.rnn.pad_sequence(batch["features"], batch_first=True)
+        inputs = [batch["text_in"]["input_ids"], batch["text_in"]["attention_mask"]]
+        inputs.append(features)
+        if self._session is not None:
+            (logits,) = self._session.run(
+                OUTPUT_NAMES,
+                {
+                    name: tensor.cpu().numpy()
+                    for name, tensor in zip(INPUT_NAMES, inputs)
+                },
+            )
+            logits = torch.from_numpy(logits).to(self._device)
+        else:
+            with torch.no_grad():
+                logits = self._module(*inputs)
+        return [
+            instance_logits[: feature.shape[0]]
+            for instance_logits, feature in zip(logits, batch["features"])
+        ]
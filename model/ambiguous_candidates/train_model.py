@@ -15,11 +15,13 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 import argparse
 import collections
 import json
+import math
 import os
 import sys
 sys.path.append("..")
 from tqdm import tqdm as progressbar
 
+import numpy as np
 import torch
 import torch.nn as nn
 import transformers
@@ -66,8 +68,17 @@ def evaluate_model(model, loader, batch_size, save_path=None, hidden_test=False)
     return report["recall"], report["precision"], report["f1"]
 
 
-def main(args):
-    if args["backbone"] == "gpt2":
+def save_checkpoint(model, args):
+    """Saves the model weights along with the arguments to rebuild it."""
+    print(f"Saving: {args['model_save_path']}")
+    torch.save(
+        {"args": args, "model_state_dict": model.state_dict()},
+        args["model_save_path"],
+    )
+
+
+def build_tokenizer(backbone):
+    if backbone == "gpt2":
         tokenizer = transformers.GPT2Tokenizer.from_pretrained("gpt2")
         # Define PAD Token = EOS Token = 50256
         tokenizer.pad_token = tokenizer.eos_token
@@ -77,6 +88,14 @@ def main(args):
         {"additional_special_tokens": ["<USER>", "<SYS>"]}
     )
     tokenizer.truncation_side = "left"
+    return tokenizer
+
+
+def main(args):
+    if args["seed"] is not None:
+        np.random.seed(args["seed"])
+        torch.manual_seed(args["seed"])
+    tokenizer = build_tokenizer(args["backbone"])
 
     # Dataloaders.
     feature_loader = VisualFeatureLoader(
@@ -95,7 +114,9 @@ def main(args):
     model = AmbiguousCandidateIdentifier(tokenizer, args)
     model.train()
     # Loss function.
-    criterion = nn.BCEWithLogitsLoss(pos_weight=torch.tensor([args["positive_weight"]]))
+    criterion = nn.BCEWithLogitsLoss(
+        pos_weight=torch.tensor([args["positive_weight"]]), reduction="none"
+    )
     if args["use_gpu"]:
         criterion = criterion.cuda()
     # Prepare optimizer and schedule (linear warmup and decay).
@@ -108,22 +129,33 @@ def main(args):
     )
     num_iters_epoch = train_loader.num_instances // args["batch_size"]
     num_iters_epoch_float = train_loader.num_instances / args["batch_size"]
+    if args["sampling"] == "epoch":
+        # Epochs of the sampler end with a smaller batch.
+        num_iters_epoch_float = math.ceil(num_iters_epoch_float)
     next_eval_iter = 0
     num_iters = 0
     best_performance = {"dev": 0.0}
     total_loss = None
+    train_batches = train_loader.get_random_batches(
+        args["batch_size"],
+        args["sampling"],
+        args["length_bucketing"],
+        num_prefetch_batches=args["num_prefetch_batches"],
+        num_workers=args["num_workers"],
+        pin_memory=args["pin_memory"],
+    )
     while True:
         model.zero_grad()
 
-        epoch = num_iters / (float(train_loader.num_instances) / args["batch_size"])
-        batch = train_loader.get_random_batch(args["batch_size"])
-        output = model(batch)
+        epoch = num_iters / num_iters_epoch_float
+        batch = next(train_batches)
+        logits, object_mask = model.forward_padded(batch)
 
-        # Compute criterion per instance.
-        per_instance_loss = []
-        for pred, target in zip(output, batch["gt_label"]):
-            per_instance_loss.append(criterion(pred.view(-1, 1), target.view(-1, 1)))
-        loss = sum(per_instance_loss)
+        # Mean criterion over the candidates of each instance, summed over
+        # the instances (padded candidates are masked out).
+        candidate_loss = criterion(logits, batch["padded_gt_label"]) * object_mask
+        num_candidates = object_mask.sum(-1).clamp(min=1)
+        loss = (candidate_loss.sum(-1) / num_candidates).sum()
         loss.backward()
         optimizer.step()
 
@@ -148,11 +180,25 @@ def main(args):
                 f"[dev]  Rec: {recall:.4f}  |  Prec: {precision:.4f}  |  F1: {f1:.4f}"
             )
 
+            if (
+                args["target_metric"] is not None
+                and "target_iter_id" not in best_performance
+                and f1 >= args["target_metric"]
+            ):
+                best_performance["target_iter_id"] = num_iters
+                best_performance["target_epoch"] = epoch
+                print(
+                    f"Reached target dev F1 {args['target_metric']} "
+                    f"at iter {num_iters} [Ep: {epoch:.2f}]"
+                )
+
             # Evaluate on devtest and teststd if better dev performance.
             if best_performance["dev"] < f1:
                 best_performance["dev"] = f1
                 best_performance["iter_id"] = num_iters
                 best_performance["epoch"] = epoch
+                if args["model_save_path"]:
+                    save_checkpoint(model, args)
 
                 # Get devtest results.
                 save_path = None
@@ -193,6 +239,9 @@ def main(args):
         next_eval_iter = int(int(epoch + 1) * num_iters_epoch_float)
         if epoch > args["num_epochs"]:
             break
+    train_batches.close()
+    if args["target_metric"] is not None and "target_iter_id" not in best_performance:
+        print(f"Target dev F1 {args['target_metric']} not reached")
 
 
 if __name__ == "__main__":
@@ -206,6 +255,11 @@ if __name__ == "__main__":
     parser.add_argument(
         "--result_save_path", default=None, help="Path to save devtest results"
     )
+    parser.add_argument(
+        "--model_save_path",
+        default=None,
+        help="Path to save the checkpoint with the best dev performance",
+    )
     parser.add_argument(
         "--visual_feature_path", default=None, help="Path to visual features"
     )
@@ -255,8 +309,51 @@ if __name__ == "__main__":
     )
     parser.add_argument("--weight_decay", type=float, default=0.0, help="Weight decay")
     parser.add_argument("--use_gpu", dest="use_gpu", action="store_true", default=False)
+    parser.add_argument(
+        "--sampling",
+        default="epoch",
+        choices=["epoch", "random"],
+        help="Shuffle the instances every epoch, or sample them with replacement",
+    )
+    parser.add_argument(
+        "--length_bucketing",
+        dest="length_bucketing",
+        action="store_true",
+        default=False,
+        help="Batch instances of similar lengths together (epoch sampling)",
+    )
+    parser.add_argument(
+        "--target_metric",
+        type=float,
+        default=None,
+        help="Report the first iteration reaching this dev F1",
+    )
+    parser.add_argument(
+        "--num_prefetch_batches",
+        type=int,
+        default=2,
+        help="Number of training batches built ahead of time (0 to disable)",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=1,
+        help="Number of threads building the prefetched batches",
+    )
+    parser.add_argument(
+        "--pin_memory",
+        dest="pin_memory",
+        action="store_true",
+        default=False,
+        help="Copy the prefetched batches to the GPU from pinned memory",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=None, help="Seed for sampling and initialization"
+    )
     try:
         parsed_args = vars(parser.parse_args())
     except (IOError) as msg:
         parser.error(str(msg))
+    if parsed_args["sampling"] == "random" and parsed_args["length_bucketing"]:
+        parser.error("--length_bucketing needs --sampling epoch")
     main(parsed_args)
@@ -12,11 +12,16 @@ Author(s): Satwik Kottur
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import itertools
 import json
+import sys
 
 import numpy as np
 import torch
 
+sys.path.append("..")
+from utils.batching import BatchPrefetcher, gather_token_ids, split_epoch, to_gpu
+
 
 class Dataloader:
     def __init__(self, tokenizer, load_path, args, hidden_labels=False):
@@ -30,47 +35,143 @@ class Dataloader:
         self.num_utterances = 2 * args["max_turns"] + 1
         self.num_instances = len(self._raw_data)
         self.device = torch.cuda if args["use_gpu"] else torch
+        self._encode_instances()
+
+    def _encode_instances(self):
+        """
+        Tokenizes the (role tagged, truncated) dialog history of each instance
+        once, into a flat int32 array of token ids and the offsets of each
+        instance.
+        """
+        text_inputs = []
+        for dialog_datum in self._raw_data:
+            # Add <USER> and <SYS> tokens.
+            dialog = [
+                ("<USER> " if turn_id % 2 == 0 else "<SYS> ") + turn
+                for turn_id, turn in enumerate(dialog_datum["input_text"])
+            ]
+            text_inputs.append(" ".join(dialog[-self.num_utterances :]))
+        encoded_inputs = self._tokenizer(
+            text_inputs, max_length=self._args["max_length"], truncation=True
+        )["input_ids"]
+        lengths = np.array([len(ii) for ii in encoded_inputs], dtype=np.int64)
+        self._offsets = np.concatenate([[0], np.cumsum(lengths)])
+        self._lengths = lengths
+        self._token_ids = np.fromiter(
+            (token_id for ii in encoded_inputs for token_id in ii),
+            dtype=np.int32,
+            count=self._offsets[-1],
+        )
+        self._labels = np.array(
+            [ii["disambiguation_label_gt"] for ii in self._raw_data], dtype=np.int64
+        )
+        self._dialog_ids = [ii["dialog_id"] for ii in self._raw_data]
+        self._turn_ids = [ii["turn_id"] for ii in self._raw_data]
 
     def get_random_batch(self, batch_size):
         indices = np.random.randint(0, self.num_instances, batch_size)
         return self.get_indexed_data(indices)
 
+    def get_random_batches(
+        self,
+        batch_size,
+        sampling="epoch",
+        length_bucketing=False,
+        class_balanced=False,
+        num_prefetch_batches=0,
+        num_workers=1,
+        pin_memory=False,
+    ):
+        """
+        Iterates over random batches, sampled either from a new permutation of
+        the instances every epoch ("epoch", see sample_epochs) or with
+        replacement as get_random_batch ("random"). With num_prefetch_batches
+        > 0, up to that many batches are built ahead of time by num_workers
+        background threads.
+        """
+        if sampling == "random" and (length_bucketing or class_balanced):
+            raise ValueError(
+                "length_bucketing and class_balanced need epoch sampling."
+            )
+        if sampling == "epoch":
+            batch_indices = self.sample_epochs(
+                batch_size, length_bucketing, class_balanced
+            )
+        else:
+            batch_indices = (
+                np.random.randint(0, self.num_instances, batch_size)
+                for _ in itertools.count()
+            )
+        if num_prefetch_batches > 0:
+            return BatchPrefetcher(
+                self, batch_indices, num_prefetch_batches, num_workers, pin_memory
+            )
+        return (self.get_indexed_data(indices) for indices in batch_indices)
+
+    def sample_epochs(self, batch_size, length_bucketing=False, class_balanced=False):
+        """
+        Yields the indices of the batches of successive epochs, each of which
+        visits every instance once, in random order.
+
+        With length_bucketing, batches group instances of similar lengths (see
+        split_epoch). With class_balanced, each epoch rather draws the same
+        number of instances of each disambiguation label, cycling through
+        permutations of the instances of each label.
+        """
+        class_indices = [
+            np.flatnonzero(self._labels == label) for label in np.unique(self._labels)
+        ]
+        class_pending = [np.zeros(0, dtype=np.int64) for _ in class_indices]
+        lengths = self._lengths if length_bucketing else None
+        while True:
+            if not class_balanced:
+                indices = np.random.permutation(self.num_instances)
+                yield from split_epoch(indices, batch_size, lengths)
+                continue
+
+            num_classes = len(class_indices)
+            class_counts = np.full(num_classes, self.num_instances // num_classes)
+            class_counts[: self.num_instances % num_classes] += 1
+            indices = []
+            for label, count in enumerate(class_counts):
+                while len(class_pending[label]) < count:
+                    class_pending[label] = np.concatenate(
+                        [
+                            class_pending[label],
+                            np.random.permutation(class_indices[label]),
+                        ]
+                    )
+                indices.append(class_pending[label][:count])
+                class_pending[label] = class_pending[label][count:]
+            indices = np.concatenate(indices)
+            np.random.shuffle(indices)
+            yield from split_epoch(indices, batch_size, lengths)
+
     def get_entire_batch(self, batch_size):
         all_indices = np.arange(self.num_instances)
         for start in all_indices[::batch_size]:
             batch_indices = all_indices[start : start + batch_size]
             yield self.get_indexed_data(batch_indices)
 
-    def get_indexed_data(self, indices):
-        text_labels = []
-        text_inputs = []
-        dialog_ids = []
-        turn_ids = []
-        for index in indices:
-            # Add <USER> and <SYS> tokens.
-            dialog_datum = self._raw_data[index]
-            dialog = self._raw_data[index]["input_text"]
-            for turn_id, turn in enumerate(dialog):
-                if turn_id % 2 == 0:
-                    dialog[turn_id] = "<USER> " + turn
-                else:
-                    dialog[turn_id] = "<SYS> " + turn
-            text = " ".join(dialog[-self.num_utterances :])
-            text_inputs.append(text)
-            text_labels.append(dialog_datum["disambiguation_label_gt"])
-            dialog_ids.append(dialog_datum["dialog_id"])
-            turn_ids.append(dialog_datum["turn_id"])
-
-        encoded_inputs = self._tokenizer(
-            text_inputs,
-            padding=True,
-            max_length=self._args["max_length"],
-            return_tensors="pt",
-            truncation=True,
+    def get_indexed_data(self, indices, pin_memory=False):
+        indices = np.asarray(indices)
+        input_ids, attention_mask = gather_token_ids(
+            self._token_ids,
+            self._offsets,
+            indices,
+            self._tokenizer.pad_token_id,
+            self._tokenizer.padding_side == "left",
         )
-        encoded_inputs = {key: val.detach() for key, val in encoded_inputs.items()}
+        encoded_inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self._tokenizer.model_input_names:
+            encoded_inputs["token_type_ids"] = torch.zeros_like(
+                encoded_inputs["input_ids"]
+            )
         if self._args["use_gpu"]:
-            encoded_inputs = {key: val.cuda() for key, val in encoded_inputs.items()}
+            encoded_inputs = {
+                key: to_gpu(val, pin_memory) for key, val in encoded_inputs.items()
+            }
+        text_labels = self._labels[indices].tolist()
         if self._hidden_labels:
             # Reset all the text_labels to 0.
             text_labels = [0 for ii in text_labels]
@@ -78,7 +179,8 @@ class Dataloader:
         batch = {
             "text_in": encoded_inputs,
             "gt_label": self.device.LongTensor(text_labels),
-            "dialog_id": dialog_ids,
-            "turn_id": turn_ids,
+            "dialog_id": [self._dialog_ids[ii] for ii in indices],
+            "turn_id": [self._turn_ids[ii] for ii in indices],
         }
         return batch
+
@@ -15,8 +15,10 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 import argparse
 import collections
 import json
+import math
 import os
 
+import numpy as np
 import torch
 import torch.nn as nn
 import transformers
@@ -60,8 +62,17 @@ def evaluate_model(model, loader, batch_size, save_path=None, hidden_test=False)
     return accuracy
 
 
-def main(args):
-    if args["backbone"] == "gpt2":
+def save_checkpoint(model, args):
+    """Saves the model weights along with the arguments to rebuild it."""
+    print(f"Saving: {args['model_save_path']}")
+    torch.save(
+        {"args": args, "model_state_dict": model.state_dict()},
+        args["model_save_path"],
+    )
+
+
+def build_tokenizer(backbone):
+    if backbone == "gpt2":
         tokenizer = transformers.GPT2Tokenizer.from_pretrained("gpt2")
         # Define PAD Token = EOS Token = 50256
         tokenizer.pad_token = tokenizer.eos_token
@@ -71,6 +82,14 @@ def main(args):
         {"additional_special_tokens": ["<USER>", "<SYS>"]}
     )
     tokenizer.truncation_side = "left"
+    return tokenizer
+
+
+def main(args):
+    if args["seed"] is not None:
+        np.random.seed(args["seed"])
+        torch.manual_seed(args["seed"])
+    tokenizer = build_tokenizer(args["backbone"])
     
     # Dataloader.
     train_loader = Dataloader(tokenizer, args["train_file"], args)
@@ -96,15 +115,27 @@ def main(args):
     )
     num_iters_epoch = train_loader.num_instances // args["batch_size"]
     num_iters_epoch_float = train_loader.num_instances / args["batch_size"]
+    if args["sampling"] == "epoch":
+        # Epochs of the sampler end with a smaller batch.
+        num_iters_epoch_float = math.ceil(num_iters_epoch_float)
     next_eval_iter = 0
     num_iters = 0
     best_performance = {"dev": 0.0}
     total_loss = None
+    train_batches = train_loader.get_random_batches(
+        args["batch_size"],
+        args["sampling"],
+        args["length_bucketing"],
+        args["class_balanced"],
+        num_prefetch_batches=args["num_prefetch_batches"],
+        num_workers=args["num_workers"],
+        pin_memory=args["pin_memory"],
+    )
     while True:
         model.zero_grad()
 
-        epoch = num_iters / (float(train_loader.num_instances) / args["batch_size"])
-        batch = train_loader.get_random_batch(args["batch_size"])
+        epoch = num_iters / num_iters_epoch_float
+        batch = next(train_batches)
         output = model(batch)
         loss = criterion(output, batch["gt_label"])
         loss.backward()
@@ -127,11 +158,25 @@ def main(args):
             accuracy = evaluate_model(model, val_loader, args["batch_size"])
             print(f"Accuracy [dev]: {accuracy}")
 
+            if (
+                args["target_metric"] is not None
+                and "target_iter_id" not in best_performance
+                and accuracy >= args["target_metric"]
+            ):
+                best_performance["target_iter_id"] = num_iters
+                best_performance["target_epoch"] = epoch
+                print(
+                    f"Reached target dev accuracy {args['target_metric']} "
+                    f"at iter {num_iters} [Ep: {epoch:.2f}]"
+                )
+
             # Evaluate on devtest and teststd if better dev performance.
             if best_performance["dev"] < accuracy:
                 best_performance["dev"] = accuracy
                 best_performance["iter_id"] = num_iters
                 best_performance["epoch"] = epoch
+                if args["model_save_path"]:
+                    save_checkpoint(model, args)
 
                 # Get devtest results.
                 if args["result_save_path"]:
@@ -171,6 +216,9 @@ def main(args):
         next_eval_iter = int(int(epoch + 1) * num_iters_epoch_float)
         if epoch > args["num_epochs"]:
             break
+    train_batches.close()
+    if args["target_metric"] is not None and "target_iter_id" not in best_performance:
+        print(f"Target dev accuracy {args['target_metric']} not reached")
 
 
 if __name__ == "__main__":
@@ -186,6 +234,11 @@ if __name__ == "__main__":
     parser.add_argument(
         "--result_save_path", default=None, help="Path to save devtest results"
     )
+    parser.add_argument(
+        "--model_save_path",
+        default=None,
+        help="Path to save the checkpoint with the best dev performance",
+    )
     parser.add_argument(
         "--max_turns", type=int, default=5, help="Number of turns in history"
     )
@@ -214,8 +267,60 @@ if __name__ == "__main__":
     )
     parser.add_argument("--weight_decay", type=float, default=0.0, help="Weight decay")
     parser.add_argument("--use_gpu", dest="use_gpu", action="store_true", default=False)
+    parser.add_argument(
+        "--sampling",
+        default="epoch",
+        choices=["epoch", "random"],
+        help="Shuffle the instances every epoch, or sample them with replacement",
+    )
+    parser.add_argument(
+        "--length_bucketing",
+        dest="length_bucketing",
+        action="store_true",
+        default=False,
+        help="Batch instances of similar lengths together (epoch sampling)",
+    )
+    parser.add_argument(
+        "--class_balanced",
+        dest="class_balanced",
+        action="store_true",
+        default=False,
+        help="Sample both disambiguation labels equally often (epoch sampling)",
+    )
+    parser.add_argument(
+        "--target_metric",
+        type=float,
+        default=None,
+        help="Report the first iteration reaching this dev accuracy",
+    )
+    parser.add_argument(
+        "--num_prefetch_batches",
+        type=int,
+        default=2,
+        help="Number of training batches built ahead of time (0 to disable)",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=1,
+        help="Number of threads building the prefetched batches",
+    )
+    parser.add_argument(
+        "--pin_memory",
+        dest="pin_memory",
+        action="store_true",
+        default=False,
+        help="Copy the prefetched batches to the GPU from pinned memory",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=None, help="Seed for sampling and initialization"
+    )
     try:
         parsed_args = vars(parser.parse_args())
     except (IOError) as msg:
         parser.error(str(msg))
+    if parsed_args["sampling"] == "random" and (
+        parsed_args["length_bucketing"] or parsed_args["class_balanced"]
+    ):
+        parser.error("--length_bucketing and --class_balanced need --sampling epoch")
     main(parsed_args)
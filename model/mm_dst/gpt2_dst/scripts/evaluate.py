@@ -15,10 +15,36 @@ root directory of this source tree.
 """
 import argparse
 import json
-from gpt2_dst.utils.convert import parse_flattened_results_from_file
+import multiprocessing
+from gpt2_dst.utils.convert import (
+    iter_flattened_results_from_file,
+    parse_flattened_results_from_file,
+)
 from utils.evaluate_dst import evaluate_from_flat_list
 
 
+def evaluate_files(input_path_target, input_path_predicted, streaming, num_workers):
+    """Returns the DST evaluation report of a prediction file."""
+    # Convert the data from the GPT-2 friendly format to JSON
+    if num_workers > 1:
+        with multiprocessing.Pool(num_workers) as pool:
+            return evaluate_from_flat_list(
+                iter_flattened_results_from_file(input_path_target, pool=pool),
+                iter_flattened_results_from_file(input_path_predicted, pool=pool),
+            )
+    elif streaming:
+        return evaluate_from_flat_list(
+            iter_flattened_results_from_file(input_path_target),
+            iter_flattened_results_from_file(input_path_predicted),
+        )
+    else:
+        list_target = parse_flattened_results_from_file(input_path_target)
+        list_predicted = parse_flattened_results_from_file(input_path_predicted)
+
+        # Evaluate
+        return evaluate_from_flat_list(list_target, list_predicted)
+
+
 if __name__ == "__main__":
     # Parse input args
     parser = argparse.ArgumentParser()
@@ -29,21 +55,48 @@ if __name__ == "__main__":
         "--input_path_predicted",
         help="path for model prediction output, line-separated format (.txt)",
     )
+    parser.add_argument(
+        "--input_path_reference",
+        default=None,
+        help="path for reference predictions to compare with, e.g. of the fp32 "
+        "model when evaluating a quantized one (.txt)",
+    )
     parser.add_argument(
         "--output_path_report", help="path for saving evaluation summary (.json)"
     )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        default=False,
+        help="parse both files lazily instead of loading them as lists",
+    )
+    parser.add_argument(
+        "--num_workers",
+        help="# of processes used to parse the files (implies --streaming)",
+        type=int,
+        default=1,
+    )
 
     args = parser.parse_args()
     input_path_target = args.input_path_target
     input_path_predicted = args.input_path_predicted
     output_path_report = args.output_path_report
 
-    # Convert the data from the GPT-2 friendly format to JSON
-    list_target = parse_flattened_results_from_file(input_path_target)
-    list_predicted = parse_flattened_results_from_file(input_path_predicted)
-
-    # Evaluate
-    report = evaluate_from_flat_list(list_target, list_predicted)
+    report = evaluate_files(
+        input_path_target, input_path_predicted, args.streaming, args.num_workers
+    )
+    if args.input_path_reference:
+        reference = evaluate_files(
+            input_path_target,
+            args.input_path_reference,
+            args.streaming,
+            args.num_workers,
+        )
+        # Difference of each metric to the reference (predicted - reference)
+        report["reference"] = reference
+        report["delta"] = {key: report[key] - reference[key] for key in reference}
+        for key, delta in report["delta"].items():
+            print(f"{key}: {report[key]:.4f} ({delta:+.4f})")
 
     # Save report
     with open(output_path_report, "w") as f_out:
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+This source code is licensed under the license found in the LICENSE file in the
+root directory of this source tree.
+
+    Exports a GPT-2 DST model (trained with run_language_modeling.py) to a
+    TorchScript or ONNX graph that gpt2_dst.utils.exported_model.ExportedGPT2 runs
+    without transformers, and checks its parity with the eager model.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+import argparse
+import inspect
+import json
+import os
+
+import torch
+from transformers import GPT2LMHeadModel, GPT2Tokenizer
+
+from gpt2_dst.utils.decoding import decode_batch
+from gpt2_dst.utils.exported_model import (
+    EXPORT_CONFIG_NAME,
+    INPUT_NAMES,
+    OUTPUT_NAMES,
+    ExportedGPT2,
+)
+
+
+GRAPH_FILES = {"torchscript": "model.pt", "onnx": "model.onnx"}
+# Prompts for the parity check, if no --prompts_from_file is given.
+DEFAULT_PROMPTS = [
+    "User : Do you have any shirts with good reviews? => Belief State :",
+    "User : What size is the grey jacket? => Belief State :",
+]
+
+
+class GPT2ExportWrapper(torch.nn.Module):
+    """GPT2LMHeadModel with the keys and values of all layers in one tensor."""
+
+    def __init__(self, model):
+        super(GPT2ExportWrapper, self).__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, position_ids, past):
+        past_key_values = tuple((past[ii, 0], past[ii, 1]) for ii in range(past.size(0)))
+        logits, presents = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=False,
+        )
+        return logits, torch.stack([torch.stack(layer) for layer in presents])
+
+
+def export_graph(wrapper, example_inputs, graph_path, export_format):
+    if export_format == "torchscript":
+        with torch.no_grad():
+            traced = torch.jit.trace(wrapper, example_inputs, check_trace=False)
+        torch.jit.save(traced, graph_path)
+        return
+
+    dynamic_axes = {
+        "input_ids": {0: "batch_size", 1: "length"},
+        "attention_mask": {0: "batch_size", 1: "total_length"},
+        "position_ids": {0: "batch_size", 1: "length"},
+        "past": {2: "batch_size", 4: "past_length"},
+        "logits": {0: "batch_size", 1: "length"},
+        "present": {2: "batch_size", 4: "total_length"},
+    }
+    kwargs = {}
+    # Newer versions of torch default to the dynamo based exporter.
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        kwargs["dynamo"] = False
+    torch.onnx.export(
+        wrapper,
+        example_inputs,
+        graph_path,
+        input_names=INPUT_NAMES,
+        output_names=OUTPUT_NAMES,
+        dynamic_axes=dynamic_axes,
+        opset_version=14,
+        **kwargs,
+    )
+
+
+def check_parity(model, exported, prompts, max_new_tokens, stop_token_ids):
+    """
+    Returns the max absolute difference of the logits of the (left-padded)
+    prompts, and the number of prompts with the same greedy generations.
+    """
+    max_length = max(len(ii) for ii in prompts)
+    pad_token_id = exported.config["pad_token_id"]
+    input_ids = torch.tensor(
+        [[pad_token_id] * (max_length - len(ii)) + ii for ii in prompts]
+    )
+    attention_mask = torch.tensor(
+        [[0] * (max_length - len(ii)) + [1] * len(ii) for ii in prompts]
+    )
+    position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+
+    with torch.no_grad():
+        logits = model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+        )[0]
+        generated = decode_batch(
+            model,
+            input_ids,
+            attention_mask,
+            max_new_tokens,
+            stop_token_ids=stop_token_ids,
+            do_sample=False,
+        )
+    exported_logits, _ = exported.forward(
+        input_ids, attention_mask, position_ids, exported.empty_past(len(prompts))
+    )
+    exported_generated = exported.generate(prompts, max_new_tokens, stop_token_ids)
+
+    # Padded positions are not compared.
+    mask = attention_mask.bool()
+    max_diff = (logits[mask] - exported_logits[mask]).abs().max().item()
+    num_matches = sum(ii == jj for ii, jj in zip(generated, exported_generated))
+    return max_diff, num_matches
+
+
+def main(args):
+    tokenizer = GPT2Tokenizer.from_pretrained(args["model_name_or_path"])
+    model = GPT2LMHeadModel.from_pretrained(args["model_name_or_path"])
+    model.eval()
+    wrapper = GPT2ExportWrapper(model).eval()
+    config = model.config
+
+    # Trace with a non-empty past, so that both past and new tokens are used.
+    num_heads = config.n_head
+    head_size = config.n_embd // num_heads
+    past = torch.zeros((config.n_layer, 2, 2, num_heads, 1, head_size))
+    example_inputs = (
+        torch.tensor([[tokenizer.eos_token_id] * 3] * 2),
+        torch.ones((2, 4), dtype=torch.long),
+        torch.tensor([[1, 2, 3]] * 2),
+        past,
+    )
+
+    os.makedirs(args["output_dir"], exist_ok=True)
+    graph_file = GRAPH_FILES[args["format"]]
+    print(f"""Exporting: {os.path.join(args["output_dir"], graph_file)}""")
+    export_graph(
+        wrapper,
+        example_inputs,
+        os.path.join(args["output_dir"], graph_file),
+        args["format"],
+    )
+    export_config = {
+        "format": args["format"],
+        "graph_file": graph_file,
+        "num_layers": config.n_layer,
+        "num_heads": num_heads,
+        "head_size": head_size,
+        "pad_token_id": tokenizer.eos_token_id,
+    }
+    with open(os.path.join(args["output_dir"], EXPORT_CONFIG_NAME), "w") as file_id:
+        json.dump(export_config, file_id)
+    # Tokenizer files, to encode the prompts of the exported model.
+    tokenizer.save_pretrained(args["output_dir"])
+
+    # Parity check against the eager model.
+    prompts = DEFAULT_PROMPTS
+    if args["prompts_from_file"]:
+        with open(args["prompts_from_file"], "r") as file_id:
+            prompts = [ii.strip() for ii in file_id.readlines()]
+    prompts = [tokenizer.encode(ii) for ii in prompts[: args["num_parity_prompts"]]]
+    stop_token_ids = [tokenizer.convert_tokens_to_ids(ii) for ii in ("<EOB>", "<EOS>")]
+    stop_token_ids = [ii for ii in stop_token_ids if ii != tokenizer.unk_token_id]
+    exported = ExportedGPT2(args["output_dir"])
+    max_diff, num_matches = check_parity(
+        model, exported, prompts, args["parity_length"], stop_token_ids
+    )
+    print(
+        f"Parity: max |logits diff| = {max_diff:.2e}, "
+        f"{num_matches} / {len(prompts)} identical greedy generations"
+    )
+    if max_diff > args["parity_tolerance"]:
+        raise ValueError(
+            f"""Exported logits differ by more than {args["parity_tolerance"]}."""
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--model_name_or_path", required=True, help="Path to the trained model"
+    )
+    parser.add_argument(
+        "--output_dir", required=True, help="Path to save the exported model"
+    )
+    parser.add_argument(
+        "--format",
+        default="torchscript",
+        choices=list(GRAPH_FILES),
+        help="Format of the exported graph",
+    )
+    parser.add_argument(
+        "--prompts_from_file",
+        default=None,
+        help="Prompts (e.g. the devtest predict file) for the parity check",
+    )
+    parser.add_argument(
+        "--num_parity_prompts",
+        type=int,
+        default=8,
+        help="Number of prompts for the parity check",
+    )
+    parser.add_argument(
+        "--parity_length",
+        type=int,
+        default=20,
+        help="Number of tokens generated for the parity check",
+    )
+    parser.add_argument(
+        "--parity_tolerance",
+        type=float,
+        default=1e-4,
+        help="Max absolute difference of the logits of the exported model",
+    )
+
+    try:
+        parsed_args = vars(parser.parse_args())
+    except (IOError) as msg:
+        parser.error(str(msg))
+    main(parsed_args)
@@ -14,15 +14,11 @@ import json
 NUM_OPTIONS = 100
 
 
-def main(args):
-    print(f"""Reading dialogs: {args["dialog_json_file"]}""")
-    with open(args["dialog_json_file"], "r") as file_id:
-        dialogs = json.load(file_id)
-
-    print(f"""Reading outputs: {args["model_output_file"]}""")
-    with open(args["model_output_file"], "r") as file_id:
-        scores = [float(ii) for ii in file_id.readlines()]
-
+def format_retrieval_scores(dialogs, scores):
+    """
+    Formats the NLL scores of the NUM_OPTIONS candidates of each turn (in the
+    order of the dialogs) into the challenge format.
+    """
     # Number of scores should match number of instances.
     num_turns = sum(len(ii["dialogue"]) for ii in dialogs["dialogue_data"])
     assert len(scores) == NUM_OPTIONS * num_turns, "#turns do not match!"
@@ -44,6 +40,19 @@ def main(args):
             num_turns += 1
             new_entry["candidate_scores"].append(new_turn_entry)
         formatted_result.append(new_entry)
+    return formatted_result
+
+
+def main(args):
+    print(f"""Reading dialogs: {args["dialog_json_file"]}""")
+    with open(args["dialog_json_file"], "r") as file_id:
+        dialogs = json.load(file_id)
+
+    print(f"""Reading outputs: {args["model_output_file"]}""")
+    with open(args["model_output_file"], "r") as file_id:
+        scores = [float(ii) for ii in file_id.readlines()]
+
+    formatted_result = format_retrieval_scores(dialogs, scores)
 
     # Write the result back.
     print(f"""Saving: {args["formatted_output_file"]}""")
@@ -60,6 +60,25 @@ if __name__ == "__main__":
         help="determine whether to output a formatted output for Target",                
     )
 
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        default=False,
+        help="parse the input JSON incrementally to keep the memory flat",
+    )
+    parser.add_argument(
+        "--num_workers",
+        help="# of processes used to format the dialogs",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--cache_path",
+        help="path to a folder caching the outputs, reused while the inputs "
+        "and options are unchanged. blank if not caching",
+        default="",
+    )
+
     # Options for retrieval evaluation.
     parser.add_argument(
         "--input_path_retrieval", help="input path to the retrieval candidates",
@@ -67,6 +86,13 @@ if __name__ == "__main__":
     parser.add_argument(
         "--output_path_retrieval", help="output path to retrieval candidates",
     )
+    parser.add_argument(
+        "--retrieval_index",
+        action="store_true",
+        default=False,
+        help="output the candidate indices of each turn rather than a "
+        "flattened line per candidate",
+    )
 
     args = parser.parse_args()
     input_path_json = args.input_path_json
@@ -84,7 +110,7 @@ if __name__ == "__main__":
     print("Belief states: {}".format(args.use_belief_states))
 
     # Convert the data into GPT-2 friendly format
-    convert_json_to_flattened(
+    cache_hit = convert_json_to_flattened(
         input_path_json,
         output_path_predict,
         output_path_target,
@@ -96,4 +122,10 @@ if __name__ == "__main__":
         output_target=args.output_target,
         input_path_retrieval=input_path_retrieval,
         output_path_retrieval=output_path_retrieval,
+        streaming=args.streaming,
+        num_workers=args.num_workers,
+        cache_path=args.cache_path,
+        retrieval_index=args.retrieval_index,
     )
+    if cache_hit is not None:
+        print("Cache: {}".format("hit" if cache_hit else "miss"))
@@ -40,6 +40,25 @@ from transformers import (
     XLNetLMHeadModel,
     XLNetTokenizer,
 )
+from transformers.generation import (
+    LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+from gpt2_dst.utils.decoding import BeliefStateGrammar, decode_batch
+from gpt2_dst.utils.prefix_cache import PrefixCache, expand_past, forward_with_prefix
+from gpt2_dst.utils.quantization import quantize_model
+from gpt2_dst.utils.sharding import (
+    ShardWriter,
+    config_key,
+    merge_shards,
+    remove_shards,
+    shard_path,
+    shard_range,
+)
 
 
 logging.basicConfig(
@@ -50,6 +69,27 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 MAX_LENGTH = int(10000)  # Hardcoded max length to avoid infinite loop
+# Arguments that change the generated belief states, see config_key().
+RESULT_ARGS = (
+    "model_type",
+    "model_name_or_path",
+    "prompts_from_file",
+    "length",
+    "stop_token",
+    "early_stop_token",
+    "constrain_belief_state",
+    "decoding",
+    "num_beams",
+    "temperature",
+    "repetition_penalty",
+    "k",
+    "p",
+    "padding_text",
+    "xlm_language",
+    "seed",
+    "quantize",
+    "num_return_sequences",
+)
 
 MODEL_CLASSES = {
     "gpt2": (GPT2LMHeadModel, GPT2Tokenizer),
@@ -163,6 +203,210 @@ def adjust_length_to_model(length, max_sequence_length):
     return length
 
 
+def encode_prompt(args, model, tokenizer, prompt_text):
+    """Returns the token ids of a prompt, after any model-specific preprocessing."""
+    # Different models need different input formatting and/or extra arguments
+    requires_preprocessing = args.model_type in PREPROCESSING_FUNCTIONS.keys()
+    if requires_preprocessing:
+        prepare_input = PREPROCESSING_FUNCTIONS.get(args.model_type)
+        preprocessed_prompt_text = prepare_input(args, model, tokenizer, prompt_text)
+        return tokenizer.encode(
+            preprocessed_prompt_text,
+            add_special_tokens=True,
+            add_space_before_punct_symbol=True,
+        )
+    return tokenizer.encode(prompt_text, add_special_tokens=True)
+
+
+def generate_batch(
+    args, model, encoded_prompts, prompt_texts=None, past_key_values=None
+):
+    """
+    Generates sequences for a batch of encoded prompts, which are left-padded
+    to the same length and masked out of the attention.
+    For a single prompt, past_key_values may hold the cached keys and values
+    of all its tokens but the last one.
+
+    Returns, for each prompt, the list of num_return_sequences generated
+    sequences (token ids, including the prompt and without any padding).
+    """
+    eos_token_id = model.config.eos_token_id
+    pad_token_id = model.config.pad_token_id
+    if pad_token_id is None:
+        pad_token_id = eos_token_id if eos_token_id is not None else 0
+
+    max_prompt_length = max(len(ii) for ii in encoded_prompts)
+    input_ids = torch.full(
+        (len(encoded_prompts), max_prompt_length), pad_token_id, dtype=torch.long
+    )
+    attention_mask = torch.zeros_like(input_ids)
+    for index, encoded_prompt in enumerate(encoded_prompts):
+        num_pads = max_prompt_length - len(encoded_prompt)
+        input_ids[index, num_pads:] = torch.tensor(encoded_prompt, dtype=torch.long)
+        attention_mask[index, num_pads:] = 1
+
+    if args.decoding != "beam" and (
+        args.early_stop_token_id is not None or args.grammar is not None
+    ):
+        return _generate_batch_with_early_stopping(
+            args,
+            model,
+            encoded_prompts,
+            prompt_texts,
+            input_ids,
+            attention_mask,
+            past_key_values,
+        )
+
+    stop_token_ids = [
+        ii for ii in (eos_token_id, args.early_stop_token_id) if ii is not None
+    ]
+    if args.decoding == "sample":
+        decoding_kwargs = dict(
+            temperature=args.temperature, top_k=args.k, top_p=args.p, do_sample=True
+        )
+    elif args.decoding == "beam":
+        # All the beams of the batch are decoded together.
+        decoding_kwargs = dict(
+            num_beams=args.num_beams, early_stopping=True, do_sample=False
+        )
+        if stop_token_ids:
+            decoding_kwargs["eos_token_id"] = stop_token_ids
+    else:
+        decoding_kwargs = dict(do_sample=False)
+    if past_key_values is not None:
+        # generate() expands the inputs for the beams or the returned
+        # sequences, but not the cached keys and values.
+        if args.decoding == "beam":
+            expand_size = args.num_beams
+        else:
+            expand_size = args.num_return_sequences
+        decoding_kwargs["past_key_values"] = expand_past(past_key_values, expand_size)
+
+    output_sequences = model.generate(
+        input_ids=input_ids.to(args.device),
+        attention_mask=attention_mask.to(args.device),
+        max_length=args.length + max_prompt_length,
+        repetition_penalty=args.repetition_penalty,
+        num_return_sequences=args.num_return_sequences,
+        pad_token_id=pad_token_id,
+        **decoding_kwargs,
+    )
+    output_sequences = output_sequences.view(
+        len(encoded_prompts), args.num_return_sequences, -1
+    ).tolist()
+
+    generated_sequences = []
+    for encoded_prompt, sequences in zip(encoded_prompts, output_sequences):
+        num_pads = max_prompt_length - len(encoded_prompt)
+        prompt_sequences = []
+        for sequence in sequences:
+            sequence = sequence[num_pads:]
+            # Drop the padding after the end of the sequence, if it ended early.
+            generated = sequence[len(encoded_prompt) :]
+            for index, token_id in enumerate(generated):
+                if token_id in stop_token_ids:
+                    sequence = sequence[: len(encoded_prompt) + index + 1]
+                    break
+            prompt_sequences.append(sequence)
+        generated_sequences.append(prompt_sequences)
+    return generated_sequences
+
+
+def _generate_batch_with_early_stopping(
+    args,
+    model,
+    encoded_prompts,
+    prompt_texts,
+    input_ids,
+    attention_mask,
+    past_key_values=None,
+):
+    """
+    Generates with decode_batch(), which stops each sequence at the early stop
+    token (or eos) and optionally constrains the belief states to the grammar.
+    """
+    logits_processor = LogitsProcessorList()
+    if args.repetition_penalty != 1.0:
+        logits_processor.append(
+            RepetitionPenaltyLogitsProcessor(penalty=args.repetition_penalty)
+        )
+    logits_warper = LogitsProcessorList()
+    if args.temperature != 1.0:
+        logits_warper.append(TemperatureLogitsWarper(args.temperature))
+    if args.k > 0:
+        logits_warper.append(TopKLogitsWarper(top_k=args.k))
+    if args.p < 1.0:
+        logits_warper.append(TopPLogitsWarper(top_p=args.p))
+
+    num_return_sequences = args.num_return_sequences
+    grammar_states = None
+    if args.grammar is not None:
+        grammar_states = [
+            args.grammar.initial_state(prompt_text)
+            for prompt_text in prompt_texts
+            for _ in range(num_return_sequences)
+        ]
+
+    generated = decode_batch(
+        model,
+        input_ids.repeat_interleave(num_return_sequences, dim=0).to(args.device),
+        attention_mask.repeat_interleave(num_return_sequences, dim=0).to(args.device),
+        max_new_tokens=args.length,
+        stop_token_ids=(model.config.eos_token_id, args.early_stop_token_id),
+        logits_processor=logits_processor,
+        logits_warper=logits_warper,
+        do_sample=args.decoding == "sample",
+        grammar=args.grammar,
+        grammar_states=grammar_states,
+        past_key_values=(
+            None
+            if past_key_values is None
+            else expand_past(past_key_values, num_return_sequences)
+        ),
+    )
+
+    generated_sequences = []
+    for index, encoded_prompt in enumerate(encoded_prompts):
+        start = index * num_return_sequences
+        generated_sequences.append(
+            [
+                list(encoded_prompt) + sequence
+                for sequence in generated[start : start + num_return_sequences]
+            ]
+        )
+    return generated_sequences
+
+
+def encode_prefix(args, model, prefix_cache, encoded_prompt):
+    """
+    Returns the keys and values of all the tokens of a prompt but the last
+    one, only encoding the tokens after its longest cached prefix.
+    """
+    prefix = encoded_prompt[:-1]
+    if not prefix:
+        return None
+    past_length, past_key_values, _ = prefix_cache.lookup(prefix)
+    if past_length < len(prefix):
+        with torch.no_grad():
+            _, past_key_values = forward_with_prefix(
+                model, prefix, past_length, past_key_values, args.device
+            )
+        prefix_cache.insert(prefix, past_key_values)
+    return past_key_values
+
+
+def save_results(path_output, str_results):
+    # Create a directory if it does not exist
+    directory = os.path.dirname(path_output)
+    if not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+
+    # Save to a file
+    with open(path_output, "w") as f_out:
+        f_out.write("\n".join(str_results))
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -198,6 +442,28 @@ command line""",
         help="Token at which text generation is stopped",
     )
 
+    parser.add_argument(
+        "--early_stop_token",
+        type=str,
+        default=None,
+        help="Token (e.g. <EOB>) at which each sequence stops being generated",
+    )
+    parser.add_argument(
+        "--constrain_belief_state",
+        action="store_true",
+        help="Constrain the generated belief states to the flattened format",
+    )
+
+    parser.add_argument(
+        "--decoding",
+        type=str,
+        default="greedy",
+        choices=["greedy", "beam", "sample"],
+        help="Decoding strategy; only sample uses temperature, k and p",
+    )
+    parser.add_argument(
+        "--num_beams", type=int, default=4, help="# of beams for beam decoding"
+    )
     parser.add_argument(
         "--temperature",
         type=float,
@@ -232,20 +498,59 @@ command line""",
     parser.add_argument(
         "--no_cuda", action="store_true", help="Avoid using CUDA when available"
     )
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="Run the model on CPU with int8 dynamically quantized linear layers",
+    )
     parser.add_argument(
         "--num_return_sequences",
         type=int,
         default=1,
         help="The number of samples to generate.",
     )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=1,
+        help="# of prompts generated together (left-padded, sorted by length).",
+    )
+    parser.add_argument(
+        "--prefix_cache_mb",
+        type=float,
+        default=0,
+        help="Memory (MB) for the keys and values of prompt prefixes shared "
+        "across prompts, e.g. the dialog history (0 to disable)",
+    )
     parser.add_argument(
         "--path_output",
         type=str,
         default=None,
         help="Path to output predictions in a line separated text file.",
     )
+    parser.add_argument(
+        "--shard_id", type=int, default=0, help="Shard of the prompts to generate"
+    )
+    parser.add_argument(
+        "--num_shards", type=int, default=1, help="# of shards of the prompts"
+    )
+    parser.add_argument(
+        "--merge_shards",
+        action="store_true",
+        help="Merge the outputs of all the shards into --path_output",
+    )
     args = parser.parse_args()
 
+    if args.merge_shards:
+        with open(args.prompts_from_file) as handle:
+            n_prompts = len(handle.readlines())
+        str_results = merge_shards(args.path_output, args.num_shards, n_prompts)
+        save_results(args.path_output, str_results)
+        remove_shards(args.path_output, args.num_shards)
+        return str_results
+
+    # Quantized models only run on CPU.
+    args.no_cuda = args.no_cuda or args.quantize
     args.device = torch.device(
         "cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu"
     )
@@ -265,9 +570,46 @@ command line""",
             "the model {} you specified is not supported. You are welcome to add it and open a PR :)"
         )
 
+    if args.batch_size > 1 and args.model_type != "gpt2":
+        raise ValueError("--batch_size > 1 is only supported for gpt2.")
+    if args.decoding == "greedy" and args.num_return_sequences > 1:
+        raise ValueError("--num_return_sequences > 1 requires beam or sample decoding.")
+    if args.decoding == "beam" and args.num_return_sequences > args.num_beams:
+        raise ValueError("--num_return_sequences should be at most --num_beams.")
+    if args.decoding == "beam" and args.constrain_belief_state:
+        raise ValueError("--constrain_belief_state is not supported with beam decoding.")
+    if args.prefix_cache_mb > 0 and args.batch_size > 1:
+        raise ValueError("--prefix_cache_mb requires --batch_size=1.")
+    if (
+        args.early_stop_token or args.constrain_belief_state or args.prefix_cache_mb > 0
+    ) and args.model_type != "gpt2":
+        raise ValueError(
+            "--early_stop_token, --constrain_belief_state and --prefix_cache_mb "
+            "are only supported for gpt2."
+        )
+
     tokenizer = tokenizer_class.from_pretrained(args.model_name_or_path)
     model = model_class.from_pretrained(args.model_name_or_path)
     model.to(args.device)
+    if args.quantize:
+        model = quantize_model(model)
+
+    args.early_stop_token_id = None
+    if args.early_stop_token is not None:
+        args.early_stop_token_id = tokenizer.convert_tokens_to_ids(
+            args.early_stop_token
+        )
+        if args.early_stop_token_id == tokenizer.unk_token_id:
+            raise ValueError(
+                f"--early_stop_token {args.early_stop_token} is not a single token."
+            )
+    args.grammar = None
+    if args.constrain_belief_state:
+        args.grammar = BeliefStateGrammar(tokenizer, model.config.vocab_size)
+
+    prefix_cache = None
+    if args.prefix_cache_mb > 0:
+        prefix_cache = PrefixCache(int(args.prefix_cache_mb * 2**20))
 
     args.length = adjust_length_to_model(
         args.length, max_sequence_length=model.config.max_position_embeddings
@@ -276,6 +618,7 @@ command line""",
 
     results = []
     prompts = []
+    writer = None
     if args.prompts_from_file:
         with open(args.prompts_from_file) as handle:
             prompts = handle.readlines()
@@ -291,104 +634,122 @@ command line""",
                 break  # break while True loop
 
         n_prompts = len(prompts)
-        for i, prompt_text in enumerate(prompts):
-            # Strip any trailing \n if provided
-            prompt_text = prompt_text.strip("\n")
-
-            # Different models need different input formatting and/or extra arguments
-            requires_preprocessing = args.model_type in PREPROCESSING_FUNCTIONS.keys()
-            if requires_preprocessing:
-                prepare_input = PREPROCESSING_FUNCTIONS.get(args.model_type)
-                preprocessed_prompt_text = prepare_input(
-                    args, model, tokenizer, prompt_text
-                )
-                encoded_prompt = tokenizer.encode(
-                    preprocessed_prompt_text,
-                    add_special_tokens=True,
-                    return_tensors="pt",
-                    add_space_before_punct_symbol=True,
-                )
-            else:
-                encoded_prompt = tokenizer.encode(
-                    prompt_text, add_special_tokens=True, return_tensors="pt"
+        # Strip any trailing \n if provided
+        prompts = [prompt_text.strip("\n") for prompt_text in prompts]
+
+        # Results of a file are written to its shard as they are generated,
+        # skipping the prompts done by a previous run.
+        order = list(range(n_prompts))
+        if args.prompts_from_file and args.path_output is not None:
+            start, end = shard_range(n_prompts, args.shard_id, args.num_shards)
+            writer = ShardWriter(
+                shard_path(args.path_output, args.shard_id, args.num_shards),
+                n_prompts,
+                config_key(args, RESULT_ARGS),
+            )
+            order = [ii for ii in range(start, end) if ii not in writer.done]
+            logger.info(
+                f"Shard {args.shard_id} / {args.num_shards}: "
+                f"{len(order)} / {end - start} prompts left"
+            )
+        encoded_prompts = {
+            ii: encode_prompt(args, model, tokenizer, prompts[ii]) for ii in order
+        }
+
+        # Batch prompts of similar lengths together to reduce the padding,
+        # and put the results back in the original order.
+        if args.batch_size > 1:
+            order.sort(key=lambda ii: len(encoded_prompts[ii]))
+        prompt_results = [None] * n_prompts
+        for start in range(0, len(order), args.batch_size):
+            batch_indices = order[start : start + args.batch_size]
+            past_key_values = None
+            if prefix_cache is not None:
+                past_key_values = encode_prefix(
+                    args, model, prefix_cache, encoded_prompts[batch_indices[0]]
                 )
-            encoded_prompt = encoded_prompt.to(args.device)
-
-            output_sequences = model.generate(
-                input_ids=encoded_prompt,
-                max_length=args.length + len(encoded_prompt[0]),
-                temperature=args.temperature,
-                top_k=args.k,
-                top_p=args.p,
-                repetition_penalty=args.repetition_penalty,
-                do_sample=True,
-                num_return_sequences=args.num_return_sequences,
+            output_sequences = generate_batch(
+                args,
+                model,
+                [encoded_prompts[ii] for ii in batch_indices],
+                [prompts[ii] for ii in batch_indices],
+                past_key_values,
             )
 
-            # Remove the batch dimension when returning multiple sequences
-            if len(output_sequences.shape) > 2:
-                output_sequences.squeeze_()
+            for i, sequences in zip(batch_indices, output_sequences):
+                prompt_text = prompts[i]
+                encoded_prompt = encoded_prompts[i]
+                generated_sequences = []
+
+                for generated_sequence_idx, generated_sequence in enumerate(
+                    sequences
+                ):
+                    print(
+                        "=== GENERATED SEQUENCE {sequence_idx}, {promt_idx}/{n_prompts} ===".format(
+                            sequence_idx=generated_sequence_idx + 1,
+                            promt_idx=i + 1,
+                            n_prompts=n_prompts,
+                        )
+                    )
 
-            generated_sequences = []
+                    # Decode text
+                    text = tokenizer.decode(
+                        generated_sequence, clean_up_tokenization_spaces=True
+                    )
 
-            for generated_sequence_idx, generated_sequence in enumerate(
-                output_sequences
-            ):
-                print(
-                    "=== GENERATED SEQUENCE {sequence_idx}, {promt_idx}/{n_prompts} ===".format(
-                        sequence_idx=generated_sequence_idx + 1,
-                        promt_idx=i + 1,
-                        n_prompts=n_prompts,
+                    # Remove all text after the stop token
+                    if args.stop_token and args.stop_token in text:
+                        text = text[: text.find(args.stop_token)]
+
+                    # Add the prompt at the beginning of the sequence. Remove the
+                    # excess text that was used for pre-processing
+                    total_sequence = (
+                        prompt_text
+                        + text[
+                            len(
+                                tokenizer.decode(
+                                    encoded_prompt, clean_up_tokenization_spaces=True
+                                )
+                            ) :
+                        ]
                     )
-                )
-                generated_sequence = generated_sequence.tolist()
 
-                # Decode text
-                text = tokenizer.decode(
-                    generated_sequence, clean_up_tokenization_spaces=True
-                )
+                    generated_sequences.append(total_sequence)
+                    print(total_sequence)
 
-                # Remove all text after the stop token
-                text = text[: text.find(args.stop_token) if args.stop_token else None]
-
-                # Add the prompt at the beginning of the sequence. Remove the
-                # excess text that was used for pre-processing
-                total_sequence = (
-                    prompt_text
-                    + text[
-                        len(
-                            tokenizer.decode(
-                                encoded_prompt[0], clean_up_tokenization_spaces=True
-                            )
-                        ) :
-                    ]
-                )
+                prompt_results[i] = generated_sequences
+                if writer is not None:
+                    writer.write(i, " || ".join(generated_sequences))
 
-                generated_sequences.append(total_sequence)
-                print(total_sequence)
+            if writer is not None:
+                writer.maybe_checkpoint()
 
-            results.append(generated_sequences)
+        results.extend(prompt_results)
+        if prefix_cache is not None:
+            logger.info(prefix_cache.stats())
 
         prompts = []
         if args.prompt or args.prompts_from_file:
             break  # break while True loop
 
-    if args.path_output is not None:
-
-        # Create a directory if it does not exist
-        directory = os.path.dirname(args.path_output)
-        if not os.path.exists(directory):
-            os.makedirs(directory, exist_ok=True)
+    if writer is not None:
+        writer.close()
+        if args.num_shards > 1:
+            logger.info(
+                "Run with --merge_shards once all the shards are done to save "
+                f"{args.path_output}"
+            )
+            return results
+        save_results(args.path_output, merge_shards(args.path_output, 1, n_prompts))
+        remove_shards(args.path_output, 1)
 
+    elif args.path_output is not None:
         # Format results into a line-separated string file
-        str_results = "\n".join(
-            [" || ".join(generated_sequences) for generated_sequences in results]
+        save_results(
+            args.path_output,
+            [" || ".join(generated_sequences) for generated_sequences in results],
         )
 
-        # Save to a file
-        with open(args.path_output, "w") as f_out:
-            f_out.write(str_results)
-
     return results
 
 
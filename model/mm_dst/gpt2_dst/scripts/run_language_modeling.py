@@ -27,6 +27,7 @@ https://github.com/huggingface/transformers/blob/master/examples/language-modeli
 
 import argparse
 import glob
+import hashlib
 import json
 import logging
 import os
@@ -38,7 +39,13 @@ from typing import Dict, List, Tuple
 import numpy as np
 import torch
 from torch.nn.utils.rnn import pad_sequence
-from torch.utils.data import DataLoader, Dataset, RandomSampler, SequentialSampler
+from torch.utils.data import (
+    DataLoader,
+    Dataset,
+    RandomSampler,
+    Sampler,
+    SequentialSampler,
+)
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm, trange
 
@@ -100,27 +107,118 @@ class TextDataset(Dataset):
         return torch.tensor(self.examples[item], dtype=torch.long)
 
 
+class TokenizedExamples:
+    """
+    Read-only list of integer sequences (e.g. token ids), stored as a flat
+    (memory-mapped) array plus an offsets index into it.
+    """
+
+    def __init__(self, ids: np.ndarray, offsets: np.ndarray):
+        self.ids = ids
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        return self.ids[self.offsets[i] : self.offsets[i + 1]]
+
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+
 class LineByLineTextDataset(Dataset):
+    # Number of lines tokenized at once when building the cache.
+    tokenize_chunk_size = 10000
+
     def __init__(
         self, tokenizer: PreTrainedTokenizer, args, file_path: str, block_size=512
     ):
         print(file_path)
         assert os.path.isfile(file_path)
-        # Here, we do not cache the features, operating under the assumption
-        # that we will soon use fast multithreaded tokenizers from the
-        # `tokenizers` repo everywhere =)
-        logger.info("Creating features from dataset file at %s", file_path)
 
-        with open(file_path, encoding="utf-8") as f:
-            lines = [
-                line
-                for line in f.read().splitlines()
-                if (len(line) > 0 and not line.isspace())
+        # The token ids are cached next to the data file, keyed by the data
+        # file, the tokenizer vocab & special tokens and block_size. Every
+        # later run (and every DDP rank) memory-maps the same cache.
+        directory, filename = os.path.split(file_path)
+        cache_key = self._cache_key(tokenizer, file_path, block_size)
+        cached_prefix = os.path.join(
+            directory,
+            "{}_cached_lbl_{}_{}_{}".format(
+                args.model_type, block_size, filename, cache_key
+            ),
+        )
+        cached_ids_file = cached_prefix + ".ids.bin"
+        cached_offsets_file = cached_prefix + ".offsets.npy"
+
+        if not (
+            os.path.exists(cached_ids_file)
+            and os.path.exists(cached_offsets_file)
+            and not args.overwrite_cache
+        ):
+            logger.info("Creating features from dataset file at %s", file_path)
+            self._build_cache(
+                tokenizer, file_path, block_size, cached_ids_file, cached_offsets_file
+            )
+
+        logger.info("Loading features from cached file %s", cached_ids_file)
+        offsets = np.load(cached_offsets_file)
+        if offsets[-1] > 0:
+            ids = np.memmap(cached_ids_file, dtype=np.int32, mode="r")
+        else:
+            ids = np.zeros(0, dtype=np.int32)
+        self.examples = TokenizedExamples(ids, offsets)
+
+    @staticmethod
+    def _cache_key(tokenizer: PreTrainedTokenizer, file_path: str, block_size: int):
+        stat = os.stat(file_path)
+        key = json.dumps(
+            [
+                type(tokenizer).__name__,
+                sorted(tokenizer.get_vocab().items()),
+                tokenizer.all_special_tokens,
+                block_size,
+                stat.st_size,
+                stat.st_mtime_ns,
             ]
+        )
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
 
-        self.examples = tokenizer.batch_encode_plus(
-            lines, add_special_tokens=True, max_length=block_size
-        )["input_ids"]
+    def _build_cache(
+        self, tokenizer, file_path, block_size, cached_ids_file, cached_offsets_file
+    ):
+        def iter_line_chunks():
+            lines = []
+            with open(file_path, encoding="utf-8") as f:
+                for raw_line in f:
+                    for line in raw_line.splitlines():
+                        if len(line) > 0 and not line.isspace():
+                            lines.append(line)
+                    if len(lines) >= self.tokenize_chunk_size:
+                        yield lines
+                        lines = []
+            if lines:
+                yield lines
+
+        # Write to temporary files first, so that an interrupted run
+        # never leaves a partial cache behind.
+        lengths = [np.zeros(1, dtype=np.int64)]
+        with open(cached_ids_file + ".tmp", "wb") as f_ids:
+            for lines in iter_line_chunks():
+                examples = tokenizer.batch_encode_plus(
+                    lines, add_special_tokens=True, max_length=block_size
+                )["input_ids"]
+                np.fromiter(
+                    (ii for example in examples for ii in example), dtype=np.int32
+                ).tofile(f_ids)
+                lengths.append(np.array([len(ii) for ii in examples], dtype=np.int64))
+        with open(cached_offsets_file + ".tmp", "wb") as f_offsets:
+            np.save(f_offsets, np.cumsum(np.concatenate(lengths)))
+        os.replace(cached_ids_file + ".tmp", cached_ids_file)
+        os.replace(cached_offsets_file + ".tmp", cached_offsets_file)
+        logger.info("Saving features into cached file %s", cached_ids_file)
 
     def __len__(self):
         return len(self.examples)
@@ -129,9 +227,207 @@ class LineByLineTextDataset(Dataset):
         return torch.tensor(self.examples[i], dtype=torch.long)
 
 
+class PackedLineByLineTextDataset(Dataset):
+    """
+    Packs several lines of a LineByLineTextDataset into each block_size
+    window, so that (almost) no tokens are spent on padding.
+
+    Lines are never split across windows. Position ids restart at 0 at the
+    beginning of each line, and the first token of each line is excluded
+    from the loss, so that the loss is only computed within each line.
+    Earlier lines of the same window remain visible to the attention.
+    """
+
+    # Number of partially filled windows a line may be packed into.
+    num_open_windows = 8
+
+    def __init__(
+        self, tokenizer: PreTrainedTokenizer, args, file_path: str, block_size=512
+    ):
+        self.lines = LineByLineTextDataset(
+            tokenizer, args, file_path=file_path, block_size=block_size
+        )
+        lengths = self.lines.examples.lengths()
+
+        # First-fit packing over the last few open windows, in line order.
+        windows = []
+        open_windows = []
+        for index, length in enumerate(lengths.tolist()):
+            for window in open_windows:
+                if window[0] + length <= block_size:
+                    window[0] += length
+                    window[1].append(index)
+                    break
+            else:
+                window = [length, [index]]
+                windows.append(window[1])
+                open_windows.append(window)
+                if len(open_windows) > self.num_open_windows:
+                    open_windows.pop(0)
+
+        order = np.array([index for window in windows for index in window], dtype=np.int64)
+        window_offsets = np.cumsum([0] + [len(window) for window in windows])
+        self.examples = TokenizedExamples(order, window_offsets)
+
+        num_tokens = int(lengths.sum())
+        self.packing_efficiency = num_tokens / max(1, len(windows) * block_size)
+        logger.info(
+            "Packed %d lines (%d tokens) into %d windows of %d tokens: "
+            "packing efficiency = %.4f",
+            len(lengths),
+            num_tokens,
+            len(windows),
+            block_size,
+            self.packing_efficiency,
+        )
+
+    def __len__(self):
+        return len(self.examples)
+
+    def __getitem__(self, i):
+        lines = [self.lines[index] for index in self.examples[i]]
+        input_ids = torch.cat(lines)
+        position_ids = torch.cat([torch.arange(len(line)) for line in lines])
+        # The first token of a line should not be predicted from the previous line.
+        labels = input_ids.masked_fill(position_ids == 0, -100)
+        return input_ids, position_ids, labels
+
+
+def collate_packed(examples: List[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]):
+    input_ids, position_ids, labels = zip(*examples)
+    return (
+        pad_sequence(input_ids, batch_first=True),
+        pad_sequence(position_ids, batch_first=True),
+        pad_sequence(labels, batch_first=True, padding_value=-100),
+    )
+
+
+def prepare_batch(batch, tokenizer: PreTrainedTokenizer, args):
+    """Returns the inputs, labels and extra model arguments of a batch."""
+    if args.pack_sequences:
+        inputs, position_ids, labels = batch
+        return inputs, labels, {"position_ids": position_ids.to(args.device)}
+    if isinstance(batch, tuple):
+        # Padded inputs and labels, with the padding excluded from the labels.
+        inputs, labels = batch
+        return inputs, labels, {}
+    inputs, labels = mask_tokens(batch, tokenizer, args) if args.mlm else (batch, batch)
+    return inputs, labels, {}
+
+
+class LengthGroupedBatchSampler(Sampler):
+    """
+    Batch sampler that groups examples of similar lengths, to reduce the
+    padding in each batch.
+
+    Each epoch, the examples are shuffled and split into buckets of
+    batch_size * bucket_size_multiplier examples. Each bucket is sorted by
+    length and cut into batches, and the order of all the batches is then
+    shuffled. Without shuffling, examples are batched in length order.
+
+    If max_tokens is given, batches are capped by the number of (padded)
+    tokens instead of the number of examples. Otherwise, drop_last drops
+    the incomplete batch of each bucket.
+
+    In distributed training, every rank draws the same batches (the
+    shuffling is seeded by seed + epoch) and keeps every num_replicas-th.
+    """
+
+    def __init__(
+        self,
+        lengths,
+        batch_size: int,
+        max_tokens: int = 0,
+        shuffle: bool = True,
+        bucket_size_multiplier: int = 100,
+        seed: int = 0,
+        num_replicas: int = 1,
+        rank: int = 0,
+        drop_last: bool = False,
+    ):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.bucket_size = batch_size * bucket_size_multiplier
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.drop_last = drop_last
+        self.epoch = 0
+        self._batches = None
+
+    def _make_batches(self, indices):
+        batches = []
+        batch = []
+        max_len = 0
+        for index in indices:
+            length = int(self.lengths[index])
+            if self.max_tokens > 0:
+                is_full = max(max_len, length) * (len(batch) + 1) > self.max_tokens
+            else:
+                is_full = len(batch) == self.batch_size
+            if batch and is_full:
+                batches.append(batch)
+                batch = []
+                max_len = 0
+            batch.append(int(index))
+            max_len = max(max_len, length)
+        if batch and not (
+            self.drop_last and self.max_tokens <= 0 and len(batch) < self.batch_size
+        ):
+            batches.append(batch)
+        return batches
+
+    def _epoch_batches(self):
+        if self._batches is not None and self._batches[0] == self.epoch:
+            return self._batches[1]
+
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(len(self.lengths), generator=generator).numpy()
+            batches = []
+            for start in range(0, len(indices), self.bucket_size):
+                bucket = indices[start : start + self.bucket_size]
+                bucket = bucket[np.argsort(self.lengths[bucket], kind="stable")]
+                batches.extend(self._make_batches(bucket))
+            order = torch.randperm(len(batches), generator=generator).tolist()
+            batches = [batches[ii] for ii in order]
+        else:
+            indices = np.argsort(self.lengths, kind="stable")
+            batches = self._make_batches(indices)
+
+        if self.num_replicas > 1:
+            # Every rank should run the same number of steps.
+            num_batches = len(batches) - len(batches) % self.num_replicas
+            batches = batches[self.rank : num_batches : self.num_replicas]
+
+        self._batches = (self.epoch, batches)
+        return batches
+
+    def __iter__(self):
+        batches = self._epoch_batches()
+        self.epoch += 1
+        return iter(batches)
+
+    def __len__(self):
+        return len(self._epoch_batches())
+
+
+def example_lengths(dataset) -> np.ndarray:
+    if isinstance(dataset.examples, TokenizedExamples):
+        return dataset.examples.lengths()
+    return np.array([len(example) for example in dataset.examples], dtype=np.int64)
+
+
 def load_and_cache_examples(args, tokenizer, evaluate=False):
     file_path = args.eval_data_file if evaluate else args.train_data_file
-    if args.line_by_line:
+    if args.pack_sequences:
+        dataset = PackedLineByLineTextDataset(
+            tokenizer, args, file_path=file_path, block_size=args.block_size
+        )
+    elif args.line_by_line:
         dataset = LineByLineTextDataset(
             tokenizer, args, file_path=file_path, block_size=args.block_size
         )
@@ -139,16 +435,7 @@ def load_and_cache_examples(args, tokenizer, evaluate=False):
         dataset = TextDataset(
             tokenizer, args, file_path=file_path, block_size=args.block_size
         )
-
-    # Unknown issues have been reported around not being able to handle incomplete batches (e.g. w/ older CUDA 9.2)
-    # Below is a workaround in case you encounter this issue.
-    # Alternatively, --nocuda could avoid this issue too.
-    # Comment out the following if you do not encounuter this issue or if you are not using any GPU.
-    n = len(dataset) % args.per_gpu_train_batch_size
-    if n != 0:
-        print("Truncating from %d examples" % len(dataset.examples))
-        dataset.examples = dataset.examples[:-n]
-        print("Truncating to %d examples" % len(dataset.examples))
+    # Incomplete final batches are kept (see --drop_last for training).
     return dataset
 
 
@@ -263,23 +550,42 @@ def train(
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
 
     def collate(examples: List[torch.Tensor]):
+        if args.pack_sequences:
+            return collate_packed(examples)
         if tokenizer._pad_token is None:
             return pad_sequence(examples, batch_first=True)
         return pad_sequence(
             examples, batch_first=True, padding_value=tokenizer.pad_token_id
         )
 
-    train_sampler = (
-        RandomSampler(train_dataset)
-        if args.local_rank == -1
-        else DistributedSampler(train_dataset)
-    )
-    train_dataloader = DataLoader(
-        train_dataset,
-        sampler=train_sampler,
-        batch_size=args.train_batch_size,
-        collate_fn=collate,
-    )
+    if args.group_by_length:
+        train_batch_sampler = LengthGroupedBatchSampler(
+            example_lengths(train_dataset),
+            args.train_batch_size,
+            max_tokens=args.max_tokens_per_batch,
+            seed=args.seed,
+            num_replicas=(
+                1 if args.local_rank == -1 else torch.distributed.get_world_size()
+            ),
+            rank=0 if args.local_rank == -1 else torch.distributed.get_rank(),
+            drop_last=args.drop_last,
+        )
+        train_dataloader = DataLoader(
+            train_dataset, batch_sampler=train_batch_sampler, collate_fn=collate,
+        )
+    else:
+        train_sampler = (
+            RandomSampler(train_dataset)
+            if args.local_rank == -1
+            else DistributedSampler(train_dataset, drop_last=args.drop_last)
+        )
+        train_dataloader = DataLoader(
+            train_dataset,
+            sampler=train_sampler,
+            batch_size=args.train_batch_size,
+            collate_fn=collate,
+            drop_last=args.drop_last,
+        )
 
     if args.max_steps > 0:
         t_total = args.max_steps
@@ -430,16 +736,14 @@ def train(
                 steps_trained_in_current_epoch -= 1
                 continue
 
-            inputs, labels = (
-                mask_tokens(batch, tokenizer, args) if args.mlm else (batch, batch)
-            )
+            inputs, labels, model_kwargs = prepare_batch(batch, tokenizer, args)
             inputs = inputs.to(args.device)
             labels = labels.to(args.device)
             model.train()
             outputs = (
                 model(inputs, masked_lm_labels=labels)
                 if args.mlm
-                else model(inputs, labels=labels)
+                else model(inputs, labels=labels, **model_kwargs)
             )
             loss = outputs[
                 0
@@ -553,19 +857,38 @@ def evaluate(
     # Note that DistributedSampler samples randomly
 
     def collate(examples: List[torch.Tensor]):
+        if args.pack_sequences:
+            return collate_packed(examples)
         if tokenizer._pad_token is None:
-            return pad_sequence(examples, batch_first=True)
-        return pad_sequence(
-            examples, batch_first=True, padding_value=tokenizer.pad_token_id
+            inputs = pad_sequence(examples, batch_first=True)
+        else:
+            inputs = pad_sequence(
+                examples, batch_first=True, padding_value=tokenizer.pad_token_id
+            )
+        if args.mlm:
+            return inputs
+        # Exclude the padding from the loss, so that the perplexity does not
+        # depend on the batch size.
+        return inputs, pad_sequence(examples, batch_first=True, padding_value=-100)
+
+    if args.group_by_length:
+        eval_batch_sampler = LengthGroupedBatchSampler(
+            example_lengths(eval_dataset),
+            args.eval_batch_size,
+            max_tokens=args.max_tokens_per_batch,
+            shuffle=False,
+        )
+        eval_dataloader = DataLoader(
+            eval_dataset, batch_sampler=eval_batch_sampler, collate_fn=collate,
+        )
+    else:
+        eval_sampler = SequentialSampler(eval_dataset)
+        eval_dataloader = DataLoader(
+            eval_dataset,
+            sampler=eval_sampler,
+            batch_size=args.eval_batch_size,
+            collate_fn=collate,
         )
-
-    eval_sampler = SequentialSampler(eval_dataset)
-    eval_dataloader = DataLoader(
-        eval_dataset,
-        sampler=eval_sampler,
-        batch_size=args.eval_batch_size,
-        collate_fn=collate,
-    )
 
     # multi-gpu evaluate
     if args.n_gpu > 1:
@@ -577,26 +900,33 @@ def evaluate(
     logger.info("  Batch size = %d", args.eval_batch_size)
     eval_loss = 0.0
     nb_eval_steps = 0
+    nb_eval_tokens = 0
     model.eval()
 
     for batch in tqdm(eval_dataloader, desc="Evaluating"):
-        inputs, labels = (
-            mask_tokens(batch, tokenizer, args) if args.mlm else (batch, batch)
-        )
+        inputs, labels, model_kwargs = prepare_batch(batch, tokenizer, args)
         inputs = inputs.to(args.device)
         labels = labels.to(args.device)
 
         with torch.no_grad():
-            outputs = (
-                model(inputs, masked_lm_labels=labels)
-                if args.mlm
-                else model(inputs, labels=labels)
-            )
-            lm_loss = outputs[0]
-            eval_loss += lm_loss.mean().item()
+            if args.mlm:
+                outputs = model(inputs, masked_lm_labels=labels)
+                lm_loss = outputs[0]
+                eval_loss += lm_loss.mean().item()
+            else:
+                # Sum the token losses, to average over all the tokens at the end.
+                logits = model(inputs, **model_kwargs)[0]
+                shift_labels = labels[:, 1:]
+                eval_loss += torch.nn.functional.cross_entropy(
+                    logits[:, :-1].reshape(-1, logits.size(-1)),
+                    shift_labels.reshape(-1),
+                    ignore_index=-100,
+                    reduction="sum",
+                ).item()
+                nb_eval_tokens += (shift_labels != -100).sum().item()
         nb_eval_steps += 1
 
-    eval_loss = eval_loss / nb_eval_steps
+    eval_loss = eval_loss / (nb_eval_steps if args.mlm else nb_eval_tokens)
     perplexity = torch.exp(torch.tensor(eval_loss))
 
     result = {"perplexity": perplexity}
@@ -647,6 +977,12 @@ def main():
         action="store_true",
         help="Whether distinct lines of text in the dataset are to be handled as distinct sequences.",
     )
+    parser.add_argument(
+        "--pack_sequences",
+        action="store_true",
+        help="Pack several lines into each block_size window instead of padding them "
+        "(implies --line_by_line). The loss is only computed within each line.",
+    )
     parser.add_argument(
         "--should_continue",
         action="store_true",
@@ -727,6 +1063,24 @@ def main():
         type=int,
         help="Batch size per GPU/CPU for evaluation.",
     )
+    parser.add_argument(
+        "--group_by_length",
+        action="store_true",
+        help="Batch examples of similar lengths together to reduce padding.",
+    )
+    parser.add_argument(
+        "--max_tokens_per_batch",
+        default=0,
+        type=int,
+        help="With --group_by_length: if > 0, cap the # of (padded) tokens per batch "
+        "instead of the # of examples.",
+    )
+    parser.add_argument(
+        "--drop_last",
+        action="store_true",
+        help="Drop the incomplete last training batch of each epoch. "
+        "Evaluation always uses all the examples.",
+    )
     parser.add_argument(
         "--gradient_accumulation_steps",
         type=int,
@@ -795,7 +1149,7 @@ def main():
     parser.add_argument(
         "--overwrite_cache",
         action="store_true",
-        help="Overwrite the cached training and evaluation sets",
+        help="Overwrite the cached training and evaluation sets (--line_by_line)",
     )
     parser.add_argument(
         "--seed", type=int, default=42, help="random seed for initialization"
@@ -835,6 +1189,10 @@ def main():
             "BERT and RoBERTa-like models do not have LM heads but masked LM heads. They must be run using the --mlm "
             "flag (masked language modeling)."
         )
+    if args.pack_sequences and (args.mlm or args.group_by_length):
+        raise ValueError(
+            "--pack_sequences cannot be combined with --mlm or --group_by_length."
+        )
     if args.eval_data_file is None and args.do_eval:
         raise ValueError(
             "Cannot do evaluation without an evaluation data file. Either supply a file to --eval_data_file "
@@ -21,6 +21,7 @@ https://github.com/huggingface/transformers/blob/master/examples/text-generation
 """
 
 import argparse
+import json
 import logging
 import os
 import numpy as np
@@ -42,6 +43,30 @@ from transformers import (
     XLNetTokenizer,
 )
 
+from gpt2_dst.scripts.format_retrieval_results import format_retrieval_scores
+from gpt2_dst.utils.convert import START_OF_RESPONSE
+from gpt2_dst.utils.prefix_cache import (
+    PrefixCache,
+    forward_with_prefix,
+    select_past,
+    slice_past,
+)
+from gpt2_dst.utils.quantization import quantize_model
+from gpt2_dst.utils.retrieval_pool import (
+    TokenizedPool,
+    load_retrieval_index,
+    split_context,
+    split_retrieval_target,
+)
+from gpt2_dst.utils.sharding import (
+    ShardWriter,
+    config_key,
+    merge_shards,
+    remove_shards,
+    shard_path,
+    shard_range,
+)
+
 
 logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
@@ -51,6 +76,19 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 MAX_LENGTH = int(10000)  # Hardcoded max length to avoid infinite loop
+# Arguments that change the retrieval scores, see config_key().
+RESULT_ARGS = (
+    "model_type",
+    "model_name_or_path",
+    "prompts_from_file",
+    "padding_text",
+    "xlm_language",
+    "quantize",
+    "score_response_only",
+    "score_reduction",
+    "retrieval_index_file",
+    "retrieval_pool_file",
+)
 
 MODEL_CLASSES = {
     "gpt2": (GPT2LMHeadModel, GPT2Tokenizer),
@@ -164,6 +202,292 @@ def adjust_length_to_model(length, max_sequence_length):
     return length
 
 
+def encode_prompt(args, model, tokenizer, prompt_text):
+    """Returns the token ids of a prompt, after any model-specific preprocessing."""
+    # Different models need different input formatting and/or extra arguments
+    requires_preprocessing = args.model_type in PREPROCESSING_FUNCTIONS.keys()
+    if requires_preprocessing:
+        prepare_input = PREPROCESSING_FUNCTIONS.get(args.model_type)
+        preprocessed_prompt_text = prepare_input(args, model, tokenizer, prompt_text)
+        return tokenizer.encode(
+            preprocessed_prompt_text,
+            add_special_tokens=True,
+            add_space_before_punct_symbol=True,
+        )
+    return tokenizer.encode(prompt_text, add_special_tokens=True)
+
+
+def encode_tokens(args, model, prefix_cache, token_ids):
+    """
+    Runs the model over token_ids of a single sequence, only encoding the
+    tokens after their longest cached prefix if a prefix cache is given.
+
+    Returns the logits of the last token, the past_key_values of all the
+    tokens and the negative log-likelihood of each token (0 for the first).
+    """
+    start, past_key_values, token_nlls = 0, None, torch.zeros(1)
+    if prefix_cache is not None:
+        past_length, cached_past, cached_nlls = prefix_cache.lookup(token_ids)
+        # The logits of the last cached token are needed to score the next one.
+        if past_length >= 2:
+            start = past_length - 1
+            past_key_values = slice_past(cached_past, start)
+            token_nlls = cached_nlls[: start + 1]
+
+    logits, past_key_values = forward_with_prefix(
+        model, token_ids, start, past_key_values, args.device
+    )
+    new_token_nlls = torch.nn.functional.cross_entropy(
+        logits[0, :-1],
+        torch.tensor(token_ids[start + 1 :], device=args.device),
+        reduction="none",
+    )
+    token_nlls = torch.cat([token_nlls, new_token_nlls.cpu()])
+    if prefix_cache is not None:
+        prefix_cache.insert(token_ids, past_key_values, token_nlls)
+    return logits[0, -1], past_key_values, token_nlls
+
+
+def iter_candidate_groups(prompts, batch_size):
+    """
+    Yields the indices of consecutive prompts that share the same context
+    (the text before <SOR>), at most batch_size at a time.
+    """
+    group = []
+    group_context = None
+    for index, prompt_text in enumerate(prompts):
+        context, found, _ = prompt_text.partition(START_OF_RESPONSE)
+        if not found or context != group_context or len(group) == batch_size:
+            if group:
+                yield group
+            group = []
+        group.append(index)
+        group_context = context if found else None
+    if group:
+        yield group
+
+
+def encode_contexts(args, model, contexts):
+    """
+    Runs the model over a right-padded batch of contexts.
+
+    Returns the logits of the last token of each context, the past_key_values
+    of the batch, its attention mask and the negative log-likelihood of each
+    token (0 for the first) of each context.
+    """
+    lengths = [len(ii) for ii in contexts]
+    input_ids = torch.zeros((len(contexts), max(lengths)), dtype=torch.long)
+    attention_mask = torch.zeros_like(input_ids)
+    for index, context in enumerate(contexts):
+        input_ids[index, : len(context)] = torch.tensor(context, dtype=torch.long)
+        attention_mask[index, : len(context)] = 1
+    outputs = model(
+        input_ids=input_ids.to(args.device),
+        attention_mask=attention_mask.to(args.device),
+        use_cache=True,
+    )
+    logits = outputs[0]
+    labels = input_ids.masked_fill(attention_mask == 0, -100)
+    token_nlls = torch.nn.functional.cross_entropy(
+        logits[:, :-1].transpose(1, 2), labels[:, 1:].to(args.device), reduction="none"
+    ).cpu()
+    last_logits = logits[torch.arange(len(contexts)), torch.tensor(lengths) - 1]
+    context_nlls = [
+        torch.cat([torch.zeros(1), token_nlls[index, : length - 1]])
+        for index, length in enumerate(lengths)
+    ]
+    return last_logits, outputs[1], attention_mask, context_nlls
+
+
+def score_candidates(args, model, prefix_cache, encoded_prompts, context_lengths=None):
+    """
+    Returns the negative log-likelihood of each token (0 for the first) of
+    each prompt, made of a context and a candidate.
+
+    Each context is encoded once, and its past_key_values are shared by the
+    remainders of its prompts (i.e. the candidates), which are all scored
+    together as one right-padded batch. Without context_lengths (the length
+    of the context of each prompt), the prompts share a single context: their
+    longest common prefix, looked up in the prefix cache if any. Otherwise,
+    the distinct contexts are encoded as one right-padded batch.
+    """
+    lengths = [len(ii) for ii in encoded_prompts]
+    if context_lengths is None:
+        context_length = min(lengths) - 1
+        for encoded_prompt in encoded_prompts[1:]:
+            for index in range(context_length):
+                if encoded_prompt[index] != encoded_prompts[0][index]:
+                    context_length = index
+                    break
+        if context_length < 1:
+            return [encode_tokens(args, model, None, ii)[2] for ii in encoded_prompts]
+
+        last_logits, past_key_values, context_nlls = encode_tokens(
+            args, model, prefix_cache, encoded_prompts[0][:context_length]
+        )
+        last_logits = last_logits[None]
+        context_nlls = [context_nlls]
+        context_mask = torch.ones((1, context_length), dtype=torch.long)
+        context_lengths = [context_length] * len(encoded_prompts)
+        context_index = [0] * len(encoded_prompts)
+    else:
+        contexts = {}
+        context_index = [
+            contexts.setdefault(tuple(encoded_prompt[:length]), len(contexts))
+            for encoded_prompt, length in zip(encoded_prompts, context_lengths)
+        ]
+        last_logits, past_key_values, context_mask, context_nlls = encode_contexts(
+            args, model, [list(ii) for ii in contexts]
+        )
+
+    batch_size = len(encoded_prompts)
+    max_length = max(
+        length - context_length
+        for length, context_length in zip(lengths, context_lengths)
+    )
+    input_ids = torch.zeros((batch_size, max_length), dtype=torch.long)
+    labels = torch.full((batch_size, max_length), -100, dtype=torch.long)
+    attention_mask = torch.zeros((batch_size, max_length), dtype=torch.long)
+    for index, (encoded_prompt, context_length) in enumerate(
+        zip(encoded_prompts, context_lengths)
+    ):
+        candidate = torch.tensor(encoded_prompt[context_length:], dtype=torch.long)
+        input_ids[index, : len(candidate)] = candidate
+        labels[index, : len(candidate)] = candidate
+        attention_mask[index, : len(candidate)] = 1
+    context_index = torch.tensor(context_index)
+    attention_mask = torch.cat([context_mask[context_index], attention_mask], dim=1)
+    position_ids = torch.tensor(context_lengths)[:, None] + torch.arange(max_length)
+    device_index = context_index.to(args.device)
+
+    outputs = model(
+        input_ids=input_ids.to(args.device),
+        attention_mask=attention_mask.to(args.device),
+        position_ids=position_ids.to(args.device),
+        past_key_values=select_past(past_key_values, device_index),
+        use_cache=False,
+    )
+    # The first token of each candidate is predicted by the last context token.
+    logits = torch.cat([last_logits[device_index, None], outputs[0][:, :-1]], dim=1)
+    candidate_nlls = torch.nn.functional.cross_entropy(
+        logits.transpose(1, 2), labels.to(args.device), reduction="none"
+    ).cpu()
+    return [
+        torch.cat(
+            [
+                context_nlls[context_index[index]],
+                candidate_nlls[index, : length - context_length],
+            ]
+        )
+        for index, (length, context_length) in enumerate(zip(lengths, context_lengths))
+    ]
+
+
+def reduce_token_nlls(args, token_nlls, encoded_prompt, prompt_text):
+    """
+    Returns the score of a prompt: the mean (or sum) of the negative
+    log-likelihood of its tokens, or only of its response tokens (after <SOR>).
+    prompt_text (the line the prompt comes from) names the prompt in errors.
+    """
+    start = 1
+    if args.score_response_only:
+        if args.start_of_response_id not in encoded_prompt:
+            raise ValueError(f"No {START_OF_RESPONSE} in: {prompt_text}")
+        start = encoded_prompt.index(args.start_of_response_id) + 1
+    token_nlls = token_nlls[start:]
+    if args.score_reduction == "sum":
+        return float(token_nlls.sum().item())
+    return float(token_nlls.mean().item())
+
+
+def score_line(args, model, prefix_cache, encoded_prompt, prompt_text):
+    """Returns the score of a single line of a flattened retrieval file."""
+    if prefix_cache is not None:
+        _, _, token_nlls = encode_tokens(args, model, prefix_cache, encoded_prompt)
+    elif args.score_response_only or args.score_reduction == "sum":
+        input_ids = torch.tensor([encoded_prompt], device=args.device)
+        logits = model(input_ids)[0]
+        token_nlls = torch.nn.functional.cross_entropy(
+            logits[0, :-1], input_ids[0, 1:], reduction="none"
+        )
+        token_nlls = torch.cat([torch.zeros(1), token_nlls.cpu()])
+    else:
+        encoded_prompt = torch.tensor([encoded_prompt], device=args.device)
+        outputs = model(encoded_prompt, labels=encoded_prompt)
+        return float(outputs[0].cpu().item())
+    return reduce_token_nlls(args, token_nlls, encoded_prompt, prompt_text)
+
+
+def score_group(args, model, prefix_cache, encoded_prompts, prompt_texts):
+    """Returns the scores of prompts that share a context."""
+    all_token_nlls = score_candidates(args, model, prefix_cache, encoded_prompts)
+    return [
+        reduce_token_nlls(args, token_nlls, encoded_prompt, prompt_text)
+        for token_nlls, encoded_prompt, prompt_text in zip(
+            all_token_nlls, encoded_prompts, prompt_texts
+        )
+    ]
+
+
+def load_retrieval_pool(args, tokenizer, n_prompts):
+    """
+    Returns the retrieval index, the candidate pool and the pre-tokenized
+    candidate pool.
+    """
+    retrieval_index = load_retrieval_index(args.retrieval_index_file)
+    if len(retrieval_index) != n_prompts:
+        raise ValueError("#prompts and #turns in the retrieval index do not match!")
+    with open(args.retrieval_pool_file, "r") as file_id:
+        options_pool = json.load(file_id)["system_transcript_pool"]
+    pool = TokenizedPool(
+        options_pool, lambda text: tokenizer.encode(text, add_special_tokens=False)
+    )
+    return retrieval_index, options_pool, pool
+
+
+def score_turn(args, model, tokenizer, prefix_cache, prompt_text, turn, retrieval_pool):
+    """
+    Scores the candidates of a turn, given its context (a line of the predict
+    file), its retrieval index entry and the pre-tokenized candidate pool.
+    """
+    _, options_pool, pool = retrieval_pool
+    domain, candidates = turn
+    context = split_context(prompt_text)
+    context_ids = tokenizer.encode(context, add_special_tokens=True)
+    encoded_prompts = [context_ids + pool[domain, ii] for ii in candidates]
+
+    # <SOR> should split the tokenization of the flattened lines.
+    text = context + split_retrieval_target(options_pool[domain][candidates[0]])
+    if tokenizer.encode(text, add_special_tokens=True) != encoded_prompts[0]:
+        raise ValueError(f"The tokenization of {START_OF_RESPONSE} is context dependent.")
+
+    scores = []
+    for start in range(0, len(encoded_prompts), args.batch_size):
+        batch = encoded_prompts[start : start + args.batch_size]
+        scores.extend(
+            score_group(args, model, prefix_cache, batch, [prompt_text] * len(batch))
+        )
+    return scores
+
+
+def save_results(args, results):
+    # Create a directory if it does not exist
+    directory = os.path.dirname(args.path_output)
+    if not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+
+    # Save to a file
+    if args.dialog_json_file is not None:
+        with open(args.dialog_json_file, "r") as file_id:
+            dialogs = json.load(file_id)
+        with open(args.path_output, "w") as f_out:
+            json.dump(format_retrieval_scores(dialogs, results), f_out)
+    else:
+        with open(args.path_output, "w") as f_out:
+            for ii in results:
+                f_out.write(f"{ii}\n")
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -211,14 +535,91 @@ command line""",
     parser.add_argument(
         "--no_cuda", action="store_true", help="Avoid using CUDA when available"
     )
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="Run the model on CPU with int8 dynamically quantized linear layers",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=1,
+        help="# of candidates of a context scored together, on top of the "
+        "context encoded once",
+    )
+    parser.add_argument(
+        "--prefix_cache_mb",
+        type=float,
+        default=0,
+        help="Memory (MB) for the keys and values of prompt prefixes shared "
+        "across prompts, e.g. the context of the candidates (0 to disable)",
+    )
+    parser.add_argument(
+        "--score_response_only",
+        action="store_true",
+        help="Only score the response tokens (after <SOR>) of each prompt",
+    )
+    parser.add_argument(
+        "--score_reduction",
+        type=str,
+        default="mean",
+        choices=["mean", "sum"],
+        help="Reduction of the negative log-likelihood of the scored tokens",
+    )
+    parser.add_argument(
+        "--dialog_json_file",
+        type=str,
+        default=None,
+        help="Original SIMMC dialog JSON, to save the scores in the format of "
+        "format_retrieval_results.py rather than one per line",
+    )
+    parser.add_argument(
+        "--retrieval_index_file",
+        type=str,
+        default=None,
+        help="Retrieval index from preprocess_input.py --retrieval_index, to "
+        "score its candidates with the contexts of the prompts file",
+    )
+    parser.add_argument(
+        "--retrieval_pool_file",
+        type=str,
+        default=None,
+        help="Retrieval candidates JSON with the system_transcript_pool",
+    )
     parser.add_argument(
         "--path_output",
         type=str,
         default=None,
         help="Path to output predictions in a line separated text file.",
     )
+    parser.add_argument(
+        "--shard_id", type=int, default=0, help="Shard of the prompts to score"
+    )
+    parser.add_argument(
+        "--num_shards", type=int, default=1, help="# of shards of the prompts"
+    )
+    parser.add_argument(
+        "--merge_shards",
+        action="store_true",
+        help="Merge the outputs of all the shards into --path_output",
+    )
     args = parser.parse_args()
 
+    if args.merge_shards:
+        if args.retrieval_index_file:
+            n_results = sum(
+                len(ii) for _, ii in load_retrieval_index(args.retrieval_index_file)
+            )
+        else:
+            with open(args.prompts_from_file) as handle:
+                n_results = len(handle.readlines())
+        results = merge_shards(args.path_output, args.num_shards, n_results)
+        save_results(args, results)
+        remove_shards(args.path_output, args.num_shards)
+        return results
+
+    # Quantized models only run on CPU.
+    args.no_cuda = args.no_cuda or args.quantize
     args.device = torch.device(
         "cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu"
     )
@@ -238,9 +639,32 @@ command line""",
             "the model {} you specified is not supported. You are welcome to add it and open a PR :)"
         )
 
+    if (
+        args.prefix_cache_mb > 0 or args.batch_size > 1 or args.retrieval_index_file
+    ) and args.model_type != "gpt2":
+        raise ValueError(
+            "--prefix_cache_mb, --batch_size and --retrieval_index_file are only "
+            "supported for gpt2."
+        )
+    if args.retrieval_index_file and not (
+        args.retrieval_pool_file and args.prompts_from_file
+    ):
+        raise ValueError(
+            "--retrieval_index_file requires --retrieval_pool_file and --prompts_from_file."
+        )
+
     tokenizer = tokenizer_class.from_pretrained(args.model_name_or_path)
     model = model_class.from_pretrained(args.model_name_or_path)
     model.to(args.device)
+    if args.quantize:
+        model = quantize_model(model)
+
+    if args.score_response_only and START_OF_RESPONSE not in tokenizer.get_vocab():
+        raise ValueError(f"--score_response_only requires a {START_OF_RESPONSE} token.")
+    args.start_of_response_id = tokenizer.convert_tokens_to_ids(START_OF_RESPONSE)
+    prefix_cache = None
+    if args.prefix_cache_mb > 0:
+        prefix_cache = PrefixCache(int(args.prefix_cache_mb * 2**20))
 
     args.length = adjust_length_to_model(
         args.length, max_sequence_length=model.config.max_position_embeddings
@@ -249,6 +673,7 @@ command line""",
 
     results = []
     prompts = []
+    writer = None
     if args.prompts_from_file:
         with open(args.prompts_from_file) as handle:
             prompts = handle.readlines()
@@ -265,45 +690,122 @@ command line""",
 
         with torch.no_grad():
             n_prompts = len(prompts)
-            for i, prompt_text in progressbar(enumerate(prompts), total=n_prompts):
-                # Strip any trailing \n if provided
-                prompt_text = prompt_text.strip("\n")
-
-                # Different models need different input formatting and/or extra arguments
-                requires_preprocessing = args.model_type in PREPROCESSING_FUNCTIONS.keys()
-                if requires_preprocessing:
-                    prepare_input = PREPROCESSING_FUNCTIONS.get(args.model_type)
-                    preprocessed_prompt_text = prepare_input(
-                        args, model, tokenizer, prompt_text
+            # Strip any trailing \n if provided
+            prompts = [prompt_text.strip("\n") for prompt_text in prompts]
+
+            # The results of prompt ii are offsets[ii]:offsets[ii + 1], i.e.
+            # the candidates of a turn for a retrieval index.
+            retrieval_pool = None
+            if args.retrieval_index_file:
+                retrieval_pool = load_retrieval_pool(args, tokenizer, n_prompts)
+                offsets = [0]
+                for _, candidates in retrieval_pool[0]:
+                    offsets.append(offsets[-1] + len(candidates))
+            else:
+                offsets = list(range(n_prompts + 1))
+            n_results = offsets[-1]
+
+            # Results of a file are written to its shard as they are scored,
+            # skipping the prompts done by a previous run.
+            todo = list(range(n_prompts))
+            if args.prompts_from_file and args.path_output is not None:
+                start, end = shard_range(n_prompts, args.shard_id, args.num_shards)
+                writer = ShardWriter(
+                    shard_path(args.path_output, args.shard_id, args.num_shards),
+                    n_results,
+                    config_key(args, RESULT_ARGS),
+                )
+                todo = [
+                    ii
+                    for ii in range(start, end)
+                    if any(
+                        jj not in writer.done
+                        for jj in range(offsets[ii], offsets[ii + 1])
                     )
-                    encoded_prompt = tokenizer.encode(
-                        preprocessed_prompt_text,
-                        add_special_tokens=True,
-                        return_tensors="pt",
-                        add_space_before_punct_symbol=True,
+                ]
+                logger.info(
+                    f"Shard {args.shard_id} / {args.num_shards}: "
+                    f"{len(todo)} / {end - start} prompts left"
+                )
+
+            if retrieval_pool is None and args.batch_size > 1:
+                groups = [
+                    [todo[ii] for ii in group]
+                    for group in iter_candidate_groups(
+                        [prompts[ii] for ii in todo], args.batch_size
                     )
-                else:
-                    encoded_prompt = tokenizer.encode(
-                        prompt_text, add_special_tokens=True, return_tensors="pt"
+                ]
+            else:
+                groups = [[ii] for ii in todo]
+
+            prompt_results = [None] * n_results
+            for group in progressbar(groups):
+                if retrieval_pool is not None:
+                    (turn_id,) = group
+                    scores = score_turn(
+                        args,
+                        model,
+                        tokenizer,
+                        prefix_cache,
+                        prompts[turn_id],
+                        retrieval_pool[0][turn_id],
+                        retrieval_pool,
                     )
-                encoded_prompt = encoded_prompt.to(args.device)
-                outputs = model(encoded_prompt, labels=encoded_prompt)
-                results.append(float(outputs[0].cpu().item()))
+                else:
+                    encoded_prompts = [
+                        encode_prompt(args, model, tokenizer, prompts[ii])
+                        for ii in group
+                    ]
+                    if len(group) > 1:
+                        scores = score_group(
+                            args,
+                            model,
+                            prefix_cache,
+                            encoded_prompts,
+                            [prompts[ii] for ii in group],
+                        )
+                    else:
+                        scores = [
+                            score_line(
+                                args,
+                                model,
+                                prefix_cache,
+                                encoded_prompts[0],
+                                prompts[group[0]],
+                            )
+                        ]
+
+                result_ids = [
+                    jj for ii in group for jj in range(offsets[ii], offsets[ii + 1])
+                ]
+                for result_id, score in zip(result_ids, scores):
+                    prompt_results[result_id] = score
+                    if writer is not None:
+                        writer.write(result_id, score)
+                if writer is not None:
+                    writer.maybe_checkpoint()
+            results.extend(prompt_results)
+
+        if prefix_cache is not None:
+            logger.info(prefix_cache.stats())
 
         prompts = []
         if args.prompt or args.prompts_from_file:
             break  # break while True loop
 
-    if args.path_output is not None:
-        # Create a directory if it does not exist
-        directory = os.path.dirname(args.path_output)
-        if not os.path.exists(directory):
-            os.makedirs(directory, exist_ok=True)
-
-        # Save to a file
-        with open(args.path_output, "w") as f_out:
-            for ii in results:
-                f_out.write(f"{ii}\n")
+    if writer is not None:
+        writer.close()
+        if args.num_shards > 1:
+            logger.info(
+                "Run with --merge_shards once all the shards are done to save "
+                f"{args.path_output}"
+            )
+            return results
+        save_results(args, merge_shards(args.path_output, 1, n_results))
+        remove_shards(args.path_output, 1)
+
+    elif args.path_output is not None:
+        save_results(args, results)
     return results
 
 
@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+This source code is licensed under the license found in the LICENSE file in the
+root directory of this source tree.
+
+    Local inference server for the SIMMC 2.1 subtasks, which keeps the models
+    loaded across requests.
+
+    Requests and responses are JSON objects, one per line, over TCP:
+
+        {"id": 0, "task": "dst", "prompt": <line of the predict file>}
+        {"id": 1, "task": "retrieval", "context": <line of the predict file>,
+            "candidates": [<response>, ...]}
+        {"id": 2, "task": "disambiguation", "dialog": [<utterance>, ...]}
+        {"id": 3, "task": "ambiguous_candidates", "dialog": [<utterance>, ...],
+            "features": [<visual feature of each candidate>, ...]}
+        {"id": 4, "task": "stats"}
+
+    Each request is answered with {"id": ..., "result": ...} (or "error") as soon
+    as its result is ready, so responses may come out of order. Concurrent
+    requests of a task are coalesced into micro-batches.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+import argparse
+import asyncio
+import importlib.util
+import json
+import logging
+import os
+
+import torch
+from transformers import AutoTokenizer, GPT2LMHeadModel, GPT2Tokenizer
+
+from gpt2_dst.scripts.run_generation import generate_batch
+from gpt2_dst.scripts.run_retrieval import reduce_token_nlls, score_candidates
+from gpt2_dst.utils.convert import START_OF_RESPONSE, parse_flattened_result
+from gpt2_dst.utils.decoding import BeliefStateGrammar
+from gpt2_dst.utils.micro_batching import MicroBatcher
+from gpt2_dst.utils.quantization import quantize_model
+from gpt2_dst.utils.retrieval_pool import split_context, split_retrieval_target
+
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+# Folder with the disambiguate/ and ambiguous_candidates/ models.
+MODEL_DIR = os.path.dirname(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+)
+# Fields each task expects in its requests.
+REQUIRED_FIELDS = {
+    "dst": ["prompt"],
+    "retrieval": ["context", "candidates"],
+    "disambiguation": ["dialog"],
+    "ambiguous_candidates": ["dialog", "features"],
+}
+
+
+def load_module(name, path):
+    """Imports a module of one of the other model folders, by its path."""
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def format_dialog(dialog, max_turns):
+    """Formats a dialog as the disambiguate/ambiguous_candidates Dataloaders."""
+    utterances = [
+        ("<USER> " if index % 2 == 0 else "<SYS> ") + utterance
+        for index, utterance in enumerate(dialog)
+    ]
+    return " ".join(utterances[-(2 * max_turns + 1) :])
+
+
+class GPT2Tasks:
+    """DST (generation) and retrieval (scoring) with the GPT-2 DST model."""
+
+    def __init__(self, args):
+        self.args = args
+        self.tokenizer = GPT2Tokenizer.from_pretrained(args.model_name_or_path)
+        self.model = GPT2LMHeadModel.from_pretrained(args.model_name_or_path)
+        self.model.to(args.device)
+        if args.quantize:
+            self.model = quantize_model(self.model)
+        self.model.eval()
+
+        # Options of run_generation.py and run_retrieval.py.
+        args.decoding = "greedy"
+        args.num_return_sequences = 1
+        args.repetition_penalty = 1.0
+        args.temperature, args.k, args.p = 1.0, 0, 0.9
+        args.early_stop_token_id = None
+        if args.early_stop_token is not None:
+            args.early_stop_token_id = self.tokenizer.convert_tokens_to_ids(
+                args.early_stop_token
+            )
+        args.grammar = None
+        if args.constrain_belief_state:
+            args.grammar = BeliefStateGrammar(
+                self.tokenizer, self.model.config.vocab_size
+            )
+        vocab = self.tokenizer.get_vocab()
+        if args.score_response_only and START_OF_RESPONSE not in vocab:
+            raise ValueError(f"--score_response_only requires a {START_OF_RESPONSE} token.")
+        args.start_of_response_id = self.tokenizer.convert_tokens_to_ids(
+            START_OF_RESPONSE
+        )
+
+    def generate(self, requests):
+        prompts = [request["prompt"].strip("\n") for request in requests]
+        encoded_prompts = [
+            self.tokenizer.encode(ii, add_special_tokens=True) for ii in prompts
+        ]
+        # Batch prompts of similar lengths together to reduce the padding.
+        order = sorted(range(len(prompts)), key=lambda ii: len(encoded_prompts[ii]))
+        with torch.no_grad():
+            output_sequences = generate_batch(
+                self.args,
+                self.model,
+                [encoded_prompts[ii] for ii in order],
+                [prompts[ii] for ii in order],
+            )
+
+        results = [None] * len(prompts)
+        for index, (sequence,) in zip(order, output_sequences):
+            text = self.tokenizer.decode(sequence, clean_up_tokenization_spaces=True)
+            if self.args.stop_token and self.args.stop_token in text:
+                text = text[: text.find(self.args.stop_token)]
+            prompt_length = len(
+                self.tokenizer.decode(
+                    encoded_prompts[index], clean_up_tokenization_spaces=True
+                )
+            )
+            prediction = prompts[index] + text[prompt_length:]
+            results[index] = {
+                "prediction": prediction,
+                "belief_state": parse_flattened_result(prediction),
+            }
+        return results
+
+    def score(self, requests):
+        encoded_prompts, context_lengths, request_ids = [], [], []
+        for index, request in enumerate(requests):
+            context = split_context(request["context"])
+            context_ids = self.tokenizer.encode(context, add_special_tokens=True)
+            for candidate in request["candidates"]:
+                encoded_prompts.append(
+                    context_ids
+                    + self.tokenizer.encode(
+                        split_retrieval_target(candidate), add_special_tokens=False
+                    )
+                )
+                context_lengths.append(len(context_ids))
+                request_ids.append(index)
+
+        # The candidates of all the requests are scored together, batch_size
+        # at a time to bound the memory of the expanded contexts.
+        results = [{"scores": []} for _ in requests]
+        with torch.no_grad():
+            for start in range(0, len(encoded_prompts), self.args.batch_size):
+                end = start + self.args.batch_size
+                all_token_nlls = score_candidates(
+                    self.args,
+                    self.model,
+                    None,
+                    encoded_prompts[start:end],
+                    context_lengths[start:end],
+                )
+                for token_nlls, encoded_prompt, index in zip(
+                    all_token_nlls, encoded_prompts[start:end], request_ids[start:end]
+                ):
+                    results[index]["scores"].append(
+                        reduce_token_nlls(
+                            self.args,
+                            token_nlls,
+                            encoded_prompt,
+                            requests[index]["context"],
+                        )
+                    )
+        return results
+
+
+class ExportedClassifierTask:
+    """Disambiguation or ambiguous candidates, with a model exported to a graph."""
+
+    def __init__(self, export_dir, task, use_gpu):
+        if task == "disambiguation":
+            module = load_module(
+                "disambiguate_exported_model",
+                os.path.join(MODEL_DIR, "disambiguate", "exported_model.py"),
+            )
+            self.model = module.ExportedDisambiguator(export_dir, use_gpu)
+        else:
+            module = load_module(
+                "ambiguous_candidates_exported_model",
+                os.path.join(MODEL_DIR, "ambiguous_candidates", "exported_model.py"),
+            )
+            self.model = module.ExportedAmbiguousCandidateIdentifier(export_dir, use_gpu)
+        self.task = task
+        self.device = torch.device("cuda" if use_gpu else "cpu")
+        self.tokenizer = AutoTokenizer.from_pretrained(export_dir)
+        self.tokenizer.truncation_side = "left"
+
+    def __call__(self, requests):
+        max_turns = self.model.config["max_turns"]
+        encoded_inputs = self.tokenizer(
+            [format_dialog(request["dialog"], max_turns) for request in requests],
+            padding=True,
+            max_length=self.model.config["max_length"],
+            return_tensors="pt",
+            truncation=True,
+        )
+        batch = {
+            "text_in": {key: val.to(self.device) for key, val in encoded_inputs.items()}
+        }
+        if self.task == "disambiguation":
+            logits = self.model(batch)
+            return [
+                {"label": int(torch.argmax(ii)), "logits": ii.tolist()} for ii in logits
+            ]
+
+        batch["features"] = [
+            torch.tensor(request["features"], dtype=torch.float32, device=self.device)
+            for request in requests
+        ]
+        results = []
+        for request, logits in zip(requests, self.model(batch)):
+            candidates = torch.nonzero(logits > 0)[:, 0].tolist()
+            if "object_map" in request:
+                candidates = [request["object_map"][ii] for ii in candidates]
+            results.append({"candidates": candidates, "logits": logits.tolist()})
+        return results
+
+
+async def handle_connection(batchers, reader, writer):
+    """Answers the requests of a connection, processing them concurrently."""
+    write_lock = asyncio.Lock()
+    pending = set()
+
+    async def respond(line):
+        response = {"id": None}
+        try:
+            request = json.loads(line)
+            response["id"] = request.get("id")
+            task = request.get("task")
+            if task == "stats":
+                response["result"] = {
+                    name: batcher.stats.snapshot() for name, batcher in batchers.items()
+                }
+            elif task in batchers:
+                missing = [ii for ii in REQUIRED_FIELDS[task] if ii not in request]
+                if missing:
+                    raise ValueError(f"Missing fields for {task}: {missing}")
+                response["result"] = await batchers[task].submit(request)
+            else:
+                raise ValueError(f"Unknown or unavailable task: {task}")
+        except Exception as error:
+            response["error"] = f"{type(error).__name__}: {error}"
+        async with write_lock:
+            writer.write((json.dumps(response) + "\n").encode("utf-8"))
+            await writer.drain()
+
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        if line.strip():
+            task = asyncio.ensure_future(respond(line))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+    if pending:
+        await asyncio.gather(*pending, return_exceptions=True)
+    writer.close()
+
+
+async def serve(args, handlers):
+    batchers = {
+        task: MicroBatcher(handler, args.max_batch_size, args.max_wait_ms)
+        for task, handler in handlers.items()
+    }
+    workers = [asyncio.ensure_future(batcher.run()) for batcher in batchers.values()]
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_connection(batchers, reader, writer),
+        args.host,
+        args.port,
+        # Retrieval and ambiguous candidates requests can be long lines.
+        limit=2 ** 26,
+    )
+    logger.info(f"Serving {sorted(batchers)} on {args.host}:{args.port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        for worker in workers:
+            worker.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model_name_or_path",
+        default=None,
+        help="Path to the GPT-2 DST model, for the dst and retrieval tasks",
+    )
+    parser.add_argument(
+        "--disambiguator_export_dir",
+        default=None,
+        help="Path to a model exported by disambiguate/export_model.py",
+    )
+    parser.add_argument(
+        "--candidate_identifier_export_dir",
+        default=None,
+        help="Path to a model exported by ambiguous_candidates/export_model.py",
+    )
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=16,
+        help="Max # of requests of a task processed together",
+    )
+    parser.add_argument(
+        "--max_wait_ms",
+        type=float,
+        default=5,
+        help="Max time a request waits for others to join its batch",
+    )
+    parser.add_argument("--length", type=int, default=100)
+    parser.add_argument(
+        "--stop_token",
+        type=str,
+        default="<EOS>",
+        help="Token at which text generation is stopped",
+    )
+    parser.add_argument(
+        "--early_stop_token",
+        type=str,
+        default=None,
+        help="Special token (e.g. <EOB>) at which each sequence stops generating",
+    )
+    parser.add_argument(
+        "--constrain_belief_state",
+        action="store_true",
+        help="Only allow tokens that keep the belief state parseable",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=100,
+        help="# of retrieval candidates scored together",
+    )
+    parser.add_argument(
+        "--score_response_only",
+        action="store_true",
+        help="Only score the response tokens of the retrieval candidates",
+    )
+    parser.add_argument(
+        "--score_reduction",
+        default="mean",
+        choices=["mean", "sum"],
+        help="Reduction of the token negative log-likelihoods into a score",
+    )
+    parser.add_argument(
+        "--no_cuda", action="store_true", help="Avoid using CUDA when available"
+    )
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="Run the GPT-2 model on CPU with int8 dynamically quantized linear layers",
+    )
+    args = parser.parse_args()
+
+    # Quantized models only run on CPU.
+    args.no_cuda = args.no_cuda or args.quantize
+    args.device = torch.device(
+        "cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu"
+    )
+
+    handlers = {}
+    if args.model_name_or_path:
+        gpt2_tasks = GPT2Tasks(args)
+        handlers["dst"] = gpt2_tasks.generate
+        handlers["retrieval"] = gpt2_tasks.score
+    use_gpu = args.device.type == "cuda"
+    if args.disambiguator_export_dir:
+        handlers["disambiguation"] = ExportedClassifierTask(
+            args.disambiguator_export_dir, "disambiguation", use_gpu
+        )
+    if args.candidate_identifier_export_dir:
+        handlers["ambiguous_candidates"] = ExportedClassifierTask(
+            args.candidate_identifier_export_dir, "ambiguous_candidates", use_gpu
+        )
+    if not handlers:
+        raise ValueError("No model to serve.")
+
+    asyncio.run(serve(args, handlers))
+
+
+if __name__ == "__main__":
+    main()
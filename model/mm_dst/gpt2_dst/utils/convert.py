@@ -11,9 +11,14 @@ root directory of this source tree.
     The reformatted data is used as input for the GPT-2 based
     DST model baseline.
 """
+import collections
+import hashlib
 import json
+import multiprocessing
 import re
 import os
+import shutil
+import tempfile
 
 # DSTC style dataset fieldnames
 FIELDNAME_DIALOG = "dialogue"
@@ -40,6 +45,19 @@ TEMPLATE_TARGET = (
 TEMPLATE_PREDICT_NOBELIEF = "{context} {START_OF_RESPONSE} "
 TEMPLATE_TARGET_NOBELIEF = "{context} {START_OF_RESPONSE} {response} {END_OF_SENTENCE}"
 
+# Read size used when streaming the input JSON.
+STREAM_CHUNK_SIZE = 1 << 16
+
+# Number of dialogs handed to each worker at once in the multi-process mode.
+PARALLEL_CHUNK_SIZE = 64
+
+# Number of lines parsed by each worker at once when parsing results.
+PARSE_CHUNK_SIZE = 1024
+PARSE_MAX_PENDING_CHUNKS = 32
+
+# Bump when the formatting changes, to invalidate the incremental caches.
+CACHE_VERSION = 1
+
 
 def convert_json_to_flattened(
     input_path_json,
@@ -53,31 +71,37 @@ def convert_json_to_flattened(
     output_path_retrieval=None,
     input_path_special_tokens="",
     output_path_special_tokens="",
+    streaming=False,
+    num_workers=1,
+    cache_path="",
+    retrieval_index=False,
 ):
     """
     Input: JSON representation of the dialogs
     Output: line-by-line stringified representation of each turn
-    """
 
-    with open(input_path_json, "r") as f_in:
-        data = json.load(f_in)["dialogue_data"]
+    If retrieval_index is True, output_path_retrieval gets one JSON line per
+    turn with its domain and retrieval candidate indices, rather than one
+    flattened line per (turn, candidate). The candidates are then read from
+    the "system_transcript_pool" of input_path_retrieval, with the contexts
+    of the predict file (see run_retrieval.py).
 
-    # If input_path_retrieval is not None, also encode retrieval options.
-    if input_path_retrieval is not None:
-        with open(input_path_retrieval, "r") as file_id:
-            retrieval_options = json.load(file_id)
-        format_retrieval_options = True
-        options_pool = retrieval_options["system_transcript_pool"]
-        options_dict = {
-            ii["dialogue_idx"]: ii
-            for ii in retrieval_options["retrieval_candidates"]
-        }
-        retrieval_targets = []
-    else:
-        format_retrieval_options = False
+    If streaming is True, dialogs are parsed incrementally from the
+    "dialogue_data" field, so that the peak memory does not grow with
+    the size of the input file. Lines are written out as soon as they
+    are formatted in both modes.
 
-    predicts = []
-    targets = []
+    If num_workers > 1, dialogs are formatted by a pool of processes,
+    and the results are written back in the original dialog order.
+
+    If cache_path is given, the output files are also saved in that folder,
+    keyed by the formatting options and the path, size and modification time
+    of the input files. A later run with the same key copies them back
+    without reading the inputs.
+
+    Returns whether the outputs were copied from the cache if cache_path is
+    given, else None.
+    """
     if input_path_special_tokens != "":
         with open(input_path_special_tokens, "r") as f_in:
             special_tokens = json.load(f_in)
@@ -94,131 +118,313 @@ def convert_json_to_flattened(
             )
         special_tokens["additional_special_tokens"] = additional_special_tokens
 
+    # If a new output path for special tokens is given,
+    # we track new OOVs
+    track_oov = output_path_special_tokens != ""
+
+    format_kwargs = {
+        "len_context": len_context,
+        "use_multimodal_contexts": use_multimodal_contexts,
+        "use_belief_states": use_belief_states,
+        "output_target": output_target,
+        "track_oov": track_oov,
+        "retrieval_index": retrieval_index,
+    }
+
+    outputs = {"predict": output_path_predict}
+    if output_target:
+        outputs["target"] = output_path_target
+    if input_path_retrieval is not None:
+        outputs["retrieval"] = output_path_retrieval
+
+    cache = None
+    cache_hit = None
+    if cache_path != "":
+        cache = _OutputCache(
+            cache_path,
+            [
+                CACHE_VERSION,
+                format_kwargs,
+                _file_identity(input_path_json),
+                _file_identity(input_path_retrieval),
+            ],
+        )
+        oov = cache.load(outputs)
+        cache_hit = oov is not None
+    if not cache_hit:
+        oov = _write_flattened(
+            input_path_json,
+            input_path_retrieval,
+            outputs,
+            format_kwargs,
+            streaming,
+            num_workers,
+        )
+        if cache is not None:
+            cache.save(outputs, oov)
+
     if output_path_special_tokens != "":
-        # If a new output path for special tokens is given,
-        # we track new OOVs
-        oov = set()
-
-    for _, dialog in enumerate(data):
-
-        domain = dialog["domain"]
-        dialog_id = dialog["dialogue_idx"]
-        prev_asst_uttr = None
-        prev_turn = None
-        lst_context = []
-
-        for turn_id, turn in enumerate(dialog[FIELDNAME_DIALOG]):
-            user_uttr = turn.get(FIELDNAME_USER_UTTR, "").replace("\n", " ").strip()
-            user_belief = turn.get(FIELDNAME_BELIEF_STATE, {})
-            asst_uttr = turn.get(FIELDNAME_ASST_UTTR, "").replace("\n", " ").strip()
-
-            # Format main input context
-            context = ""
-            if prev_asst_uttr:
-                context += f"System : {prev_asst_uttr} "
-                if use_multimodal_contexts:
-                    # Add multimodal contexts
-                    visual_objects = prev_turn[FIELDNAME_SYSTEM_STATE][
-                        "act_attributes"
-                    ]["objects"]
-                    context += represent_visual_objects(visual_objects) + " "
-
-            context += f"User : {user_uttr}"
-            prev_asst_uttr = asst_uttr
-            prev_turn = turn
-
-            # Add multimodal contexts -- user shouldn't have access to ground-truth
-            """
+        # Create a directory if it does not exist
+        directory = os.path.dirname(output_path_special_tokens)
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        with open(output_path_special_tokens, "w") as f_special_tokens:
+            # Add oov's (acts and slot names, etc.) to special tokens as well
+            special_tokens["additional_special_tokens"].extend(list(oov))
+            json.dump(special_tokens, f_special_tokens)
+    return cache_hit
+
+
+def _write_flattened(
+    input_path_json,
+    input_path_retrieval,
+    outputs,
+    format_kwargs,
+    streaming,
+    num_workers,
+):
+    """
+    Formats the dialogs into the output files (see convert_json_to_flattened)
+    and returns the OOV tokens.
+    """
+    if streaming:
+        data = iter_dialogue_data(input_path_json)
+    else:
+        with open(input_path_json, "r") as f_in:
+            data = json.load(f_in)["dialogue_data"]
+
+    # If input_path_retrieval is not None, also encode retrieval options.
+    if input_path_retrieval is not None:
+        with open(input_path_retrieval, "r") as file_id:
+            retrieval_options = json.load(file_id)
+        format_retrieval_options = True
+        options_pool = retrieval_options["system_transcript_pool"]
+        options_dict = {
+            ii["dialogue_idx"]: ii
+            for ii in retrieval_options["retrieval_candidates"]
+        }
+    else:
+        format_retrieval_options = False
+        options_pool = None
+
+    def iter_jobs():
+        for dialog in data:
+            if format_retrieval_options:
+                retrieval_candidates = options_dict[dialog["dialogue_idx"]][
+                    "retrieval_candidates"
+                ]
+            else:
+                retrieval_candidates = None
+            yield dialog, retrieval_candidates
+
+    def format_window(window):
+        if pool is not None:
+            return pool.map(_format_job, window, chunksize=PARALLEL_CHUNK_SIZE)
+        return [
+            format_dialog(
+                dialog,
+                retrieval_candidates=retrieval_candidates,
+                options_pool=options_pool,
+                **format_kwargs,
+            )
+            for dialog, retrieval_candidates in window
+        ]
+
+    # The worker pool and output files are all released in the finally
+    # clause, whichever step fails.
+    oov = set()
+    pool = None
+    f_predict = f_target = f_retrieval = None
+    try:
+        if num_workers > 1:
+            # Ship the (large) retrieval pool to each worker only once.
+            pool = multiprocessing.Pool(
+                num_workers,
+                initializer=_init_format_worker,
+                initargs=(options_pool, format_kwargs),
+            )
+        formatted = _iter_formatted(
+            iter_jobs(), format_window, num_workers * PARALLEL_CHUNK_SIZE
+        )
+
+        # Output into text files
+        f_predict = _open_for_write(outputs["predict"])
+        if "target" in outputs:
+            f_target = _open_for_write(outputs["target"])
+        if format_retrieval_options:
+            f_retrieval = _open_for_write(outputs["retrieval"])
+        for predicts, targets, retrieval_targets, dialog_oov in formatted:
+            f_predict.write_lines(predicts)
+            if f_target is not None:
+                f_target.write_lines(targets)
+            if f_retrieval is not None:
+                f_retrieval.write_lines(retrieval_targets)
+            oov.update(dialog_oov)
+    finally:
+        for file_id in (f_predict, f_target, f_retrieval):
+            if file_id is not None:
+                file_id.close()
+        if pool is not None:
+            pool.terminate()
+    return oov
+
+
+def format_dialog(
+    dialog,
+    len_context=2,
+    use_multimodal_contexts=True,
+    use_belief_states=True,
+    output_target=True,
+    retrieval_candidates=None,
+    options_pool=None,
+    track_oov=False,
+    retrieval_index=False,
+):
+    """
+    Formats all the turns of a single dialog.
+
+    Input:
+    - dialog: a single element of the "dialogue_data" field
+    - retrieval_candidates: per-turn retrieval candidates of the dialog,
+      in which case options_pool should be the "system_transcript_pool"
+    - retrieval_index: output the domain and candidate indices of each turn
+      as a JSON line, rather than a flattened line per candidate
+
+    Output:
+    - (predicts, targets, retrieval_targets, oov), where the first three
+      are lists of lines and oov is a set of acts and slot names
+    """
+    predicts = []
+    targets = []
+    retrieval_targets = []
+    oov = set()
+
+    domain = dialog["domain"]
+    prev_asst_uttr = None
+    prev_turn = None
+    lst_context = []
+
+    for turn_id, turn in enumerate(dialog[FIELDNAME_DIALOG]):
+        user_uttr = turn.get(FIELDNAME_USER_UTTR, "").replace("\n", " ").strip()
+        user_belief = turn.get(FIELDNAME_BELIEF_STATE, {})
+        asst_uttr = turn.get(FIELDNAME_ASST_UTTR, "").replace("\n", " ").strip()
+
+        # Format main input context
+        context = ""
+        if prev_asst_uttr:
+            context += f"System : {prev_asst_uttr} "
             if use_multimodal_contexts:
-                visual_objects = turn[FIELDNAME_BELIEF_STATE]['act_attributes']['objects']
-                context += ' ' + represent_visual_objects(visual_objects)
-            """
-
-            # Concat with previous contexts
-            lst_context.append(context)
-            context = " ".join(lst_context[-len_context:])
-
-            # Format belief state
-            if use_belief_states:
-                belief_state = []
-                # for bs_per_frame in user_belief:
-                str_belief_state_per_frame = (
-                    "{act} [ {slot_values} ] ({request_slots}) < {objects} > | {disamb_candidates} |".format(
-                        act=user_belief.get("act", "").strip(),
-                        slot_values=", ".join(
-                            [
-                                f"{k.strip()} = {str(v).strip()}"
-                                for k, v in user_belief.get("act_attributes", {}).get(
-                                    "slot_values", {}
-                                ).items()
-                            ]
-                        ),
-                        request_slots=", ".join(
-                            user_belief.get("act_attributes", {}).get("request_slots", [])
-                        ),
-                        objects=", ".join(
-                            [str(o) for o in user_belief.get("act_attributes", {}).get("objects", [])]
-                        ),
-                        disamb_candidates=", ".join(
-                            [str(o) for o in user_belief.get("disambiguation_candidates", [])]
-                        ),
-                    )
-                )
-                belief_state.append(str_belief_state_per_frame)
+                # Add multimodal contexts
+                visual_objects = prev_turn[FIELDNAME_SYSTEM_STATE][
+                    "act_attributes"
+                ]["objects"]
+                context += represent_visual_objects(visual_objects) + " "
+
+        context += f"User : {user_uttr}"
+        prev_asst_uttr = asst_uttr
+        prev_turn = turn
+
+        # Add multimodal contexts -- user shouldn't have access to ground-truth
+        """
+        if use_multimodal_contexts:
+            visual_objects = turn[FIELDNAME_BELIEF_STATE]['act_attributes']['objects']
+            context += ' ' + represent_visual_objects(visual_objects)
+        """
 
-                # Track OOVs
-                if output_path_special_tokens != "":
-                    oov.add(user_belief.get("act", ""))
-                    for slot_name in user_belief.get("act_attributes", {}).get("slot_values", {}):
-                        oov.add(str(slot_name))
-                        # slot_name, slot_value = kv[0].strip(), kv[1].strip()
-                        # oov.add(slot_name)
-                        # oov.add(slot_value)
+        # Concat with previous contexts
+        lst_context.append(context)
+        context = " ".join(lst_context[-len_context:])
 
-                str_belief_state = " ".join(belief_state)
+        # Format belief state
+        if use_belief_states:
+            belief_state = []
+            # for bs_per_frame in user_belief:
+            str_belief_state_per_frame = (
+                "{act} [ {slot_values} ] ({request_slots}) < {objects} > | {disamb_candidates} |".format(
+                    act=user_belief.get("act", "").strip(),
+                    slot_values=", ".join(
+                        [
+                            f"{k.strip()} = {str(v).strip()}"
+                            for k, v in user_belief.get("act_attributes", {}).get(
+                                "slot_values", {}
+                            ).items()
+                        ]
+                    ),
+                    request_slots=", ".join(
+                        user_belief.get("act_attributes", {}).get("request_slots", [])
+                    ),
+                    objects=", ".join(
+                        [str(o) for o in user_belief.get("act_attributes", {}).get("objects", [])]
+                    ),
+                    disamb_candidates=", ".join(
+                        [str(o) for o in user_belief.get("disambiguation_candidates", [])]
+                    ),
+                )
+            )
+            belief_state.append(str_belief_state_per_frame)
+
+            # Track OOVs
+            if track_oov:
+                oov.add(user_belief.get("act", ""))
+                for slot_name in user_belief.get("act_attributes", {}).get("slot_values", {}):
+                    oov.add(str(slot_name))
+                    # slot_name, slot_value = kv[0].strip(), kv[1].strip()
+                    # oov.add(slot_name)
+                    # oov.add(slot_value)
+
+            str_belief_state = " ".join(belief_state)
+
+            # Format the main input
+            predict = TEMPLATE_PREDICT.format(
+                context=context,
+                START_BELIEF_STATE=START_BELIEF_STATE,
+            )
+            predicts.append(predict)
 
-                # Format the main input
-                predict = TEMPLATE_PREDICT.format(
+            # Format the main output
+            if output_target:
+                target = TEMPLATE_TARGET.format(
                     context=context,
                     START_BELIEF_STATE=START_BELIEF_STATE,
+                    belief_state=str_belief_state,
+                    END_OF_BELIEF=END_OF_BELIEF,
+                    response=asst_uttr,
+                    END_OF_SENTENCE=END_OF_SENTENCE,
                 )
-                predicts.append(predict)
-
-                # Format the main output
-                if output_target:
-                    target = TEMPLATE_TARGET.format(
-                        context=context,
-                        START_BELIEF_STATE=START_BELIEF_STATE,
-                        belief_state=str_belief_state,
-                        END_OF_BELIEF=END_OF_BELIEF,
-                        response=asst_uttr,
-                        END_OF_SENTENCE=END_OF_SENTENCE,
-                    )
-                    targets.append(target)
+                targets.append(target)
 
-                # NOTE: Retrieval options w/ belief states is not implemented.
-            else:
-                # Format the main input
-                predict = TEMPLATE_PREDICT_NOBELIEF.format(
-                    context=context, START_OF_RESPONSE=START_OF_RESPONSE
-                )
-                predicts.append(predict)
-
-                # Format the main output
-                if output_target:
-                    target = TEMPLATE_TARGET_NOBELIEF.format(
-                        context=context,
-                        response=asst_uttr,
-                        END_OF_SENTENCE=END_OF_SENTENCE,
-                        START_OF_RESPONSE=START_OF_RESPONSE,
-                    )
-                    targets.append(target)
+            # NOTE: Retrieval options w/ belief states is not implemented.
+        else:
+            # Format the main input
+            predict = TEMPLATE_PREDICT_NOBELIEF.format(
+                context=context, START_OF_RESPONSE=START_OF_RESPONSE
+            )
+            predicts.append(predict)
 
-                # Add retrieval options is necessary.
-                if format_retrieval_options:
-                    turn_options = (
-                        options_dict[dialog_id]["retrieval_candidates"][turn_id]
+            # Format the main output
+            if output_target:
+                target = TEMPLATE_TARGET_NOBELIEF.format(
+                    context=context,
+                    response=asst_uttr,
+                    END_OF_SENTENCE=END_OF_SENTENCE,
+                    START_OF_RESPONSE=START_OF_RESPONSE,
+                )
+                targets.append(target)
+
+            # Add retrieval options is necessary.
+            if retrieval_candidates is not None:
+                turn_options = retrieval_candidates[turn_id]
+                if retrieval_index:
+                    retrieval_targets.append(
+                        json.dumps(
+                            {
+                                "domain": domain,
+                                "candidates": turn_options["retrieval_candidates"],
+                            }
+                        )
                     )
+                else:
                     for option_ind in turn_options["retrieval_candidates"]:
                         retrieval_target = TEMPLATE_TARGET_NOBELIEF.format(
                             context=context,
@@ -228,44 +434,229 @@ def convert_json_to_flattened(
                         )
                         retrieval_targets.append(retrieval_target)
 
-    # Create a directory if it does not exist
-    directory = os.path.dirname(output_path_predict)
-    if not os.path.exists(directory):
-        os.makedirs(directory, exist_ok=True)
+    return predicts, targets, retrieval_targets, oov
 
-    directory = os.path.dirname(output_path_target)
-    if not os.path.exists(directory):
-        os.makedirs(directory, exist_ok=True)
 
-    # Output into text files
-    with open(output_path_predict, "w") as f_predict:
-        X = "\n".join(predicts)
-        f_predict.write(X)
+# Formatting options of the worker processes, set by _init_format_worker.
+_worker_options_pool = None
+_worker_format_kwargs = None
 
-    if output_target:
-        with open(output_path_target, "w") as f_target:
-            Y = "\n".join(targets)
-            f_target.write(Y)
 
-    # Write retrieval candidates if necessary.
-    if format_retrieval_options:
-        # Create a directory if it does not exist
-        directory = os.path.dirname(output_path_retrieval)
-        if not os.path.exists(directory):
-            os.makedirs(directory, exist_ok=True)
-        with open(output_path_retrieval, "w") as file_id:
-            file_id.write("\n".join(retrieval_targets))
+def _init_format_worker(options_pool, format_kwargs):
+    global _worker_options_pool, _worker_format_kwargs
+    _worker_options_pool = options_pool
+    _worker_format_kwargs = format_kwargs
 
-    if output_path_special_tokens != "":
-        # Create a directory if it does not exist
-        directory = os.path.dirname(output_path_special_tokens)
-        if not os.path.exists(directory):
-            os.makedirs(directory, exist_ok=True)
 
-        with open(output_path_special_tokens, "w") as f_special_tokens:
-            # Add oov's (acts and slot names, etc.) to special tokens as well
-            special_tokens["additional_special_tokens"].extend(list(oov))
-            json.dump(special_tokens, f_special_tokens)
+def _format_job(job):
+    dialog, retrieval_candidates = job
+    return format_dialog(
+        dialog,
+        retrieval_candidates=retrieval_candidates,
+        options_pool=_worker_options_pool,
+        **_worker_format_kwargs,
+    )
+
+
+def _iter_formatted(jobs, format_window, window_size):
+    """
+    Formats the dialogs one window at a time, in the original order.
+    Bounding the window keeps a streamed input from being read ahead all
+    at once.
+    """
+    for window in _iter_windows(jobs, window_size):
+        yield from format_window(window)
+
+
+def _iter_windows(iterable, window_size):
+    window = []
+    for item in iterable:
+        window.append(item)
+        if len(window) == window_size:
+            yield window
+            window = []
+    if window:
+        yield window
+
+
+def _file_identity(path):
+    if path is None:
+        return None
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+class _OutputCache:
+    """
+    Folder with the output files of previous runs, one entry per key (the
+    formatting options and the identity of the input files). Looking up an
+    entry does not read the inputs.
+    """
+
+    OOV_NAME = "oov.json"
+
+    def __init__(self, path, key):
+        self._path = path
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode("utf-8"))
+        self._entry_path = os.path.join(path, digest.hexdigest())
+
+    def load(self, outputs):
+        """
+        Copies the cached output files to their paths, and returns the OOV
+        tokens (None if there is no entry).
+        """
+        if not os.path.isdir(self._entry_path):
+            return None
+        for name, path in outputs.items():
+            directory = os.path.dirname(path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+            shutil.copyfile(os.path.join(self._entry_path, name), path)
+        with open(os.path.join(self._entry_path, self.OOV_NAME), "r") as file_id:
+            return set(json.load(file_id))
+
+    def save(self, outputs, oov):
+        os.makedirs(self._path, exist_ok=True)
+        # Fill a temporary folder first, so that an interrupted run never
+        # leaves a partial entry behind.
+        temp_path = tempfile.mkdtemp(dir=self._path)
+        for name, path in outputs.items():
+            shutil.copyfile(path, os.path.join(temp_path, name))
+        with open(os.path.join(temp_path, self.OOV_NAME), "w") as file_id:
+            json.dump(sorted(oov), file_id)
+        try:
+            os.rename(temp_path, self._entry_path)
+        except OSError:
+            # Saved by a concurrent run in the meantime.
+            shutil.rmtree(temp_path)
+
+
+def iter_dialogue_data(input_path_json, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Incrementally yields the dialogs in the "dialogue_data" field of a
+    SIMMC JSON file, holding at most one dialog (plus a read buffer)
+    in memory at a time.
+
+    Other top-level fields are skipped over; parsing stops at the end of
+    the "dialogue_data" list.
+    """
+    decoder = json.JSONDecoder()
+    with open(input_path_json, "r") as f_in:
+        reader = _StreamReader(f_in, decoder, chunk_size)
+        reader.expect("{")
+        while True:
+            reader.skip_whitespace()
+            if reader.peek() == "}":
+                raise ValueError(
+                    f"No 'dialogue_data' field found in {input_path_json}"
+                )
+            key = reader.decode()
+            reader.expect(":")
+            if key != "dialogue_data":
+                # Skip over the value of the other fields (e.g. "split").
+                reader.decode()
+                if reader.peek() == ",":
+                    reader.expect(",")
+                continue
+
+            reader.expect("[")
+            reader.skip_whitespace()
+            if reader.peek() == "]":
+                return
+            while True:
+                yield reader.decode()
+                reader.skip_whitespace()
+                if reader.peek() == "]":
+                    return
+                reader.expect(",")
+
+
+class _StreamReader:
+    """Minimal buffered reader for decoding JSON values one at a time."""
+
+    def __init__(self, file_id, decoder, chunk_size):
+        self._file_id = file_id
+        self._decoder = decoder
+        self._chunk_size = chunk_size
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self, size):
+        # Drop the consumed part of the buffer before reading more.
+        if self._pos:
+            self._buffer = self._buffer[self._pos:]
+            self._pos = 0
+        chunk = self._file_id.read(size)
+        if not chunk:
+            self._eof = True
+        self._buffer += chunk
+
+    def skip_whitespace(self):
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos].isspace():
+                self._pos += 1
+            if self._pos < len(self._buffer) or self._eof:
+                return
+            self._fill(self._chunk_size)
+
+    def peek(self):
+        self.skip_whitespace()
+        if self._pos >= len(self._buffer):
+            raise ValueError("Unexpected end of JSON input")
+        return self._buffer[self._pos]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(
+                f"Expected '{char}' but found '{self._buffer[self._pos]}'"
+            )
+        self._pos += 1
+
+    def decode(self):
+        self.skip_whitespace()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+                # A value ending right at the buffer boundary (e.g. a number)
+                # may continue in the next chunk.
+                if end < len(self._buffer) or self._eof:
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            # Grow the read size with the pending value to keep it linear.
+            self._fill(max(self._chunk_size, len(self._buffer) - self._pos))
+
+
+class _LineWriter:
+    """
+    Writes lines separated by newlines (without a trailing one), so that
+    the output matches "\\n".join(lines) without materializing the list.
+    """
+
+    def __init__(self, path):
+        self._file_id = open(path, "w")
+        self._first = True
+
+    def write_lines(self, lines):
+        for line in lines:
+            if not self._first:
+                self._file_id.write("\n")
+            self._file_id.write(line)
+            self._first = False
+
+    def close(self):
+        self._file_id.close()
+
+
+def _open_for_write(path):
+    # Create a directory if it does not exist
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    return _LineWriter(path)
 
 
 def represent_visual_objects(object_ids):
@@ -292,13 +683,50 @@ def represent_visual_objects(object_ids):
 
 
 def parse_flattened_results_from_file(path):
-    results = []
+    return list(iter_flattened_results_from_file(path))
+
+
+def iter_flattened_results_from_file(
+    path,
+    pool=None,
+    chunk_size=PARSE_CHUNK_SIZE,
+    max_pending_chunks=PARSE_MAX_PENDING_CHUNKS,
+):
+    """
+    Lazily yields the parsed belief state of each line of a file.
+
+    If a multiprocessing pool is given, lines are parsed by the pool in
+    chunks of chunk_size and yielded in the original order. At most
+    max_pending_chunks chunks are read ahead of the consumer.
+    """
     with open(path, "r") as f_in:
-        for line in f_in:
-            parsed = parse_flattened_result(line)
-            results.append(parsed)
+        if pool is None:
+            for line in f_in:
+                yield parse_flattened_result(line)
+            return
+
+        pending = collections.deque()
+        for chunk in _iter_windows(f_in, chunk_size):
+            pending.append(pool.apply_async(_parse_chunk, (chunk,)))
+            if len(pending) == max_pending_chunks:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
 
-    return results
+
+def _parse_chunk(lines):
+    return [parse_flattened_result(line) for line in lines]
+
+
+# Belief state parser, compiled once at import time
+DIALOG_ACT_REGEX = re.compile(
+    r"([\w:?.?]*)  *\[(.*)\] *\(([^\]]*)\) *\<([^\]]*)\> *\|([^\]]*)\|"
+)
+SLOT_REGEX = re.compile(r"([A-Za-z0-9_.-:]*)  *= (\[(.*)\]|[^,]*)")
+REQUEST_REGEX = re.compile(r"[A-Za-z0-9_.-:]+")
+# Object and disambiguation candidate IDs should always be <int>: only keep
+# the alphanumeric tokens that consist of digits only.
+OBJECT_ID_REGEX = re.compile(r"(?<![A-Za-z0-9])[0-9]+(?![A-Za-z0-9])")
 
 
 def parse_flattened_result(to_parse):
@@ -322,64 +750,34 @@ def parse_flattened_result(to_parse):
             }, ...  # End of a frame
         ]  # End of a dialog
     """
-    dialog_act_regex = re.compile(
-        r'([\w:?.?]*)  *\[(.*)\] *\(([^\]]*)\) *\<([^\]]*)\> *\|([^\]]*)\|'
-    )    
-    
-    slot_regex = re.compile(r"([A-Za-z0-9_.-:]*)  *= (\[(.*)\]|[^,]*)")
-    request_regex = re.compile(r"([A-Za-z0-9_.-:]+)")
-    object_regex = re.compile(r"([A-Za-z0-9]+)")
-    disamb_candidate_regex = re.compile(r"([A-Za-z0-9]+)")
-
     belief = []
 
-    # Parse
-    splits = to_parse.strip().split(START_BELIEF_STATE)
-    if len(splits) == 2:
-        to_parse = splits[1].strip()
-        splits = to_parse.split(END_OF_BELIEF)
-
-        if len(splits) == 2:
-            # to_parse: 'DIALOG_ACT_1 : [ SLOT_NAME = SLOT_VALUE, ... ] ...'
-            to_parse = splits[0].strip()
-
-            for dialog_act in dialog_act_regex.finditer(to_parse):
-                d = {
-                    "act": dialog_act.group(1),
-                    "slots": [],
-                    "request_slots": [],
-                    "objects": [],
-                    "disambiguation_candidates": [],
-                }
-
-                for slot in slot_regex.finditer(dialog_act.group(2)):
-                    d["slots"].append([slot.group(1).strip(), slot.group(2).strip()])
-
-                for request_slot in request_regex.finditer(dialog_act.group(3)):
-                    d["request_slots"].append(request_slot.group(1).strip())
-
-                for object_id in object_regex.finditer(dialog_act.group(4)):
-                    str_object_id = object_id.group(1).strip()
-
-                    try:
-                        # Object ID should always be <int>.
-                        int_object_id = int(str_object_id)
-                        d["objects"].append(int_object_id)
-                    except:
-                        pass
-
-                for disamb_candidate_id in disamb_candidate_regex.finditer(dialog_act.group(5)):
-                    str_disamb_candidate_id = disamb_candidate_id.group(1).strip()
-
-                    try:
-                        # disamb_candidate ID should always be <int>.
-                        int_disamb_candidate_id = int(str_disamb_candidate_id)
-                        d["disambiguation_candidates"].append(int_disamb_candidate_id)
-                    except:
-                        pass
-
-                if d != {}:
-                    belief.append(d)
+    # Parse: both markers should appear exactly once.
+    _, found, to_parse = to_parse.partition(START_BELIEF_STATE)
+    if not found or START_BELIEF_STATE in to_parse:
+        return belief
+    to_parse, found, rest = to_parse.strip().partition(END_OF_BELIEF)
+    if not found or END_OF_BELIEF in rest:
+        return belief
+
+    # to_parse: 'DIALOG_ACT_1 : [ SLOT_NAME = SLOT_VALUE, ... ] ...'
+    for act, slots, request_slots, objects, candidates in DIALOG_ACT_REGEX.findall(
+        to_parse.strip()
+    ):
+        belief.append(
+            {
+                "act": act,
+                "slots": [
+                    [slot.group(1).strip(), slot.group(2).strip()]
+                    for slot in SLOT_REGEX.finditer(slots)
+                ],
+                "request_slots": REQUEST_REGEX.findall(request_slots),
+                "objects": [int(ii) for ii in OBJECT_ID_REGEX.findall(objects)],
+                "disambiguation_candidates": [
+                    int(ii) for ii in OBJECT_ID_REGEX.findall(candidates)
+                ],
+            }
+        )
 
     return belief
 
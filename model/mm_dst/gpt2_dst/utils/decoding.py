@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+This source code is licensed under the license found in the LICENSE file in the
+root directory of this source tree.
+
+    Decoding utilities for the GPT-2 based DST model baseline.
+
+    decode_batch() generates for a batch of (left-padded) prompts, stops each
+    sequence as soon as it emits one of the stop tokens (e.g. <EOB>), and
+    drops the finished sequences from the batch. BeliefStateGrammar optionally
+    constrains the decoding of the belief state to the format expected by
+    parse_flattened_result():
+
+        act [ slot = value, ... ] (request_slots) < objects > | candidates |
+"""
+import re
+
+import torch
+
+from gpt2_dst.utils.convert import END_OF_BELIEF, START_BELIEF_STATE
+
+# Dialog acts and slot names of the SIMMC 2 belief states. The grammar also
+# accepts the ones added to the tokenizer as special tokens.
+DIALOG_ACTS = (
+    "ASK:GET",
+    "CONFIRM:ADD_TO_CART",
+    "INFORM:COMPARE",
+    "INFORM:DISAMBIGUATE",
+    "INFORM:GET",
+    "INFORM:REFINE",
+    "REQUEST:ADD_TO_CART",
+    "REQUEST:COMPARE",
+    "REQUEST:DISAMBIGUATE",
+    "REQUEST:GET",
+)
+SLOT_NAMES = (
+    "availableSizes",
+    "brand",
+    "color",
+    "customerRating",
+    "customerReview",
+    "materials",
+    "pattern",
+    "price",
+    "size",
+    "sleeveLength",
+    "type",
+)
+
+# Characters that delimit the parts of a flattened belief state.
+STRUCTURAL_CHARS = "[]()<>|"
+# Characters of the slot values, besides the list separators.
+VALUE_CHARS = frozenset(
+    chr(ii) for ii in range(32, 127) if chr(ii) not in STRUCTURAL_CHARS + ",="
+)
+
+# Bounds of the grammar, so that any belief state ends within 2048 tokens.
+# The SIMMC 2 belief states stay below them (up to 7 slots, 2 request slots
+# and 43 objects).
+MAX_SPACES = 2
+MAX_SLOTS = 8
+MAX_VALUE_TOKENS = 24
+MAX_REQUEST_SLOTS = 8
+MAX_OBJECTS = 64
+MAX_OBJECT_ID_DIGITS = 4
+
+# Stages of the belief state grammar, in order. States are
+# (stage, list part, text or counter, # of items) tuples, and the stages of
+# SPACE_STAGES allow up to MAX_SPACES spaces (counted by the third entry)
+# before their delimiter.
+(
+    STAGE_BEFORE_ACT,
+    STAGE_ACT,
+    STAGE_BEFORE_SLOTS,
+    STAGE_BEFORE_SLOT,
+    STAGE_SLOT_NAME,
+    STAGE_BEFORE_EQUALS,
+    STAGE_AFTER_EQUALS,
+    STAGE_VALUE,
+    STAGE_LIST_VALUE,
+    STAGE_AFTER_VALUE,
+    STAGE_BEFORE_LIST,
+    STAGE_BEFORE_ITEM,
+    STAGE_ITEM,
+    STAGE_AFTER_ITEM,
+    STAGE_BEFORE_END,
+    STAGE_DONE,
+) = range(16)
+SPACE_STAGES = frozenset(
+    (
+        STAGE_BEFORE_ACT,
+        STAGE_BEFORE_SLOTS,
+        STAGE_BEFORE_SLOT,
+        STAGE_BEFORE_EQUALS,
+        STAGE_AFTER_VALUE,
+        STAGE_BEFORE_LIST,
+        STAGE_BEFORE_ITEM,
+        STAGE_AFTER_ITEM,
+        STAGE_BEFORE_END,
+    )
+)
+
+# Parts after the slots: (opening, closing, items are slot names, max items).
+LIST_PARTS = (
+    ("(", ")", True, MAX_REQUEST_SLOTS),
+    ("<", ">", False, MAX_OBJECTS),
+    ("|", "|", False, MAX_OBJECTS),  # Disambiguation candidates.
+)
+
+
+def _prefixes(names):
+    return frozenset(name[:ii] for name in names for ii in range(1, len(name) + 1))
+
+
+class BeliefStateGrammar:
+    """
+    Token-level constraint for decoding belief states.
+
+    The belief state is checked character by character: the dialog act and
+    the slot names come from the known vocabulary, slot values are lists or
+    free text of at most MAX_VALUE_TOKENS tokens, and the request slots,
+    objects and candidates are lists of slot names and object IDs. Spaces,
+    slots and list items are bounded too, so that any sequence of allowed
+    tokens reaches <EOB>. The allowed token mask of each state is memoized,
+    and only scans the tokens whose first character is allowed.
+    """
+
+    def __init__(self, tokenizer, vocab_size=None, acts=None, slots=None):
+        vocab_size = vocab_size or len(tokenizer)
+        self.end_of_belief_id = tokenizer.convert_tokens_to_ids(END_OF_BELIEF)
+        # Dialog acts and slots are added as special tokens, and can be decoded
+        # like any other token. Markers such as <SOM> or <EOS> cannot.
+        added_tokens = [
+            token
+            for token in tokenizer.additional_special_tokens
+            if not any(char in STRUCTURAL_CHARS for char in token)
+        ]
+        if acts is None:
+            acts = set(DIALOG_ACTS)
+            acts.update(token for token in added_tokens if ":" in token)
+        if slots is None:
+            slots = set(SLOT_NAMES)
+            slots.update(
+                token for token in added_tokens if re.fullmatch(r"[A-Za-z_]+", token)
+            )
+        self.acts = frozenset(acts)
+        self.slots = frozenset(slots)
+        self._act_prefixes = _prefixes(self.acts)
+        self._slot_prefixes = _prefixes(self.slots)
+
+        disallowed_ids = set(tokenizer.all_special_ids) - set(
+            tokenizer.additional_special_tokens_ids
+        )
+        disallowed_ids.add(self.end_of_belief_id)
+
+        # Token texts, grouped by their first character. Predictions are
+        # written one per line, and empty tokens would not advance the state.
+        self.token_texts = []
+        self._tokens_by_first_char = {}
+        for token_id in range(vocab_size):
+            text = None
+            if token_id not in disallowed_ids and token_id < len(tokenizer):
+                text = tokenizer.decode([token_id])
+                if not text or "\n" in text or "\r" in text:
+                    text = None
+            self.token_texts.append(text)
+            if text is not None:
+                self._tokens_by_first_char.setdefault(text[0], []).append(token_id)
+        self._masks = {}
+
+    def initial_state(self, prompt_text):
+        """Constrains the decoding only if the prompt asks for a belief state."""
+        if prompt_text.rstrip().endswith(START_BELIEF_STATE):
+            return (STAGE_BEFORE_ACT, 0, 0, 0)
+        return (STAGE_DONE, 0, 0, 0)
+
+    def _name(self, state, name, prefixes):
+        stage, part, _, count = state
+        return (stage, part, name, count) if name in prefixes else None
+
+    def _step(self, state, char):
+        """Returns the state after a character, or None if it is not allowed."""
+        stage, part, value, count = state
+        if stage in SPACE_STAGES and char == " ":
+            return (stage, part, value + 1, count) if value < MAX_SPACES else None
+
+        if stage == STAGE_BEFORE_ACT:
+            return self._name((STAGE_ACT, 0, "", 0), char, self._act_prefixes)
+        if stage == STAGE_ACT:
+            # Dialog act names are followed by at least one space.
+            if char == " ":
+                return (STAGE_BEFORE_SLOTS, 0, 1, 0) if value in self.acts else None
+            return self._name(state, value + char, self._act_prefixes)
+        if stage == STAGE_BEFORE_SLOTS:
+            return (STAGE_BEFORE_SLOT, 0, 0, 0) if char == "[" else None
+
+        # Slots: [ name = value, name = [ list ], ... ]
+        if stage == STAGE_BEFORE_SLOT:
+            # Only empty slots can be closed right after the "[".
+            if char == "]" and count == 0:
+                return (STAGE_BEFORE_LIST, 0, 0, 0)
+            return self._name(
+                (STAGE_SLOT_NAME, 0, "", count), char, self._slot_prefixes
+            )
+        if stage == STAGE_SLOT_NAME:
+            if char == " ":
+                if value not in self.slots:
+                    return None
+                return (STAGE_BEFORE_EQUALS, 0, 1, count)
+            return self._name(state, value + char, self._slot_prefixes)
+        if stage == STAGE_BEFORE_EQUALS:
+            return (STAGE_AFTER_EQUALS, 0, 0, count) if char == "=" else None
+        if stage == STAGE_AFTER_EQUALS:
+            # The parser expects exactly one space after the "=", and the
+            # value starts with the current token.
+            if value == 0:
+                return (stage, 0, 1, count) if char == " " else None
+            if char == "[":
+                return (STAGE_LIST_VALUE, 0, 1, count)
+            if char in VALUE_CHARS and char != " ":
+                return (STAGE_VALUE, 0, 1, count)
+            return None
+        if stage == STAGE_VALUE:
+            if char in VALUE_CHARS and value is not None:
+                return state
+            # Once out of tokens (value is None), only the separator can follow.
+            if char == " ":
+                return (STAGE_AFTER_VALUE, 0, 1, count + 1)
+            return self._end_slot(char, count + 1)
+        if stage == STAGE_LIST_VALUE:
+            if char == "]":
+                return (STAGE_AFTER_VALUE, 0, 0, count + 1)
+            if value is not None and (char in VALUE_CHARS or char == ","):
+                return state
+            return None
+        if stage == STAGE_AFTER_VALUE:
+            return self._end_slot(char, count)
+
+        # Request slots, objects and candidates: ( name, ... ) < id, ... >
+        opening, closing, named, _ = LIST_PARTS[part]
+        if stage == STAGE_BEFORE_LIST:
+            return (STAGE_BEFORE_ITEM, part, 0, 0) if char == opening else None
+        if stage == STAGE_BEFORE_ITEM:
+            # Only empty lists can be closed right after the opening.
+            if char == closing and count == 0:
+                return self._end_list(part)
+            if named:
+                return self._name(
+                    (STAGE_ITEM, part, "", count), char, self._slot_prefixes
+                )
+            # Object IDs only keep their # of digits.
+            return (STAGE_ITEM, part, 1, count) if char.isdigit() else None
+        if stage == STAGE_ITEM:
+            if named and value + char in self._slot_prefixes:
+                return (stage, part, value + char, count)
+            if not named and char.isdigit():
+                if value < MAX_OBJECT_ID_DIGITS:
+                    return (stage, part, value + 1, count)
+                return None
+            if named and value not in self.slots:
+                return None
+            if char == " ":
+                return (STAGE_AFTER_ITEM, part, 1, count + 1)
+            return self._end_item(part, char, count + 1)
+        if stage == STAGE_AFTER_ITEM:
+            return self._end_item(part, char, count)
+        return None
+
+    def _end_slot(self, char, count):
+        if char == "," and count < MAX_SLOTS:
+            return (STAGE_BEFORE_SLOT, 0, 0, count)
+        if char == "]":
+            return (STAGE_BEFORE_LIST, 0, 0, 0)
+        return None
+
+    def _end_item(self, part, char, count):
+        if char == "," and count < LIST_PARTS[part][3]:
+            return (STAGE_BEFORE_ITEM, part, 0, count)
+        if char == LIST_PARTS[part][1]:
+            return self._end_list(part)
+        return None
+
+    def _end_list(self, part):
+        if part + 1 < len(LIST_PARTS):
+            return (STAGE_BEFORE_LIST, part + 1, 0, 0)
+        return (STAGE_BEFORE_END, 0, 0, 0)
+
+    def _advance(self, state, text):
+        """Returns the state after a token, or None if it is not allowed."""
+        stage, part, value, count = state
+        if stage in (STAGE_VALUE, STAGE_LIST_VALUE) and value is not None:
+            # Slot values are bounded in tokens rather than characters, and
+            # then have to end (see _step).
+            value = value + 1 if value < MAX_VALUE_TOKENS else None
+            state = (stage, part, value, count)
+        for char in text:
+            state = self._step(state, char)
+            if state is None:
+                return None
+        return state
+
+    @staticmethod
+    def _mask_key(state):
+        """The token count of a slot value only matters once it is exhausted."""
+        stage, part, value, count = state
+        if stage in (STAGE_VALUE, STAGE_LIST_VALUE) and value is not None:
+            if value < MAX_VALUE_TOKENS:
+                return (stage, part, 0, count)
+        return state
+
+    def _compile(self, state):
+        mask = torch.zeros(len(self.token_texts), dtype=torch.bool)
+        for char, token_ids in self._tokens_by_first_char.items():
+            if self._advance(state, char) is None:
+                continue
+            for token_id in token_ids:
+                if self._advance(state, self.token_texts[token_id]) is not None:
+                    mask[token_id] = True
+        if state[0] == STAGE_BEFORE_END:
+            mask[self.end_of_belief_id] = True
+        self._masks[state] = mask
+
+    def allowed_tokens(self, states):
+        """Returns a [len(states), vocab_size] mask of the allowed next tokens."""
+        masks = []
+        for state in states:
+            if state[0] == STAGE_DONE:
+                masks.append(None)
+                continue
+            state = self._mask_key(state)
+            if state not in self._masks:
+                self._compile(state)
+            masks.append(self._masks[state])
+        if all(mask is None for mask in masks):
+            return None
+        full = torch.ones(len(self.token_texts), dtype=torch.bool)
+        return torch.stack([full if mask is None else mask for mask in masks])
+
+    def next_state(self, state, token_id):
+        if state[0] == STAGE_DONE:
+            return state
+        if token_id == self.end_of_belief_id:
+            return (STAGE_DONE, 0, 0, 0)
+        text = self.token_texts[token_id] if token_id < len(self.token_texts) else None
+        next_state = None if text is None else self._advance(state, text)
+        # Only reachable if the mask was not applied (e.g. beyond the vocab).
+        return next_state if next_state is not None else state
+
+
+def _select_rows(past_key_values, index):
+    """Keeps the given batch rows of the cached attention keys and values."""
+    if hasattr(past_key_values, "reorder_cache"):
+        past_key_values.reorder_cache(index)
+        return past_key_values
+    if isinstance(past_key_values, torch.Tensor):
+        return past_key_values.index_select(0, index)
+    return tuple(_select_rows(ii, index) for ii in past_key_values)
+
+
+def decode_batch(
+    model,
+    input_ids,
+    attention_mask,
+    max_new_tokens,
+    stop_token_ids=(),
+    logits_processor=None,
+    logits_warper=None,
+    do_sample=True,
+    grammar=None,
+    grammar_states=None,
+    past_key_values=None,
+):
+    """
+    Generates up to max_new_tokens for a batch of left-padded prompts.
+
+    A sequence is finished as soon as it emits one of stop_token_ids, and
+    finished sequences are dropped from the batch, so that they no longer
+    consume any compute. If a grammar is given, each next token is
+    restricted to the ones allowed by the grammar state of its sequence.
+    past_key_values may hold the cached keys and values of the first tokens
+    of the prompts (see prefix_cache.py), which are then not encoded again.
+
+    Returns the list of generated token ids (stop token included) per row.
+    """
+    device = input_ids.device
+    stop_token_ids = set(ii for ii in stop_token_ids if ii is not None)
+    generated = [[] for _ in range(input_ids.size(0))]
+    rows = torch.arange(input_ids.size(0), device=device)
+    if grammar is not None:
+        grammar_states = list(grammar_states)
+
+    sequences = input_ids
+    past_length = 0 if past_key_values is None else past_key_values[0][0].size(2)
+    position_ids = (attention_mask.long().cumsum(-1) - 1).clamp(min=0)
+    position_ids = position_ids[:, past_length:]
+    model_inputs = input_ids[:, past_length:]
+
+    for _ in range(max_new_tokens):
+        outputs = model(
+            input_ids=model_inputs,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past_key_values,
+            use_cache=True,
+        )
+        scores = outputs[0][:, -1, :]
+        past_key_values = outputs[1]
+
+        if logits_processor is not None:
+            scores = logits_processor(sequences, scores)
+        if grammar is not None:
+            allowed = grammar.allowed_tokens(grammar_states)
+            if allowed is not None:
+                allowed = allowed.to(device)
+                scores = scores.masked_fill(~allowed, -float("inf"))
+        if do_sample:
+            if logits_warper is not None:
+                scores = logits_warper(sequences, scores)
+            probs = torch.nn.functional.softmax(scores, dim=-1)
+            next_tokens = torch.multinomial(probs, num_samples=1).squeeze(1)
+        else:
+            next_tokens = torch.argmax(scores, dim=-1)
+
+        next_token_list = next_tokens.tolist()
+        finished = []
+        for batch_index, (row, token_id) in enumerate(
+            zip(rows.tolist(), next_token_list)
+        ):
+            generated[row].append(token_id)
+            if grammar is not None:
+                grammar_states[batch_index] = grammar.next_state(
+                    grammar_states[batch_index], token_id
+                )
+            finished.append(token_id in stop_token_ids)
+
+        sequences = torch.cat([sequences, next_tokens[:, None]], dim=-1)
+        attention_mask = torch.cat(
+            [attention_mask, attention_mask.new_ones((attention_mask.size(0), 1))],
+            dim=-1,
+        )
+        position_ids = position_ids[:, -1:] + 1
+        model_inputs = next_tokens[:, None]
+
+        if any(finished):
+            keep = [ii for ii, is_finished in enumerate(finished) if not is_finished]
+            if not keep:
+                break
+            index = torch.tensor(keep, device=device)
+            rows = rows[index]
+            sequences = sequences[index]
+            attention_mask = attention_mask[index]
+            position_ids = position_ids[index]
+            model_inputs = model_inputs[index]
+            past_key_values = _select_rows(past_key_values, index)
+            if grammar is not None:
+                grammar_states = [grammar_states[ii] for ii in keep]
+
+    return generated
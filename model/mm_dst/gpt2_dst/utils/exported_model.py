@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+This source code is licensed under the license found in the LICENSE file in the
+root directory of this source tree.
+
+    Runtime for GPT-2 DST models exported by gpt2_dst/scripts/export_model.py.
+
+    The exported graph (TorchScript or ONNX) maps
+
+        (input_ids, attention_mask, position_ids, past) -> (logits, present)
+
+    where past and present stack the attention keys and values of all the
+    layers as [num_layers, 2, batch_size, num_heads, length, head_size].
+    ExportedGPT2 only needs torch (and onnxruntime for ONNX graphs), not
+    transformers, and decodes greedily with the keys and values cached
+    across steps.
+"""
+import json
+import os
+
+import torch
+
+EXPORT_CONFIG_NAME = "export_config.json"
+INPUT_NAMES = ["input_ids", "attention_mask", "position_ids", "past"]
+OUTPUT_NAMES = ["logits", "present"]
+
+
+class ExportedGPT2:
+    def __init__(self, export_dir):
+        with open(os.path.join(export_dir, EXPORT_CONFIG_NAME), "r") as file_id:
+            self.config = json.load(file_id)
+        graph_path = os.path.join(export_dir, self.config["graph_file"])
+        self._session = None
+        self._module = None
+        if self.config["format"] == "onnx":
+            # Only needed to run ONNX graphs.
+            import onnxruntime
+
+            self._session = onnxruntime.InferenceSession(
+                graph_path, providers=["CPUExecutionProvider"]
+            )
+        else:
+            self._module = torch.jit.load(graph_path, map_location="cpu")
+
+    def empty_past(self, batch_size):
+        return torch.zeros(
+            (
+                self.config["num_layers"],
+                2,
+                batch_size,
+                self.config["num_heads"],
+                0,
+                self.config["head_size"],
+            )
+        )
+
+    def forward(self, input_ids, attention_mask, position_ids, past):
+        """Returns the logits of input_ids and the keys and values of all tokens."""
+        if self._session is not None:
+            inputs = (input_ids, attention_mask, position_ids, past)
+            logits, present = self._session.run(
+                OUTPUT_NAMES,
+                {name: tensor.numpy() for name, tensor in zip(INPUT_NAMES, inputs)},
+            )
+            return torch.from_numpy(logits), torch.from_numpy(present)
+        with torch.no_grad():
+            return self._module(input_ids, attention_mask, position_ids, past)
+
+    def generate(self, prompts, max_new_tokens, stop_token_ids=()):
+        """
+        Greedily generates up to max_new_tokens for a batch of prompts (lists
+        of token ids), which are left-padded.
+
+        Returns the list of generated token ids (stop token included) per prompt.
+        """
+        max_length = max(len(ii) for ii in prompts)
+        pad_token_id = self.config["pad_token_id"]
+        input_ids = torch.tensor(
+            [[pad_token_id] * (max_length - len(ii)) + ii for ii in prompts]
+        )
+        attention_mask = torch.tensor(
+            [[0] * (max_length - len(ii)) + [1] * len(ii) for ii in prompts]
+        )
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        past = self.empty_past(len(prompts))
+
+        generated = [[] for _ in prompts]
+        finished = [False] * len(prompts)
+        for _ in range(max_new_tokens):
+            logits, past = self.forward(input_ids, attention_mask, position_ids, past)
+            next_tokens = torch.argmax(logits[:, -1, :], dim=-1)
+            for index, token_id in enumerate(next_tokens.tolist()):
+                if not finished[index]:
+                    generated[index].append(token_id)
+                    finished[index] = token_id in stop_token_ids
+            if all(finished):
+                break
+            input_ids = next_tokens[:, None]
+            position_ids = position_ids[:, -1:] + 1
+            attention_mask = torch.cat(
+                [attention_mask, attention_mask.new_ones((len(prompts), 1))], dim=-1
+            )
+        return generated
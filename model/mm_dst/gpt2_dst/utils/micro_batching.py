@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+This source code is licensed under the license found in the LICENSE file in the
+root directory of this source tree.
+
+    Dynamic micro-batching for the inference server (run_server.py).
+
+    Requests submitted to a MicroBatcher are queued, and coalesced into
+    batches of up to max_batch_size requests: a batch is closed as soon as
+    it is full, or max_wait_ms after its first request arrived. Batches run
+    one at a time on a worker thread, so that the event loop keeps accepting
+    (and queueing) requests in the meantime. If a batch fails, all of its
+    requests get the exception.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import time
+
+# Number of recent requests the latency percentiles are computed over.
+LATENCY_WINDOW = 1000
+
+
+class ServingStats:
+    """Request, batch and latency counters of a MicroBatcher."""
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.num_requests = 0
+        self.num_errors = 0
+        self.num_batches = 0
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+
+    def record_batch(self, latencies, failed=False):
+        """Records the latencies of the requests of a batch, unless it failed."""
+        self.num_batches += 1
+        if failed:
+            self.num_errors += len(latencies)
+        else:
+            self.num_requests += len(latencies)
+            self.latencies.extend(latencies)
+
+    def snapshot(self):
+        """Returns the counters, with latency percentiles in milliseconds."""
+        latencies = sorted(self.latencies)
+        num_batched = self.num_requests + self.num_errors
+        uptime = time.time() - self.start_time
+        snapshot = {
+            "num_requests": self.num_requests,
+            "num_errors": self.num_errors,
+            "num_batches": self.num_batches,
+            "mean_batch_size": num_batched / max(self.num_batches, 1),
+            "requests_per_second": self.num_requests / max(uptime, 1e-9),
+            "uptime_seconds": uptime,
+        }
+        for percentile in (50, 90, 99):
+            key = f"latency_p{percentile}_ms"
+            if not latencies:
+                snapshot[key] = None
+                continue
+            index = min(len(latencies) - 1, len(latencies) * percentile // 100)
+            snapshot[key] = 1000 * latencies[index]
+        return snapshot
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent requests into batches for process_batch, which maps
+    a list of requests to the list of their results.
+    """
+
+    def __init__(self, process_batch, max_batch_size, max_wait_ms):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.stats = ServingStats()
+        self._queue = asyncio.Queue()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    async def submit(self, request):
+        """Returns the result of a request, once its batch is processed."""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((request, future, time.perf_counter()))
+        return await future
+
+    async def _next_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # Also take whatever is already queued, up to max_batch_size.
+        while len(batch) < self.max_batch_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def run(self):
+        """Processes batches until cancelled."""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            requests = [request for request, _, _ in batch]
+            try:
+                results = await loop.run_in_executor(
+                    self._executor, self.process_batch, requests
+                )
+            except Exception as error:
+                results = None
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(error)
+            else:
+                for (_, future, _), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+
+            end_time = time.perf_counter()
+            self.stats.record_batch(
+                [end_time - start_time for _, _, start_time in batch],
+                failed=results is None,
+            )
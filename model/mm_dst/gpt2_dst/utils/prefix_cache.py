@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+This source code is licensed under the license found in the LICENSE file in the
+root directory of this source tree.
+
+    Prompt prefix cache for the GPT-2 based DST model baseline.
+
+    Consecutive turns of a dialog (and all the retrieval candidates of a turn)
+    share long prompt prefixes. PrefixCache keeps the attention keys and
+    values (past_key_values) of recent prompts in a trie of token ids, so that
+    only the tokens after the longest cached prefix need to be encoded.
+"""
+import collections
+
+import torch
+
+
+class _TrieNode:
+    __slots__ = ("children", "entry_id")
+
+    def __init__(self):
+        self.children = {}
+        # Any cached entry whose tokens go through this node.
+        self.entry_id = None
+
+
+def slice_past(past_key_values, length):
+    """Keeps the cached keys and values of the first length tokens."""
+    return tuple(
+        tuple(tensor[:, :, :length] for tensor in layer) for layer in past_key_values
+    )
+
+
+def expand_past(past_key_values, expand_size):
+    """Repeats each row of the cached keys and values expand_size times."""
+    if expand_size == 1:
+        return past_key_values
+    return tuple(
+        tuple(tensor.repeat_interleave(expand_size, dim=0) for tensor in layer)
+        for layer in past_key_values
+    )
+
+
+def select_past(past_key_values, indices):
+    """Gathers the rows of the cached keys and values given by indices."""
+    return tuple(
+        tuple(tensor.index_select(0, indices) for tensor in layer)
+        for layer in past_key_values
+    )
+
+
+def _num_bytes(past_key_values, token_nlls):
+    num_bytes = sum(
+        tensor.numel() * tensor.element_size()
+        for layer in past_key_values
+        for tensor in layer
+    )
+    if token_nlls is not None:
+        num_bytes += token_nlls.numel() * token_nlls.element_size()
+    return num_bytes
+
+
+class PrefixCache:
+    """
+    Trie of token ids mapped to the past_key_values of a single sequence,
+    with LRU eviction once the cached tensors exceed max_bytes.
+
+    An entry can be reused for any prefix it shares with a new sequence:
+    its keys and values are sliced to the length of the common prefix.
+    Entries may also keep the negative log-likelihood of each of their tokens
+    (token_nlls[0] is unused), which is sliced the same way.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.root = _TrieNode()
+        # entry_id -> (token_ids, past_key_values, token_nlls, num_bytes)
+        self.entries = collections.OrderedDict()
+        self.next_entry_id = 0
+        self.num_lookups = 0
+        self.num_reused_tokens = 0
+        self.num_tokens = 0
+
+    def lookup(self, token_ids, max_length=None):
+        """
+        Returns (length, past_key_values, token_nlls) for the longest cached
+        prefix of token_ids, up to max_length tokens, or (0, None, None).
+        """
+        max_length = len(token_ids) if max_length is None else max_length
+        node = self.root
+        length = 0
+        for token_id in token_ids[:max_length]:
+            child = node.children.get(token_id)
+            if child is None:
+                break
+            node = child
+            length += 1
+
+        self.num_lookups += 1
+        self.num_tokens += len(token_ids)
+        if length == 0:
+            return 0, None, None
+        self.num_reused_tokens += length
+        self.entries.move_to_end(node.entry_id)
+        _, past_key_values, token_nlls, _ = self.entries[node.entry_id]
+        if token_nlls is not None:
+            token_nlls = token_nlls[:length]
+        return length, slice_past(past_key_values, length), token_nlls
+
+    def insert(self, token_ids, past_key_values, token_nlls=None):
+        """Caches the past_key_values (and token_nlls) of token_ids."""
+        if not token_ids or self._is_cached(token_ids):
+            return
+        # Copy slices, which would otherwise keep their whole storage alive.
+        past_key_values = tuple(
+            tuple(tensor.detach().contiguous() for tensor in layer)
+            for layer in past_key_values
+        )
+        num_bytes = _num_bytes(past_key_values, token_nlls)
+        if num_bytes > self.max_bytes:
+            return
+
+        entry_id = self.next_entry_id
+        self.next_entry_id += 1
+        node = self.root
+        for token_id in token_ids:
+            node = node.children.setdefault(token_id, _TrieNode())
+            node.entry_id = entry_id
+        self.entries[entry_id] = (tuple(token_ids), past_key_values, token_nlls, num_bytes)
+        self.num_bytes += num_bytes
+
+        while self.num_bytes > self.max_bytes:
+            self._evict(next(iter(self.entries)))
+
+    def _is_cached(self, token_ids):
+        node = self.root
+        for token_id in token_ids:
+            node = node.children.get(token_id)
+            if node is None:
+                return False
+        return True
+
+    def _evict(self, entry_id):
+        token_ids, _, _, num_bytes = self.entries.pop(entry_id)
+        self.num_bytes -= num_bytes
+
+        path = [self.root]
+        for token_id in token_ids:
+            path.append(path[-1].children[token_id])
+        # Walk back up, handing the nodes over to another entry (if any).
+        for depth in range(len(token_ids), 0, -1):
+            node = path[depth]
+            if node.entry_id != entry_id:
+                break
+            if node.children:
+                node.entry_id = next(iter(node.children.values())).entry_id
+            else:
+                del path[depth - 1].children[token_ids[depth - 1]]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        """Returns a one-line summary of the cache usage."""
+        return (
+            f"prefix cache: {len(self)} entries, {self.num_bytes / 2**20:.1f} MB, "
+            f"{self.num_reused_tokens}/{self.num_tokens} prompt tokens reused "
+            f"over {self.num_lookups} lookups"
+        )
+
+
+def forward_with_prefix(model, token_ids, past_length, past_key_values, device):
+    """
+    Runs the model over token_ids[past_length:] on top of the cached keys and
+    values of token_ids[:past_length], for a single sequence.
+
+    Returns the logits of the new tokens and the past_key_values of all the
+    tokens.
+    """
+    input_ids = torch.tensor([token_ids[past_length:]], dtype=torch.long, device=device)
+    position_ids = torch.arange(
+        past_length, len(token_ids), dtype=torch.long, device=device
+    ).unsqueeze(0)
+    outputs = model(
+        input_ids=input_ids,
+        position_ids=position_ids,
+        past_key_values=past_key_values if past_length else None,
+        use_cache=True,
+    )
+    return outputs[0], outputs[1]
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+This source code is licensed under the license found in the LICENSE file in the
+root directory of this source tree.
+
+    CPU int8 inference for the GPT-2 based DST model baseline.
+
+    torch.quantization.quantize_dynamic() only swaps nn.Linear layers, while
+    the attention and MLP projections of GPT-2 are transformers' Conv1D (a
+    linear layer with a transposed weight). These are first replaced with
+    equivalent nn.Linear layers, so that all the projections of the model
+    (and the LM head) run with int8 weights and dynamically quantized
+    activations.
+"""
+import torch
+from transformers.pytorch_utils import Conv1D
+
+
+def conv1d_to_linear(module):
+    """Replaces (in place) the Conv1D layers of a module with nn.Linear."""
+    for name, child in module.named_children():
+        if isinstance(child, Conv1D):
+            in_features, out_features = child.weight.shape
+            linear = torch.nn.Linear(in_features, out_features)
+            linear.weight.data = child.weight.data.t().contiguous()
+            linear.bias.data = child.bias.data
+            setattr(module, name, linear)
+        else:
+            conv1d_to_linear(child)
+    return module
+
+
+def quantize_model(model):
+    """Returns a CPU model with int8 dynamically quantized linear layers."""
+    if next(model.parameters()).device.type != "cpu":
+        raise ValueError("Dynamic quantization is only supported on CPU.")
+    model = conv1d_to_linear(model)
+    return torch.quantization.quantize_dynamic(
+        model.eval(), {torch.nn.Linear}, dtype=torch.qint8
+    )
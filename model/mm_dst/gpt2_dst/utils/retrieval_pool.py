@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+This source code is licensed under the license found in the LICENSE file in the
+root directory of this source tree.
+
+    Pre-tokenized retrieval candidates for the GPT-2 based DST model baseline.
+
+    Rather than one flattened line per (turn, candidate), retrieval inputs
+    can be given as the predict file (one context per turn), the retrieval
+    index written by convert_json_to_flattened(..., retrieval_index=True)
+    and the "system_transcript_pool", which is tokenized once per domain.
+"""
+import json
+
+import numpy as np
+
+from gpt2_dst.utils.convert import (
+    END_OF_SENTENCE,
+    START_OF_RESPONSE,
+    TEMPLATE_TARGET_NOBELIEF,
+)
+
+
+def split_retrieval_target(response):
+    """
+    Returns the text that follows <SOR> in the flattened line of a candidate
+    response, e.g. " response <EOS>".
+    """
+    retrieval_target = TEMPLATE_TARGET_NOBELIEF.format(
+        context="",
+        response=response,
+        END_OF_SENTENCE=END_OF_SENTENCE,
+        START_OF_RESPONSE=START_OF_RESPONSE,
+    )
+    return retrieval_target.partition(START_OF_RESPONSE)[2]
+
+
+class TokenizedPool:
+    """
+    Token ids of the candidate responses of each domain, stored as a flat
+    int32 array and the offsets of each response.
+    """
+
+    def __init__(self, options_pool, encode):
+        self.token_ids = {}
+        self.offsets = {}
+        for domain, responses in options_pool.items():
+            encoded = [encode(split_retrieval_target(ii)) for ii in responses]
+            self.offsets[domain] = np.cumsum([0] + [len(ii) for ii in encoded])
+            self.token_ids[domain] = np.fromiter(
+                (token_id for ii in encoded for token_id in ii),
+                dtype=np.int32,
+                count=self.offsets[domain][-1],
+            )
+
+    def __getitem__(self, key):
+        domain, index = key
+        offsets = self.offsets[domain]
+        return self.token_ids[domain][offsets[index] : offsets[index + 1]].tolist()
+
+
+def load_retrieval_index(path):
+    """Returns the (domain, candidate indices) of each turn of an index file."""
+    with open(path, "r") as file_id:
+        return [
+            (entry["domain"], entry["candidates"])
+            for entry in map(json.loads, file_id)
+        ]
+
+
+def split_context(prompt_text):
+    """Returns the context of a predict line, up to and including <SOR>."""
+    context, found, _ = prompt_text.partition(START_OF_RESPONSE)
+    if not found:
+        raise ValueError(f"No {START_OF_RESPONSE} in: {prompt_text}")
+    return context + START_OF_RESPONSE
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+This source code is licensed under the license found in the LICENSE file in the
+root directory of this source tree.
+
+    Sharded, resumable outputs for run_generation.py and run_retrieval.py.
+
+    Each process handles a contiguous shard of the prompts and appends its
+    results to a shard file as they are computed. The byte offset of the
+    results that are safely on disk is checkpointed next to it, so that a
+    restarted process drops anything written after the checkpoint and
+    resumes from there. merge_shards() reassembles the results of all the
+    shards in the original order.
+
+    The checkpoint also records a key of the run configuration (the model
+    and the arguments that affect the results, see config_key()): a shard
+    left over by a run with another configuration is never resumed from.
+"""
+import hashlib
+import json
+import os
+import time
+
+# Minimum time between two checkpoints (each one syncs the shard file).
+CHECKPOINT_SECONDS = 30
+
+
+def shard_range(num_items, shard_id, num_shards):
+    """Returns the (start, end) indices of a contiguous shard of items."""
+    if not 0 <= shard_id < num_shards:
+        raise ValueError(f"--shard_id should be in [0, {num_shards}).")
+    return (
+        num_items * shard_id // num_shards,
+        num_items * (shard_id + 1) // num_shards,
+    )
+
+
+def shard_path(path_output, shard_id, num_shards):
+    return f"{path_output}.shard{shard_id}-of-{num_shards}"
+
+
+def config_key(args, arg_names):
+    """Returns a key of the values of the given (result affecting) arguments."""
+    config = json.dumps(
+        {name: getattr(args, name) for name in arg_names}, sort_keys=True
+    )
+    return hashlib.sha1(config.encode("utf-8")).hexdigest()
+
+
+def _read_checkpoint(path, num_items, config=None):
+    """
+    Returns the checkpointed offset of a shard file (0 if there is none), and
+    the config key it was written with.
+    """
+    checkpoint_path = path + ".ckpt"
+    if not os.path.exists(checkpoint_path):
+        return 0, config
+    with open(checkpoint_path, "r") as file_id:
+        checkpoint = json.load(file_id)
+    if checkpoint["num_items"] != num_items:
+        raise ValueError(
+            f"{path} was written for {checkpoint['num_items']} prompts, "
+            f"not {num_items}."
+        )
+    if config is not None and checkpoint.get("config") != config:
+        raise ValueError(
+            f"{path} was written with another model or arguments; remove it "
+            f"(and {checkpoint_path}) to start over."
+        )
+    return checkpoint["offset"], checkpoint.get("config")
+
+
+def _read_records(path, offset):
+    records = {}
+    if offset == 0:
+        return records
+    with open(path, "rb") as file_id:
+        data = file_id.read(offset)
+    if len(data) != offset:
+        raise ValueError(f"{path} is shorter than its checkpoint.")
+    for line in data.splitlines():
+        index, result = json.loads(line)
+        records[index] = result
+    return records
+
+
+class ShardWriter:
+    """
+    Appends (index, result) records to a shard file as JSON lines.
+
+    Records of a previous run with the same config up to its last checkpoint
+    are loaded into `done`, and anything written after that checkpoint is
+    discarded.
+    """
+
+    def __init__(
+        self, path, num_items, config, checkpoint_seconds=CHECKPOINT_SECONDS
+    ):
+        self.path = path
+        self.num_items = num_items
+        self.config = config
+        self.checkpoint_seconds = checkpoint_seconds
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        offset, _ = _read_checkpoint(path, num_items, config)
+        self.done = _read_records(path, offset)
+        if os.path.exists(path):
+            with open(path, "r+b") as file_id:
+                file_id.truncate(offset)
+        self.file_id = open(path, "ab")
+        self.last_checkpoint = time.time()
+
+    def write(self, index, result):
+        self.file_id.write((json.dumps([index, result]) + "\n").encode("utf-8"))
+
+    def maybe_checkpoint(self):
+        """Checkpoints, if the last checkpoint is old enough."""
+        if time.time() - self.last_checkpoint >= self.checkpoint_seconds:
+            self.checkpoint()
+
+    def checkpoint(self):
+        self.file_id.flush()
+        os.fsync(self.file_id.fileno())
+        checkpoint_path = self.path + ".ckpt"
+        with open(checkpoint_path + ".tmp", "w") as file_id:
+            json.dump(
+                {
+                    "offset": self.file_id.tell(),
+                    "num_items": self.num_items,
+                    "config": self.config,
+                },
+                file_id,
+            )
+        os.replace(checkpoint_path + ".tmp", checkpoint_path)
+        self.last_checkpoint = time.time()
+
+    def close(self):
+        self.checkpoint()
+        self.file_id.close()
+
+
+def merge_shards(path_output, num_shards, num_items):
+    """
+    Returns the results of all the shards, in the original order. All the
+    shards should have been written with the same config.
+    """
+    records = {}
+    config = None
+    for shard_id in range(num_shards):
+        path = shard_path(path_output, shard_id, num_shards)
+        if os.path.exists(path):
+            offset, config = _read_checkpoint(path, num_items, config)
+            records.update(_read_records(path, offset))
+
+    missing = [ii for ii in range(num_items) if ii not in records]
+    if missing:
+        raise ValueError(
+            f"{len(missing)} / {num_items} results are missing from the shards "
+            f"of {path_output}, e.g. #{missing[0]}."
+        )
+    return [records[ii] for ii in range(num_items)]
+
+
+def remove_shards(path_output, num_shards):
+    for shard_id in range(num_shards):
+        path = shard_path(path_output, shard_id, num_shards)
+        for file_path in (path, path + ".ckpt"):
+            if os.path.exists(file_path):
+                os.remove(file_path)
@@ -7,6 +7,8 @@ else
     PATH_DIR=$(realpath "$1")
     PATH_DATA_DIR=$(realpath "$2")
 fi
+# Number of processes used to format each split (e.g. NUM_WORKERS=$(nproc))
+NUM_WORKERS=${NUM_WORKERS:-1}
 
 # Train split
 python3 -m gpt2_dst.scripts.preprocess_input \
@@ -15,6 +17,7 @@ python3 -m gpt2_dst.scripts.preprocess_input \
     --output_path_target="${PATH_DIR}"/gpt2_dst/data/simmc2.1_dials_dstc11_train_target.txt \
     --len_context=2 \
     --use_multimodal_contexts=1 \
+    --num_workers="${NUM_WORKERS}" \
     --output_path_special_tokens="${PATH_DIR}"/gpt2_dst/data/simmc2_special_tokens.json
 
 # Dev split
@@ -24,6 +27,7 @@ python3 -m gpt2_dst.scripts.preprocess_input \
     --output_path_target="${PATH_DIR}"/gpt2_dst/data/simmc2.1_dials_dstc11_dev_target.txt \
     --len_context=2 \
     --use_multimodal_contexts=1 \
+    --num_workers="${NUM_WORKERS}" \
     --input_path_special_tokens="${PATH_DIR}"/gpt2_dst/data/simmc2_special_tokens.json \
     --output_path_special_tokens="${PATH_DIR}"/gpt2_dst/data/simmc2_special_tokens.json \
 
@@ -34,6 +38,7 @@ python3 -m gpt2_dst.scripts.preprocess_input \
     --output_path_target="${PATH_DIR}"/gpt2_dst/data/simmc2.1_dials_dstc11_devtest_target.txt \
     --len_context=2 \
     --use_multimodal_contexts=1 \
+    --num_workers="${NUM_WORKERS}" \
     --input_path_special_tokens="${PATH_DIR}"/gpt2_dst/data/simmc2_special_tokens.json \
     --output_path_special_tokens="${PATH_DIR}"/gpt2_dst/data/simmc2_special_tokens.json \
 
@@ -44,6 +49,7 @@ python3 -m gpt2_dst.scripts.preprocess_input \
     --output_path_target="${PATH_DIR}"/gpt2_dst/data/simmc2.1_dials_dstc11_teststd_target.txt \
     --len_context=2 \
     --use_multimodal_contexts=1 \
+    --num_workers="${NUM_WORKERS}" \
     --input_path_special_tokens="${PATH_DIR}"/gpt2_dst/data/simmc2_special_tokens.json \
     --output_path_special_tokens="${PATH_DIR}"/gpt2_dst/data/simmc2_special_tokens.json \
     --no_target
\ No newline at end of file
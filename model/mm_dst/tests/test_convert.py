@@ -0,0 +1,113 @@
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+This source code is licensed under the license found in the LICENSE file in the
+root directory of this source tree.
+
+    Checks that the precompiled belief state parser of convert.py matches
+    the original one, which recompiled its regexes for every line.
+"""
+import random
+import re
+
+import pytest
+
+from gpt2_dst.utils.convert import (
+    END_OF_BELIEF,
+    START_BELIEF_STATE,
+    parse_flattened_result,
+)
+
+
+def reference_parse_flattened_result(to_parse):
+    """The original parser, before the regexes were precompiled."""
+    dialog_act_regex = re.compile(
+        r"([\w:?.?]*)  *\[(.*)\] *\(([^\]]*)\) *\<([^\]]*)\> *\|([^\]]*)\|"
+    )
+    slot_regex = re.compile(r"([A-Za-z0-9_.-:]*)  *= (\[(.*)\]|[^,]*)")
+    request_regex = re.compile(r"([A-Za-z0-9_.-:]+)")
+    object_regex = re.compile(r"([A-Za-z0-9]+)")
+
+    belief = []
+    splits = to_parse.strip().split(START_BELIEF_STATE)
+    if len(splits) != 2:
+        return belief
+    splits = splits[1].strip().split(END_OF_BELIEF)
+    if len(splits) != 2:
+        return belief
+    for dialog_act in dialog_act_regex.finditer(splits[0].strip()):
+        frame = {
+            "act": dialog_act.group(1),
+            "slots": [
+                [slot.group(1).strip(), slot.group(2).strip()]
+                for slot in slot_regex.finditer(dialog_act.group(2))
+            ],
+            "request_slots": [
+                ii.group(1).strip() for ii in request_regex.finditer(dialog_act.group(3))
+            ],
+            "objects": [],
+            "disambiguation_candidates": [],
+        }
+        for key, group in (("objects", 4), ("disambiguation_candidates", 5)):
+            for object_id in object_regex.finditer(dialog_act.group(group)):
+                try:
+                    frame[key].append(int(object_id.group(1).strip()))
+                except ValueError:
+                    pass
+        belief.append(frame)
+    return belief
+
+
+PREFIX = "User : Show me something else => Belief State : "
+TRICKY_LINES = [
+    # Well-formed, with list-valued slots and request slots.
+    PREFIX + "INFORM:GET [ sleeveLength = short, availableSizes = ['XXL', 'S', "
+    "'L'], pattern = leafy design ] (availableSizes, pattern) < 86, 57 > "
+    "| 53, 24 | <EOB> Sure, here it is. <EOS>",
+    # Nested brackets in slot values.
+    PREFIX + "INFORM:REFINE [ type = [ jacket, [ coat ] ], color = [] ] () "
+    "< 1 > | | <EOB>",
+    # Empty slots, request slots, objects and candidates.
+    PREFIX + "REQUEST:COMPARE [ ] ( ) < > | | <EOB>",
+    PREFIX + "ASK:GET [ = blue, size = ] (price) < 3 > | | <EOB>",
+    # Object IDs mixed with non-numeric tokens.
+    PREFIX + "INFORM:GET [ ] () < 12, 3a, a3, 007, -4 > | 5b, 6 | <EOB>",
+    # Several frames.
+    PREFIX + "INFORM:GET [ type = shirt ] () < 1 > | | REQUEST:ADD_TO_CART "
+    "[ ] () < 2, 3 > | 4 | <EOB>",
+    # Missing or repeated markers.
+    PREFIX + "INFORM:GET [ type = shirt ] () < 1 > | |",
+    PREFIX + "INFORM:GET [ ] () < 1 > | | <EOB> <EOB>",
+    "INFORM:GET [ ] () < 1 > | | <EOB>",
+    PREFIX + PREFIX + "INFORM:GET [ ] () < 1 > | | <EOB>",
+    # Malformed frames.
+    PREFIX + "INFORM:GET [ type = shirt () < 1 > | | <EOB>",
+    PREFIX + "INFORM:GET type = shirt ] ( < 1 | | <EOB>",
+    "",
+    "\n",
+]
+
+
+@pytest.mark.parametrize("line", TRICKY_LINES)
+def test_parse_flattened_result_tricky_lines(line):
+    assert parse_flattened_result(line) == reference_parse_flattened_result(line)
+
+
+def test_parse_flattened_result_mutated_lines():
+    # Drop, duplicate or swap random characters of well-formed lines.
+    random_state = random.Random(0)
+    for _ in range(5000):
+        line = list(random_state.choice(TRICKY_LINES[:6]))
+        for _ in range(random_state.randint(1, 4)):
+            index = random_state.randrange(len(line))
+            mutation = random_state.randrange(3)
+            if mutation == 0:
+                del line[index]
+            elif mutation == 1:
+                line.insert(index, line[index])
+            else:
+                line[index] = random_state.choice("[]()<>|,= 0123456789abc:")
+        line = "".join(line)
+        assert parse_flattened_result(line) == reference_parse_flattened_result(
+            line
+        ), line
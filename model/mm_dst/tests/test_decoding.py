@@ -0,0 +1,165 @@
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+This source code is licensed under the license found in the LICENSE file in the
+root directory of this source tree.
+
+    Checks that BeliefStateGrammar accepts the belief states of the dataset,
+    and forces even a randomly initialized model to a well-formed one.
+"""
+import json
+
+import pytest
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel, GPT2Tokenizer
+from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+
+from gpt2_dst.utils.convert import (
+    END_OF_BELIEF,
+    END_OF_MULTIMODAL_CONTEXTS,
+    END_OF_SENTENCE,
+    START_BELIEF_STATE,
+    START_OF_MULTIMODAL_CONTEXTS,
+    START_OF_RESPONSE,
+    parse_flattened_result,
+)
+from gpt2_dst.utils.decoding import BeliefStateGrammar, decode_batch
+
+PROMPT = f"User : Do you have a red jacket? {START_BELIEF_STATE}"
+# Any belief state of the grammar ends within this many tokens.
+MAX_NEW_TOKENS = 2048
+
+BELIEF_STATES = [
+    "INFORM:GET [ type = jacket, color = red ] (price) < 86, 57 > | 53, 24 |",
+    "REQUEST:COMPARE [  ] () <  > |  |",
+    "INFORM:REFINE [ availableSizes = ['XXL', 'S', 'L'], pattern = leafy design ] "
+    "(availableSizes, pattern) < 1 > | |",
+    "ASK:GET [ brand = Pedals & Gears, price = 184.99 ] (customerReview) <  > | 3 |",
+]
+# Words merged into single tokens, as in the GPT-2 vocabulary.
+MERGED_WORDS = [
+    " the",
+    " red",
+    " jacket",
+    " type",
+    " [",
+    " ]",
+    " =",
+    " <",
+    " >",
+    " |",
+    " (",
+    "),",
+    ", ",
+    "86",
+]
+
+
+@pytest.fixture(scope="module")
+def tokenizer(tmp_path_factory):
+    """A byte-level BPE tokenizer with a few merges and the special tokens."""
+    byte_encoder = bytes_to_unicode()
+    vocab = {char: ii for ii, char in enumerate(byte_encoder.values())}
+    merges = []
+    for word in MERGED_WORDS:
+        chars = [byte_encoder[byte] for byte in word.encode("utf-8")]
+        merged = chars[0]
+        for char in chars[1:]:
+            if merged + char not in vocab:
+                merges.append(f"{merged} {char}")
+                vocab[merged + char] = len(vocab)
+            merged += char
+
+    path = tmp_path_factory.mktemp("tokenizer")
+    with open(path / "vocab.json", "w") as f_vocab:
+        json.dump(vocab, f_vocab)
+    with open(path / "merges.txt", "w") as f_merges:
+        f_merges.write("#version: 0.2\n" + "\n".join(merges) + "\n")
+    tokenizer = GPT2Tokenizer(str(path / "vocab.json"), str(path / "merges.txt"))
+    tokenizer.add_special_tokens(
+        {
+            "eos_token": END_OF_SENTENCE,
+            "additional_special_tokens": [
+                END_OF_BELIEF,
+                START_OF_RESPONSE,
+                START_OF_MULTIMODAL_CONTEXTS,
+                END_OF_MULTIMODAL_CONTEXTS,
+                "INFORM:GET",
+                "REQUEST:COMPARE",
+                "type",
+                "pattern",
+            ],
+        }
+    )
+    return tokenizer
+
+
+@pytest.fixture(scope="module")
+def grammar(tokenizer):
+    return BeliefStateGrammar(tokenizer)
+
+
+@pytest.mark.parametrize("belief_state", BELIEF_STATES)
+def test_grammar_accepts_belief_states(tokenizer, grammar, belief_state):
+    state = grammar.initial_state(PROMPT)
+    for token_id in tokenizer.encode(f" {belief_state} {END_OF_BELIEF}"):
+        assert grammar.allowed_tokens([state])[0, token_id], tokenizer.decode(
+            [token_id]
+        )
+        state = grammar.next_state(state, token_id)
+    assert grammar.allowed_tokens([state]) is None
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        " INFORM:GOT [",
+        " INFORM:GET [ colour = red",
+        " INFORM:GET [ type = red ] (price) < 8a",
+        " INFORM:GET [ type = red ] (price) < 86 > | 1 | |",
+        " INFORM:GET" + " " * 3,
+    ],
+)
+def test_grammar_rejects_malformed_belief_states(tokenizer, grammar, text):
+    state = grammar.initial_state(PROMPT)
+    for token_id in tokenizer.encode(text):
+        if not grammar.allowed_tokens([state])[0, token_id]:
+            return
+        state = grammar.next_state(state, token_id)
+    pytest.fail(f"Accepted {text!r}")
+
+
+@pytest.mark.parametrize("do_sample", [True, False])
+def test_random_model_reaches_belief_state(tokenizer, grammar, do_sample):
+    torch.manual_seed(0)
+    config = GPT2Config(
+        vocab_size=len(tokenizer),
+        n_positions=MAX_NEW_TOKENS + 64,
+        n_embd=32,
+        n_layer=2,
+        n_head=2,
+    )
+    model = GPT2LMHeadModel(config).eval()
+
+    batch_size = 8
+    input_ids = torch.tensor([tokenizer.encode(PROMPT)] * batch_size)
+    with torch.no_grad():
+        generated = decode_batch(
+            model,
+            input_ids,
+            torch.ones_like(input_ids),
+            MAX_NEW_TOKENS,
+            stop_token_ids=[grammar.end_of_belief_id],
+            do_sample=do_sample,
+            grammar=grammar,
+            grammar_states=[grammar.initial_state(PROMPT)] * batch_size,
+        )
+
+    for token_ids in generated:
+        assert token_ids[-1] == grammar.end_of_belief_id
+        text = tokenizer.decode(token_ids)
+        belief = parse_flattened_result(PROMPT + text)
+        assert len(belief) == 1, text
+        assert belief[0]["act"] in grammar.acts
+        assert all(slot in grammar.slots for slot, _ in belief[0]["slots"])
+        assert all(slot in grammar.slots for slot in belief[0]["request_slots"])
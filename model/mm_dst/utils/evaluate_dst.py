@@ -110,9 +110,12 @@ def evaluate_from_flat_list(d_true, d_pred):
     c = initialize_count_dict()
 
     # Count # corrects & # wrongs
-    for i in range(len(d_true)):
-        true_turn = d_true[i]
-        pred_turn = d_pred[i]
+    # (d_true and d_pred may also be iterators, e.g. parsed lazily)
+    d_pred = iter(d_pred)
+    for true_turn in d_true:
+        pred_turn = next(d_pred, None)
+        if pred_turn is None:
+            raise IndexError("Fewer predicted turns than target turns")
         turn_evaluation = evaluate_turn(true_turn, pred_turn)
 
         c = add_dicts(c, turn_evaluation)
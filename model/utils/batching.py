@@ -0,0 +1,123 @@
+#! /usr/bin/env python
+"""
+Copyright (c) Facebook, Inc. and its affiliates.
+All rights reserved.
+This source code is licensed under the license found in the LICENSE file in the
+root directory of this source tree.
+
+Batching utilities shared by the dataloaders of the disambiguation and the
+ambiguous candidate identification baselines.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import concurrent.futures
+
+import numpy as np
+import torch
+
+# Number of batches per bucket of instances sorted by length.
+BUCKET_NUM_BATCHES = 50
+
+
+def gather_token_ids(token_ids, token_offsets, indices, pad_token_id, left_padding):
+    """
+    Gathers the token ids of the given instances from the flat token_ids
+    array (instance ii spans token_offsets[ii] to token_offsets[ii + 1]),
+    padded as the tokenizer would.
+
+    Returns the input_ids and attention_mask tensors.
+    """
+    starts = token_offsets[indices]
+    lengths = token_offsets[indices + 1] - starts
+    max_length = lengths.max()
+    positions = np.arange(max_length)
+    if left_padding:
+        positions = positions - (max_length - lengths)[:, None]
+    else:
+        positions = np.broadcast_to(positions, (len(indices), max_length))
+    mask = (positions >= 0) & (positions < lengths[:, None])
+    input_ids = token_ids[np.where(mask, starts[:, None] + positions, 0)].astype(
+        np.int64
+    )
+    input_ids[~mask] = pad_token_id
+    return torch.from_numpy(input_ids), torch.from_numpy(mask.astype(np.int64))
+
+
+def split_epoch(indices, batch_size, lengths=None):
+    """
+    Splits the shuffled indices of an epoch into batches (the last one may be
+    smaller).
+
+    With lengths, the indices are first sorted by length within buckets of
+    BUCKET_NUM_BATCHES batches, so that batches need less padding, and the
+    order of the batches is shuffled.
+    """
+    if lengths is not None:
+        bucket_size = batch_size * BUCKET_NUM_BATCHES
+        indices = np.concatenate(
+            [
+                bucket[np.argsort(lengths[bucket], kind="stable")]
+                for bucket in np.split(
+                    indices, np.arange(bucket_size, len(indices), bucket_size)
+                )
+            ]
+        )
+    batches = [
+        indices[start : start + batch_size]
+        for start in range(0, len(indices), batch_size)
+    ]
+    if lengths is not None:
+        batches = [batches[ii] for ii in np.random.permutation(len(batches))]
+    return batches
+
+
+def to_gpu(tensor, pin_memory=False):
+    """Moves a tensor to the GPU, asynchronously from pinned memory if asked."""
+    if pin_memory:
+        return tensor.pin_memory().cuda(non_blocking=True)
+    return tensor.cuda()
+
+
+class BatchPrefetcher:
+    """
+    Iterates over the batches of a Dataloader given by batch_indices, while
+    worker threads build the next num_batches ones in the background.
+
+    The indices of each batch are drawn (from np.random) in the main thread,
+    in order, when the batch is queued: the batches are the same as without
+    prefetching, whatever the number of workers.
+    """
+
+    def __init__(self, loader, batch_indices, num_batches, num_workers, pin_memory):
+        self._loader = loader
+        self._batch_indices = batch_indices
+        self._pin_memory = pin_memory
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_workers)
+        self._pending = collections.deque()
+        for _ in range(num_batches):
+            self._queue_batch()
+
+    def _queue_batch(self):
+        indices = next(self._batch_indices)
+        self._pending.append(
+            self._executor.submit(
+                self._loader.get_indexed_data, indices, self._pin_memory
+            )
+        )
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        batch = self._pending.popleft().result()
+        self._queue_batch()
+        return batch
+
+    def close(self):
+        """Stops the workers, dropping the batches not built yet."""
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._executor.shutdown(wait=True)